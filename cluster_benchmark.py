@@ -0,0 +1,102 @@
+"""
+Aggregate queries answered per second by a Cluster, by worker count.
+
+Starts clusters of increasing size on loopback and points load generator
+processes at them.  Each generator keeps a window of ping and get_peers
+queries in flight, spread over all worker ports, and counts the answers.
+Workers and generators share the machine, so the totals only grow while
+there are idle cores left.
+
+    python cluster_benchmark.py [seconds] [generators] [max workers]
+"""
+import os
+import random
+import socket
+import sys
+import time
+
+from bencode import bencode
+from twisted.internet import defer, reactor, utils
+from twisted.python import log
+
+from src.cluster import Cluster
+from src.utils import generate_node_id
+
+BASE_PORT = 22000
+WINDOW = 64
+
+
+def generate(ports, seconds):
+    """
+    Load generator: print the number of answers received within seconds.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    nodeId = generate_node_id()
+    queries = []
+    for i in range(256):
+        if i % 2:
+            message = {"t": chr(i), "y": "q", "q": "ping", "a": {"id": nodeId}}
+        else:
+            message = {"t": chr(i), "y": "q", "q": "get_peers", "a": {"id": nodeId, "info_hash": generate_node_id()}}
+        queries.append(bencode(message))
+
+    answered = 0
+    sent = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for i in range(WINDOW):
+            sock.sendto(random.choice(queries), ("127.0.0.1", ports[sent % len(ports)]))
+            sent += 1
+        try:
+            for i in range(WINDOW):
+                sock.recv(4096)
+                answered += 1
+        except socket.timeout:
+            pass
+    print answered
+
+
+@defer.inlineCallbacks
+def measure(workers, generators, seconds):
+    cluster = Cluster(workers, port=BASE_PORT, sourceRate=1e9, sourceBurst=1e9)
+    yield cluster.start()
+    yield cluster.bootstrap([])
+
+    ports = ",".join(str(BASE_PORT + i) for i in range(workers))
+    script = os.path.abspath(__file__)
+    outputs = yield defer.gatherResults([
+        utils.getProcessOutput(sys.executable, [script, "generate", ports, str(seconds)], env=os.environ)
+        for _ in range(generators)])
+    yield cluster.stop()
+    defer.returnValue(sum(int(output) for output in outputs) / float(seconds))
+
+
+@defer.inlineCallbacks
+def main(seconds, generators, maxWorkers):
+    print "%d cores, %d generators, %ds per row" % (os.sysconf("SC_NPROCESSORS_ONLN"), generators, seconds)
+    print "%-8s %12s" % ("workers", "queries/s")
+    workers = 1
+    while workers <= maxWorkers:
+        rate = yield measure(workers, generators, seconds)
+        print "%-8d %12.0f" % (workers, rate)
+        workers *= 2
+
+
+def run():
+    if len(sys.argv) > 1 and sys.argv[1] == "generate":
+        generate([int(port) for port in sys.argv[2].split(",")], float(sys.argv[3]))
+        return
+
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    generators = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    maxWorkers = int(sys.argv[3]) if len(sys.argv) > 3 else os.sysconf("SC_NPROCESSORS_ONLN")
+
+    d = main(seconds, generators, maxWorkers)
+    d.addErrback(log.err)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    run()
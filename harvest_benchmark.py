@@ -0,0 +1,110 @@
+"""
+Unique info_hashes harvested per hour: Harvester against a single Server.
+
+Runs a few hundred nodes on a SimulatedNetwork, adds a Harvester and a
+normal Server whose get_peers and announce_peer handlers are hooked to
+record info_hashes, lets both get known, then has random nodes look up
+and announce fresh info_hashes at a steady rate.
+
+    python harvest_benchmark.py [nodes] [harvester ids] [seconds]
+"""
+import random
+import sys
+
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+
+from src.harvest import Harvester
+from src.network import Server
+from src.simulation import SimulatedNetwork, seedRoutingTables
+from src.throttle import InboundThrottle
+from src.utils import generate_node_id
+
+WARMUP = 10
+LOOKUP_RATE = 20
+ANNOUNCE_SHARE = 0.2
+
+
+def makeServer():
+    server = Server(ksize=8, alpha=3, throttle=InboundThrottle(sourceRate=1e6, sourceBurst=1e6))
+    server.protocol._waitTimeout = 1.0
+    return server
+
+
+def hook(server, seen):
+    """
+    Record info_hashes the way a hand-made harvester does it today.
+    """
+    handlers = server.protocol._handlers
+    for method in ("get_peers", "announce_peer"):
+        def recorder(sender, args, handler=handlers[method]):
+            seen.add(args.get("info_hash"))
+            return handler(sender, args)
+        handlers[method] = recorder
+
+
+def traffic(servers, rand, generated):
+    for _ in range(LOOKUP_RATE):
+        server = rand.choice(servers)
+        infoHash = generate_node_id()
+        generated.add(infoHash)
+        if rand.random() < ANNOUNCE_SHARE:
+            server.announce_peer(infoHash, rand.randint(1024, 65535))
+        else:
+            server.get_peers(infoHash)
+
+
+@defer.inlineCallbacks
+def main(count, ids, seconds):
+    rand = random.Random(1)
+    network = SimulatedNetwork(loss=0.02, seed=2)
+    servers = []
+    for i in range(count):
+        server = makeServer()
+        network.listen(server.protocol, network.address(i))
+        servers.append(server)
+    seedRoutingTables(servers, network, rand)
+    entry = [network.address(i) for i in rand.sample(range(count), 10)]
+
+    harvester = Harvester(ids, queryRate=100)
+    network.listen(harvester, network.address(count))
+    harvester.bootstrap(entry)
+
+    baseline = makeServer()
+    baselineSeen = set()
+    hook(baseline, baselineSeen)
+    network.listen(baseline.protocol, network.address(count + 1))
+    yield baseline.bootstrap(entry)
+
+    yield task.deferLater(reactor, WARMUP, lambda: None)
+    harvested = harvester.unique
+    baselineSeen.clear()
+    generated = set()
+
+    loop = task.LoopingCall(traffic, servers, rand, generated)
+    loop.start(1.0)
+    yield task.deferLater(reactor, seconds, loop.stop)
+    yield task.deferLater(reactor, 3, lambda: None)
+
+    harvestedNow = harvester.unique - harvested
+    baselineNow = len(baselineSeen - set([None]))
+    scale = 3600.0 / seconds
+    print "%d nodes, %d lookups/s (%d%% announces), %ds measured" % (count, LOOKUP_RATE, ANNOUNCE_SHARE * 100, seconds)
+    print "%-22s %10s %12s %9s" % ("", "unique", "per hour", "coverage")
+    for name, unique in (("Server (hooked rpc_*)", baselineNow), ("Harvester, %d ids" % ids, harvestedNow)):
+        print "%-22s %10d %12.0f %8.1f%%" % (name, unique, unique * scale, 100.0 * unique / len(generated))
+
+
+def run():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    ids = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    seconds = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+
+    d = main(count, ids, seconds)
+    d.addErrback(log.err)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    run()
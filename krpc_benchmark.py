@@ -0,0 +1,71 @@
+"""
+Messages/sec for answering KRPC queries.
+
+Feeds ping, find_node and get_peers queries into a KademliaProtocol and
+compares the legacy path (bdecode, getattr dispatch, bencode) with the
+KRPC codec path used by datagramReceived.
+
+    python krpc_benchmark.py [messages]
+"""
+import os
+import sys
+import time
+
+from bencode import bencode, bdecode
+
+from src.node import Node
+from src.protocol import KademliaProtocol
+from src.storage import PeerStorage
+
+
+class NullTransport(object):
+    def write(self, data, address):
+        pass
+
+
+def legacy(protocol, datagram, address):
+    msg = bdecode(datagram)
+    f = getattr(protocol, "rpc_%s" % msg["q"], None)
+    response = f(address, msg["a"])
+    response["t"] = msg["t"]
+    protocol.transport.write(bencode(response), address)
+
+
+def codec(protocol, datagram, address):
+    protocol.datagramReceived(datagram, address)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    protocol = KademliaProtocol(Node(os.urandom(20)), PeerStorage(), 8)
+    protocol.transport = NullTransport()
+    sender = os.urandom(20)
+    address = ("10.1.0.1", 6881)
+
+    # a known sender, so answering doesn't also exercise routing table updates
+    protocol.router.addContact(Node(sender, *address))
+    for i in range(200):
+        protocol.router.addContact(Node(os.urandom(20), "10.0.%d.%d" % (i / 250, i % 250), 6881))
+
+    queries = {
+        "ping": {"a": {"id": sender}},
+        "find_node": {"a": {"id": sender, "target": os.urandom(20)}},
+        "get_peers": {"a": {"id": sender, "info_hash": os.urandom(20)}},
+    }
+
+    print "%-10s %14s %14s" % ("query", "legacy msg/s", "codec msg/s")
+    for name, query in sorted(queries.items()):
+        query.update({"t": "aa", "y": "q", "q": name})
+        datagram = bencode(query)
+        rates = []
+        for path in (legacy, codec):
+            started = time.time()
+            for _ in xrange(count):
+                path(protocol, datagram, address)
+            rates.append(count / (time.time() - started))
+        print "%-10s %14.0f %14.0f" % (name, rates[0], rates[1])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Cost of logging per answered query, by log level.
+
+Feeds find_node and get_peers queries from a known sender into a
+KademliaProtocol and times them with info messages emitted to an
+observer that discards them, with only warnings enabled, and with
+logging off.  Then times the crawler's per-round "crawling with nearest"
+message the old way, built eagerly and then dropped, against the lazy
+way with logging off.
+
+    python log_benchmark.py [queries]
+"""
+import os
+import sys
+import time
+
+from bencode import bencode
+from twisted.python import log as twistedLog
+
+from src import log
+from src.node import Node, NodeHeap
+from src.protocol import KademliaProtocol
+from src.storage import PeerStorage
+from src.throttle import InboundThrottle
+
+LEVELS = (("info", log.INFO), ("warning", log.WARNING), ("off", log.OFF))
+
+
+class NullTransport(object):
+    def write(self, data, address):
+        pass
+
+
+def perQuery(protocol, datagrams, address):
+    started = time.time()
+    for datagram in datagrams:
+        protocol.datagramReceived(datagram, address)
+    return (time.time() - started) / len(datagrams) * 1e6
+
+
+def perCall(f, count):
+    started = time.time()
+    for _ in xrange(count):
+        f()
+    return (time.time() - started) / count * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    twistedLog.startLoggingWithObserver(lambda event: None, setStdout=False)
+
+    throttle = InboundThrottle(sourceRate=1e9, sourceBurst=1e9)
+    protocol = KademliaProtocol(Node(os.urandom(20)), PeerStorage(), 8, throttle)
+    protocol.transport = NullTransport()
+    sender = os.urandom(20)
+    address = ("10.1.0.1", 6881)
+    protocol.router.addContact(Node(sender, *address))
+    for i in range(200):
+        protocol.router.addContact(Node(os.urandom(20), "10.0.%d.%d" % (i / 250, i % 250), 6881))
+
+    print "%-10s %s" % ("query", " ".join("%10s" % ("%s us" % name) for name, _ in LEVELS))
+    for method, key in (("find_node", "target"), ("get_peers", "info_hash")):
+        datagrams = [bencode({"t": "aa", "y": "q", "q": method, "a": {"id": sender, key: os.urandom(20)}})
+                     for _ in xrange(count)]
+        costs = []
+        for _, level in LEVELS:
+            log.set_level(level)
+            costs.append(perQuery(protocol, datagrams, address))
+        print "%-10s %s" % (method, " ".join("%10.2f" % cost for cost in costs))
+
+    logger = log.Logger(system=protocol)
+    nearest = NodeHeap(Node(os.urandom(20)), 20)
+    nearest.push([Node(os.urandom(20), "10.2.0.%d" % i, 6881) for i in range(20)])
+    log.set_level(log.OFF)
+    eager = perCall(lambda: logger.info("crawling with nearest: %s" % str(tuple(nearest))), count)
+    lazy = perCall(lambda: logger.info("crawling with nearest: %s", log.lazy(tuple, nearest)), count)
+    print
+    print "crawl round message, logging off: eager %.2f us, lazy %.2f us" % (eager, lazy)
+
+
+if __name__ == "__main__":
+    main()
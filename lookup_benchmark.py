@@ -0,0 +1,134 @@
+"""
+Lookup latency of the round-based and slot-refilling crawl engines, with
+static and RTT-based RPC timeouts.
+
+Runs a few hundred nodes on a SimulatedNetwork with packet loss and a share
+of dead contacts in every routing table, then times find_node and get_peers
+lookups with each engine.  Latencies and timeouts are scaled down tenfold
+from the live network (5-50 ms one-way, 1 s RPC timeout, 50 ms minimum
+adaptive timeout).
+
+    python lookup_benchmark.py [nodes] [lookups]
+"""
+import random
+import sys
+import time
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from src.crawling import NodeSpiderCrawl, ValueSpiderCrawl, ROUNDS, SLOTS
+from src.network import Server
+from src.node import Node
+from src.simulation import SimulatedNetwork, seedRoutingTables
+from src.throttle import InboundThrottle
+from src.timers import TimerWheel
+from src.utils import generate_node_id
+
+RPC_TIMEOUT = 1.0
+MIN_TIMEOUT = 0.05
+STALL_TIMEOUT = 0.2
+LOSS = 0.05
+DEAD_FRACTION = 0.1
+CONCURRENCY = 20
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def build(count, rand):
+    network = SimulatedNetwork(loss=LOSS, seed=rand.random())
+    servers = []
+    for i in range(count):
+        server = Server(ksize=8, alpha=3, throttle=InboundThrottle(sourceRate=1e6, sourceBurst=1e6))
+        server.protocol._waitTimeout = RPC_TIMEOUT
+        server.protocol.timeouts = TimerWheel(0.05)
+        network.listen(server.protocol, network.address(i))
+        servers.append(server)
+    seedRoutingTables(servers, network, rand)
+
+    dead = set(rand.sample(range(count), int(count * DEAD_FRACTION)))
+    for i in dead:
+        network.setDown(network.address(i))
+    live = [s for i, s in enumerate(servers) if i not in dead]
+    return network, servers, live
+
+
+def storeValue(live, key, rand):
+    closest = sorted(live, key=lambda server: server.node.distanceTo(key))[:8]
+    for server in closest:
+        server.storage[key.id] = [("10.200.0.%d" % rand.randint(1, 254), 6881)]
+
+
+def setTimeouts(servers, adaptive):
+    for server in servers:
+        server.protocol.minTimeout = MIN_TIMEOUT if adaptive else RPC_TIMEOUT
+
+
+@defer.inlineCallbacks
+def runLookups(live, crawler, mode, lookups, rand):
+    latencies = []
+    messages = []
+    found = 0
+
+    for batch in range(0, lookups, CONCURRENCY):
+        origins = rand.sample(live, min(CONCURRENCY, lookups - batch))
+        ds = []
+        for origin in origins:
+            key = Node(generate_node_id())
+            if crawler is ValueSpiderCrawl:
+                storeValue(live, key, rand)
+            nearest = origin.protocol.router.findNeighbors(key)
+            spider = crawler(origin.protocol, key, nearest, 8, 3, mode, STALL_TIMEOUT)
+            ds.append(timed(origin, spider))
+        for elapsed, sent, result in (yield defer.gatherResults(ds)):
+            latencies.append(elapsed)
+            messages.append(sent)
+            found += 1 if result else 0
+
+    defer.returnValue((latencies, messages, found))
+
+
+@defer.inlineCallbacks
+def timed(origin, spider):
+    sentBefore = origin.protocol.transport.sent
+    started = time.time()
+    result = yield spider.find()
+    defer.returnValue((time.time() - started, origin.protocol.transport.sent - sentBefore, result))
+
+
+@defer.inlineCallbacks
+def main(count, lookups):
+    rand = random.Random(1)
+    network, servers, live = build(count, rand)
+    print "%d nodes, %d%% dead contacts, %d%% loss, %d lookups per row" % (
+        count, DEAD_FRACTION * 100, LOSS * 100, lookups)
+    print "%-10s %-7s %-9s %9s %9s %9s %9s %9s" % (
+        "lookup", "engine", "timeouts", "p50 ms", "p90 ms", "p99 ms", "msgs", "found")
+
+    for name, crawler in (("find_node", NodeSpiderCrawl), ("get_peers", ValueSpiderCrawl)):
+        for mode in (ROUNDS, SLOTS):
+            for adaptive in (False, True):
+                setTimeouts(servers, adaptive)
+                latencies, messages, found = yield runLookups(live, crawler, mode, lookups, rand)
+                print "%-10s %-7s %-9s %9.0f %9.0f %9.0f %9.1f %8.0f%%" % (
+                    name, mode, "adaptive" if adaptive else "static",
+                    percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+                    percentile(latencies, 0.99) * 1000, sum(messages) / float(len(messages)),
+                    100.0 * found / lookups)
+
+
+def run():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    d = main(count, lookups)
+    d.addErrback(log.err)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    run()
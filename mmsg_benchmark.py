@@ -0,0 +1,69 @@
+"""
+Queries answered per second on loopback, plain UDP port against the
+recvmmsg/sendmmsg one.
+
+Starts a Server listening one way or the other and points load generator
+processes at it.  Each generator keeps a window of ping and get_peers
+queries in flight and counts the answers.  The batched rows also show how
+many datagrams each system call moved.
+
+    python mmsg_benchmark.py [seconds] [generators]
+"""
+import os
+import sys
+
+from twisted.internet import defer, reactor, utils
+from twisted.python import log
+
+from cluster_benchmark import generate
+from src import mmsg
+from src.network import Server
+from src.throttle import InboundThrottle
+
+PORT = 23000
+
+
+@defer.inlineCallbacks
+def measure(batched, generators, seconds):
+    server = Server(throttle=InboundThrottle(sourceRate=1e9, sourceBurst=1e9))
+    port = server.listen(PORT, "127.0.0.1", batched=batched)
+
+    script = os.path.abspath(__file__)
+    outputs = yield defer.gatherResults([
+        utils.getProcessOutput(sys.executable, [script, "generate", str(PORT), str(seconds)], env=os.environ)
+        for _ in range(generators)])
+    yield port.stopListening()
+    defer.returnValue((sum(int(output) for output in outputs) / float(seconds), port))
+
+
+@defer.inlineCallbacks
+def main(seconds, generators):
+    print "%d generators, %ds per row, recvmmsg/sendmmsg %savailable" % (
+        generators, seconds, "" if mmsg.HAVE_MMSG else "not ")
+    print "%-10s %12s %14s %14s" % ("port", "queries/s", "datagrams/recv", "datagrams/send")
+    for batched in (False, True):
+        rate, port = yield measure(batched, generators, seconds)
+        if batched and port.batched:
+            perRecv = "%.1f" % (float(port.received) / max(port.recvCalls, 1))
+            perSend = "%.1f" % (float(port.sent) / max(port.sendCalls, 1))
+        else:
+            perRecv = perSend = "1.0"
+        print "%-10s %12.0f %14s %14s" % ("batched" if batched else "plain", rate, perRecv, perSend)
+
+
+def run():
+    if len(sys.argv) > 1 and sys.argv[1] == "generate":
+        generate([int(sys.argv[2])], float(sys.argv[3]))
+        return
+
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    generators = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    d = main(seconds, generators)
+    d.addErrback(log.err)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    run()
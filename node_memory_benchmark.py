@@ -0,0 +1,69 @@
+"""
+Memory footprint of routing table contacts.
+
+Builds a 100k-node table with the legacy dict-based node layout, the
+slotted Node and the interned slotted Node, and reports resident memory
+per node.  Each layout is measured in a fresh interpreter so allocator
+state from one run doesn't leak into the next.
+
+    python node_memory_benchmark.py [count]
+"""
+import gc
+import os
+import subprocess
+import sys
+
+from src.node import Node
+from src.routing import KBucket
+
+
+class LegacyNode:
+    def __init__(self, id, ip=None, port=None):
+        self.id = id
+        self.ip = ip
+        self.port = port
+        self.long_id = long(id.encode('hex'), 16)
+
+
+LAYOUTS = {
+    "legacy": LegacyNode,
+    "slotted": Node,
+    "interned": Node.intern,
+}
+
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def measure(layout, count):
+    factory = LAYOUTS[layout]
+    contacts = [(os.urandom(20), "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255), 6881)
+                for i in range(count)]
+    table = KBucket(0, 2 ** 160 - 1, count)
+
+    gc.collect()
+    before = rss()
+    for id, ip, port in contacts:
+        table.addNode(factory(id, ip, port))
+    gc.collect()
+    return rss() - before
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    if len(sys.argv) > 2:
+        print measure(sys.argv[2], count)
+        return
+
+    print "%-10s %12s %14s" % ("layout", "total (KiB)", "bytes / node")
+    for layout in ("legacy", "slotted", "interned"):
+        out = subprocess.check_output([sys.executable, __file__, str(count), layout])
+        used = int(out)
+        print "%-10s %12d %14.1f" % (layout, used / 1024, float(used) / count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Lookup and routing performance on a simulated network.
+
+Builds a SimulatedNetwork of Servers with latency, loss and optional
+churn, seeds their routing tables, then runs get_peers, announce_peer,
+bootstrap (of fresh nodes joining) and refresh_table (of every bucket)
+from random live nodes, a batch of them at a time.  Latencies and
+timeouts are scaled down tenfold from the live network, as in
+lookup_benchmark.py.
+
+Prints one JSON object per operation with lookups/s, messages and hops
+per lookup, p50/p99 latency and memory per node, so runs can be kept
+and compared:
+
+    python sim_benchmark.py [nodes] [operations] [churn/s] [rounds|slots] >> results.jsonl
+"""
+import json
+import random
+import resource
+import sys
+import time
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from src import log as dhtlog
+from src.crawling import ROUNDS
+from src.network import Server
+from src.node import Node
+from src.simulation import SimulatedNetwork, seedRoutingTables
+from src.throttle import InboundThrottle
+from src.timers import TimerWheel
+from src.utils import generate_node_id
+
+KSIZE = 8
+ALPHA = 3
+LATENCY = (0.005, 0.05)
+LOSS = 0.02
+RPC_TIMEOUT = 1.0
+MIN_TIMEOUT = 0.05
+DOWNTIME = 30.0
+CONCURRENCY = 20
+BOOTSTRAP_CONTACTS = 3
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Simulation(object):
+    def __init__(self, count, churn, mode, seed=1):
+        self.count = count
+        self.churn = churn
+        self.mode = mode
+        self.rand = random.Random(seed)
+        self.network = SimulatedNetwork(LATENCY, loss=LOSS, seed=self.rand.random())
+        self.servers = []
+        # server -> hops of each lookup it finished since last cleared
+        self.hops = {}
+
+    def addServer(self):
+        server = Server(KSIZE, ALPHA, throttle=InboundThrottle(sourceRate=1e6, sourceBurst=1e6), lookupMode=self.mode)
+        server.protocol._waitTimeout = RPC_TIMEOUT
+        server.protocol.minTimeout = MIN_TIMEOUT
+        server.protocol.timeouts = TimerWheel(0.05)
+        self.network.listen(server.protocol, self.network.address(len(self.servers)))
+        self.servers.append(server)
+        self.hook(server)
+        return server
+
+    def hook(self, server):
+        hops = self.hops[server] = []
+        metrics = server.protocol.metrics
+        finished = metrics.lookupFinished
+
+        def record(kind, messages, duration, lookupHops):
+            hops.append(lookupHops)
+            finished(kind, messages, duration, lookupHops)
+        metrics.lookupFinished = record
+
+    def build(self):
+        """
+        Create and seed every node, then start churning.  Returns the
+        bytes of memory each node took.
+        """
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for _ in xrange(self.count):
+            self.addServer()
+        seedRoutingTables(self.servers, self.network, self.rand)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if self.churn:
+            self.network.startChurn(self.churn, DOWNTIME)
+        # ru_maxrss is in kilobytes on Linux
+        return (after - before) * 1024.0 / self.count
+
+    def live(self):
+        return [server for server in self.servers if server.protocol.transport.address not in self.network.down]
+
+    def storeValue(self, key):
+        closest = sorted(self.live(), key=lambda server: server.node.distanceTo(key))[:KSIZE]
+        for server in closest:
+            server.storage[key.id] = [("10.200.0.%d" % self.rand.randint(1, 254), 6881)]
+
+    def op_get_peers(self, origin):
+        key = Node(generate_node_id())
+        self.storeValue(key)
+        return origin, origin.get_peers(key.id, cached=False).addCallback(bool)
+
+    def op_announce_peer(self, origin):
+        return origin, origin.announce_peer(generate_node_id(), self.rand.randint(1024, 65535))
+
+    def op_bootstrap(self, origin):
+        joiner = self.addServer()
+        contacts = [server.protocol.transport.address for server in self.rand.sample(self.live(), BOOTSTRAP_CONTACTS)]
+        return joiner, joiner.bootstrap(contacts).addCallback(bool)
+
+    def op_refresh_table(self, origin):
+        # make every bucket due
+        for bucket in origin.protocol.router.buckets:
+            bucket.lastUpdated -= origin.refresher.interval + 1
+        return origin, origin.refresh_table().addCallback(lambda _: True)
+
+    @defer.inlineCallbacks
+    def measure(self, name, operations):
+        op = getattr(self, "op_" + name)
+        latencies = []
+        messages = []
+        hops = []
+        ok = 0
+        started = time.time()
+        for batch in range(0, operations, CONCURRENCY):
+            origins = self.rand.sample(self.live(), min(CONCURRENCY, operations - batch))
+            ds = [self.timed(op, origin) for origin in origins]
+            for elapsed, sent, lookupHops, success in (yield defer.gatherResults(ds)):
+                latencies.append(elapsed)
+                messages.append(sent)
+                hops.append(lookupHops)
+                ok += 1 if success else 0
+        elapsed = time.time() - started
+
+        defer.returnValue({
+            "op": name,
+            "operations": operations,
+            "ok": ok,
+            "lookups_per_sec": round(operations / elapsed, 2),
+            "messages_per_lookup": round(sum(messages) / float(operations), 2),
+            "hops_per_lookup": round(sum(hops) / float(operations), 2),
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        })
+
+    @defer.inlineCallbacks
+    def timed(self, op, origin):
+        """
+        Run op from origin.  Returns the wall time, the datagrams sent by
+        the node running it and the longest referral chain of its lookups,
+        and whether it succeeded.
+        """
+        sentBefore = origin.protocol.transport.sent
+        del self.hops[origin][:]
+        started = time.time()
+        server, d = op(origin)
+        if server is not origin:
+            # a node that just joined
+            sentBefore = 0
+        hops = self.hops[server]
+        try:
+            success = yield d
+        except Exception:
+            log.err()
+            success = False
+        defer.returnValue((time.time() - started, server.protocol.transport.sent - sentBefore,
+                           max(hops or [0]), success))
+
+
+@defer.inlineCallbacks
+def main(count, operations, churn, mode):
+    simulation = Simulation(count, churn, mode)
+    memory = simulation.build()
+
+    for name in ("get_peers", "announce_peer", "bootstrap", "refresh_table"):
+        result = yield simulation.measure(name, operations)
+        result.update({"nodes": count, "mode": mode, "loss": LOSS, "churn_per_sec": churn,
+                       "latency_ms": [LATENCY[0] * 1000, LATENCY[1] * 1000], "ksize": KSIZE, "alpha": ALPHA,
+                       "memory_per_node_bytes": int(memory)})
+        print json.dumps(result, sort_keys=True)
+        sys.stdout.flush()
+    simulation.network.stopChurn()
+
+
+def run():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    churn = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    mode = sys.argv[4] if len(sys.argv) > 4 else ROUNDS
+
+    dhtlog.set_level(dhtlog.WARNING)
+    d = main(count, operations, churn, mode)
+    d.addErrback(log.err)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    run()
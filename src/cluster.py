@@ -0,0 +1,339 @@
+"""
+Run one DHT node per core.
+
+A L{Cluster} spawns worker processes, each a full L{Server} with its own
+node id on its own UDP port (port, port + 1, ...).  The ids split the
+keyspace evenly, so every worker holds the densest routing table for its
+own slice; lookups and announces go to the worker closest to the key.
+Announces any worker receives are copied to all the others, so each one
+can answer get_peers for every announced torrent.
+
+The supervisor talks to its workers over their stdin and stdout with
+bencoded netstrings.  Workers log to stderr.
+
+Run as a script, this module is the worker::
+
+    python cluster.py '{"id": "<hex>", "port": 6881, ...}'
+"""
+import json
+import os
+import sys
+
+from bencode import bencode, bdecode
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols.basic import NetstringReceiver
+from twisted.python import failure
+
+from log import Logger
+from node import Node
+from storage import PeerStorage
+from utils import spread_node_ids
+
+
+class SharedPeerStorage(PeerStorage):
+    """
+    L{PeerStorage} that reports every announce it receives, so the
+    cluster can copy it to the other workers.
+    """
+
+    def __init__(self, onAdd=None, **kwargs):
+        PeerStorage.__init__(self, **kwargs)
+        self.onAdd = onAdd
+
+    def addPeer(self, key, peer):
+        PeerStorage.addPeer(self, key, peer)
+        if self.onAdd is not None:
+            self.onAdd(key, peer)
+
+    def addSharedPeer(self, key, peer):
+        """
+        Store an announce another worker received, without reporting it.
+        """
+        PeerStorage.addPeer(self, key, peer)
+
+
+class Channel(NetstringReceiver):
+    """
+    Bencoded messages between the supervisor and a worker.
+
+    Requests carry a "q" command and, if they expect an answer, a "t"
+    transaction id; answers carry the same "t" and either "r" or "e".
+    """
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def __init__(self):
+        self.seq = 0
+        self.pending = {}
+
+    def call(self, command, **args):
+        """
+        Send a command and return a C{Deferred} for its answer.
+        """
+        self.seq += 1
+        args["q"] = command
+        args["t"] = self.seq
+        d = self.pending[self.seq] = defer.Deferred()
+        self.sendString(bencode(args))
+        return d
+
+    def notify(self, command, **args):
+        """
+        Send a command that isn't answered.
+        """
+        args["q"] = command
+        self.sendString(bencode(args))
+
+    def stringReceived(self, string):
+        message = bdecode(string)
+        if "q" in message:
+            self.requestReceived(message)
+            return
+
+        d = self.pending.pop(message["t"], None)
+        if d is None:
+            return
+        if "e" in message:
+            d.errback(failure.Failure(RuntimeError(message["e"])))
+        else:
+            d.callback(message["r"])
+
+    def requestReceived(self, message):
+        f = getattr(self, "cmd_" + message["q"], None)
+        if f is None:
+            result = defer.fail(RuntimeError("unknown command %s" % message["q"]))
+        else:
+            result = defer.maybeDeferred(f, message)
+        if "t" in message:
+            result.addCallbacks(self._answer, self._fail, callbackArgs=(message["t"],), errbackArgs=(message["t"],))
+
+    def _answer(self, result, tid):
+        self.sendString(bencode({"t": tid, "r": result}))
+
+    def _fail(self, reason, tid):
+        self.sendString(bencode({"t": tid, "e": reason.getErrorMessage()}))
+
+
+def _encodePeers(peers):
+    return [[ip, port] for ip, port in peers or []]
+
+
+def _decodePeers(peers):
+    return [tuple(peer) for peer in peers] or None
+
+
+class WorkerChannel(Channel):
+    """
+    The worker's end: runs commands against its L{Server}.
+    """
+
+    def __init__(self, server):
+        Channel.__init__(self)
+        self.server = server
+        server.storage.onAdd = self.publishPeer
+
+    def connectionMade(self):
+        self.notify("ready", port=self.server.protocol.transport.getHost().port)
+
+    def connectionLost(self, reason):
+        # the supervisor went away
+        if reactor.running:
+            reactor.stop()
+
+    def publishPeer(self, key, peer):
+        self.notify("add_peer", h=key, peer=list(peer))
+
+    def cmd_add_peer(self, message):
+        self.server.storage.addSharedPeer(message["h"], tuple(message["peer"]))
+
+    def cmd_bootstrap(self, message):
+        addrs = [tuple(addr) for addr in message["addrs"]]
+        return self.server.bootstrap(addrs).addCallback(len)
+
+    def cmd_get_peers(self, message):
+        return self.server.get_peers(message["h"]).addCallback(_encodePeers)
+
+    def cmd_get_peers_many(self, message):
+        def collect(batch):
+            return dict((key, _encodePeers(peers)) for key, peers in batch.results.iteritems())
+        return self.server.get_peers_many(message["h"], message.get("inflight", 64)).addCallback(collect)
+
+    def cmd_announce_peer(self, message):
+        return self.server.announce_peer(message["h"], message["port"]).addCallback(int)
+
+    def cmd_stats(self, message):
+        router = self.server.protocol.router
+        return {"buckets": len(router.buckets),
+                "nodes": sum(len(bucket) for bucket in router.buckets),
+                "keys": len(list(self.server.storage)),
+                "outstanding": len(self.server.protocol._outstanding)}
+
+
+class SupervisorChannel(Channel):
+    """
+    The supervisor's end of one worker's pipes.
+    """
+
+    def __init__(self, worker):
+        Channel.__init__(self)
+        self.worker = worker
+
+    def cmd_ready(self, message):
+        self.worker.ready.callback(self.worker)
+
+    def cmd_add_peer(self, message):
+        self.worker.cluster.sharePeer(self.worker, message["h"], message["peer"])
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    One worker process, as seen from the supervisor.
+    """
+
+    def __init__(self, cluster, nodeId, port):
+        self.cluster = cluster
+        self.node = Node(nodeId)
+        self.port = port
+        self.channel = SupervisorChannel(self)
+        self.ready = defer.Deferred()
+        self.ended = defer.Deferred()
+        self.log = Logger(system=self)
+
+    def connectionMade(self):
+        # the process transport writes to the worker's stdin
+        self.channel.makeConnection(self.transport)
+
+    def outReceived(self, data):
+        self.channel.dataReceived(data)
+
+    def errReceived(self, data):
+        sys.stderr.write(data)
+
+    def processEnded(self, reason):
+        self.log.info("worker on port %d ended: %s", self.port, reason.getErrorMessage())
+        if not self.ready.called:
+            self.ready.errback(reason)
+        self.ended.callback(self)
+
+
+class Cluster(object):
+    """
+    Supervises count worker L{Server}s listening on port, port + 1, ...
+    """
+
+    def __init__(self, count=2, port=6881, interface="", ksize=20, alpha=3, sourceRate=50, sourceBurst=100):
+        self.count = count
+        self.port = port
+        self.interface = interface
+        self.options = {"interface": interface, "ksize": ksize, "alpha": alpha,
+                        "sourceRate": sourceRate, "sourceBurst": sourceBurst}
+        self.workers = []
+        self.log = Logger(system=self)
+
+    def start(self):
+        """
+        Spawn the workers.  Returns a C{Deferred} that fires once all of
+        them are listening.
+        """
+        env = dict(os.environ)
+        script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+        for i, nodeId in enumerate(spread_node_ids(self.count)):
+            worker = WorkerProcess(self, nodeId, self.port + i)
+            options = dict(self.options, id=nodeId.encode("hex"), port=worker.port)
+            reactor.spawnProcess(worker, sys.executable, [sys.executable, script, json.dumps(options)], env=env)
+            self.workers.append(worker)
+        return defer.gatherResults([started.ready for started in self.workers])
+
+    def stop(self):
+        """
+        Stop every worker.  Returns a C{Deferred} that fires once they exited.
+        """
+        for worker in self.workers:
+            worker.transport.closeStdin()
+        return defer.gatherResults([worker.ended for worker in self.workers])
+
+    def workerFor(self, key):
+        """
+        The worker whose node id is closest to key.
+        """
+        target = Node(key)
+        return min(self.workers, key=lambda worker: worker.node.distanceTo(target))
+
+    def sharePeer(self, source, key, peer):
+        for worker in self.workers:
+            if worker is not source:
+                worker.channel.notify("add_peer", h=key, peer=peer)
+
+    def bootstrap(self, addrs):
+        """
+        Bootstrap every worker from addrs and from each other.  Returns a
+        C{Deferred} firing with the number of nodes each one found.
+        """
+        host = self.interface or "127.0.0.1"
+        siblings = [[host, worker.port] for worker in self.workers]
+        ds = []
+        for worker in self.workers:
+            others = [addr for addr in siblings if addr[1] != worker.port]
+            ds.append(worker.channel.call("bootstrap", addrs=[list(addr) for addr in addrs] + others))
+        return defer.gatherResults(ds)
+
+    def get_peers(self, info_hash):
+        """
+        Look info_hash up on the worker closest to it.
+        """
+        return self.workerFor(info_hash).channel.call("get_peers", h=info_hash).addCallback(_decodePeers)
+
+    def get_peers_many(self, info_hashes, max_inflight=64):
+        """
+        Look many keys up, each on the worker closest to it, all workers at
+        once.  Returns a C{Deferred} firing with a dict of key to peers or
+        C{None}.
+        """
+        shares = {}
+        for key in set(info_hashes):
+            shares.setdefault(self.workerFor(key), []).append(key)
+
+        def merge(answers):
+            results = {}
+            for answer in answers:
+                for key, peers in answer.iteritems():
+                    results[key] = _decodePeers(peers)
+            return results
+
+        ds = [worker.channel.call("get_peers_many", h=keys, inflight=max_inflight)
+              for worker, keys in shares.iteritems()]
+        return defer.gatherResults(ds).addCallback(merge)
+
+    def announce_peer(self, info_hash, port):
+        """
+        Announce from the worker closest to info_hash.
+        """
+        return self.workerFor(info_hash).channel.call("announce_peer", h=info_hash, port=port).addCallback(bool)
+
+    def stats(self):
+        """
+        A C{Deferred} firing with a list of per-worker stats dicts.
+        """
+        return defer.gatherResults([worker.channel.call("stats") for worker in self.workers])
+
+
+def worker_main(argv):
+    from twisted.internet.stdio import StandardIO
+    from twisted.python import log as twistedLog
+
+    from log import FileLogObserver
+    from network import Server
+    from throttle import InboundThrottle
+
+    options = json.loads(argv[1])
+    twistedLog.startLoggingWithObserver(FileLogObserver(sys.stderr).emit, setStdout=False)
+
+    throttle = InboundThrottle(sourceRate=options["sourceRate"], sourceBurst=options["sourceBurst"])
+    server = Server(options["ksize"], options["alpha"], str(options["id"]).decode("hex"),
+                    storage=SharedPeerStorage(), throttle=throttle)
+    server.listen(options["port"], str(options["interface"]))
+    StandardIO(WorkerChannel(server))
+    reactor.run()
+
+
+if __name__ == "__main__":
+    worker_main(sys.argv)
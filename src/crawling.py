@@ -1,16 +1,27 @@
-from collections import Counter
+import time
 
-from log import Logger
+from twisted.internet import defer
+
+from egress import LOOKUP
+from log import Logger, lazy
 from utils import deferred_dict, decode_nodes, decode_values
 from node import Node, NodeHeap
 
 
+# lookup engines: wait for every query of a round before starting the next,
+# or keep alpha queries in flight and refill slots as answers arrive
+ROUNDS = "rounds"
+SLOTS = "slots"
+
+
 class SpiderCrawl(object):
     """
     Crawl the network and look for given 160-bit keys.
     """
+    # lookup kind, for the protocol's metrics
+    kind = None
 
-    def __init__(self, protocol, node, peers, ksize, alpha):
+    def __init__(self, protocol, node, peers, ksize, alpha, mode=ROUNDS, stallTimeout=1.0, priority=LOOKUP):
         """
         Create a new C{SpiderCrawl}er.
 
@@ -20,15 +31,33 @@ class SpiderCrawl(object):
             peers: A list of :class:`~kademlia.node.Node` instances that provide the entry point for the network
             ksize: The value for k based on the paper
             alpha: The value for alpha based on the paper
+            mode: :data:`ROUNDS` or :data:`SLOTS`, the lookup engine to use
+            stallTimeout: In :data:`SLOTS` mode, seconds after which an unanswered
+                          query stops occupying one of the alpha slots
+            priority: The :mod:`~egress` class of this crawl's queries, ``LOOKUP``
+                      unless it is background work
         """
         self.protocol = protocol
         self.ksize = ksize
         self.alpha = alpha
+        self.mode = mode
+        self.stallTimeout = stallTimeout
+        self.priority = priority
         self.node = node
         self.nearest = NodeHeap(self.node, self.ksize)
+        # peers that didn't answer, so later answers can't bring them back
+        self.failed = set()
         self.lastIDsCrawled = []
+        # queries sent, and when the first went out
+        self.messages = 0
+        self.started = None
+        # id -> referrals between a starting peer and that node, and the
+        # longest such chain that ended in an answer
+        self.depths = {}
+        self.hops = 0
         self.log = Logger(system=self)
-        self.log.info("creating spider with peers: %s" % peers)
+        self.log.info("creating spider with peers: %s", peers)
+        self.protocol.router.touchBucketFor(node)
         self.nearest.push(peers)
 
     def _find(self, rpcmethod):
@@ -46,8 +75,17 @@ class SpiderCrawl(object):
           3. if list is same as last time, next call should be to everyone not
              yet queried
           4. repeat, unless nearest list has all been queried, then ur done
+
+        In :data:`SLOTS` mode see :meth:`_findSlots` instead.
         """
-        self.log.info("crawling with nearest: %s" % str(tuple(self.nearest)))
+        if self.started is None:
+            self.started = time.time()
+            return self._find(rpcmethod).addBoth(self._finished)
+
+        if self.mode == SLOTS:
+            return self._findSlots(rpcmethod)
+
+        self.log.info("crawling with nearest: %s", lazy(tuple, self.nearest))
         count = self.alpha
         if self.nearest.getIDs() == self.lastIDsCrawled:
             self.log.info("last iteration same as current - checking all in list now")
@@ -55,15 +93,128 @@ class SpiderCrawl(object):
         self.lastIDsCrawled = self.nearest.getIDs()
 
         ds = {}
-        for peer in self.nearest.getUncontacted()[:count]:
-            ds[peer.id] = rpcmethod(peer, self.node)
+        for peer in self._nextPeers(count):
+            ds[peer.id] = rpcmethod(peer, self.node, self.priority)
             self.nearest.markContacted(peer)
+        self.messages += len(ds)
         return deferred_dict(ds).addCallback(self._nodesFound)
 
+    def _findSlots(self, rpcmethod):
+        """
+        Get either a value or list of nodes, keeping alpha queries in flight.
+
+        Every answer is handled as soon as it arrives and immediately frees
+        its slot for the closest node not yet queried.  A query unanswered
+        after stallTimeout seconds keeps running but gives up its slot.  The
+        lookup ends once every node in the current k nearest has been queried
+        and none of them is still pending.
+        """
+        self.rpcmethod = rpcmethod
+        self.inflight = {}
+        self.stalled = set()
+        self.result = defer.Deferred()
+        self._fillSlots()
+        return self.result
+
+    def _fillSlots(self):
+        while not self.result.called and len(self.inflight) - len(self.stalled) < self.alpha:
+            uncontacted = self._nextPeers(1)
+            if not uncontacted:
+                break
+            peer = uncontacted[0]
+            self.nearest.markContacted(peer)
+            self.inflight[peer.id] = self.protocol.timeouts.callLater(self.stallTimeout, self._stall, peer.id)
+            self.messages += 1
+            d = self.rpcmethod(peer, self.node, self.priority)
+            d.addCallback(self._slotAnswered, peer.id)
+            d.addErrback(self._slotFailed, peer.id)
+
+        if not self.result.called and self.nearest.allBeenContacted():
+            nearestIDs = set(self.nearest.getIDs())
+            if not any(peerid in nearestIDs for peerid in self.inflight):
+                self.result.callback(self._lookupResult(None))
+
+    def _finished(self, result):
+        self.protocol.metrics.lookupFinished(self.kind, self.messages, time.time() - self.started, self.hops)
+        return result
+
+    def _nextPeers(self, count):
+        """
+        The next count uncontacted peers among the k nearest.  Peers whose
+        distance to the target has the same bit length are about equally
+        close, so among those the ones that answer fastest go first.
+        """
+        uncontacted = self.nearest.getUncontacted()
+        uncontacted.sort(key=self._peerRank)
+        return uncontacted[:count]
+
+    def _peerRank(self, peer):
+        estimator = self.protocol.peerRTTs.get(peer) or self.protocol.rtt
+        rtt = estimator.srtt
+        return self.node.distanceTo(peer).bit_length(), rtt
+
+    def _peerFailed(self, peerid):
+        self.failed.add(peerid)
+        self.nearest.remove([peerid])
+
+    def _pushNodes(self, nodes, source):
+        """
+        Add the nodes peer source answered with, one hop further out than it.
+        """
+        depth = self._reached(source)
+        for node in nodes:
+            self.depths.setdefault(node.id, depth + 1)
+        self.nearest.push([node for node in nodes if node.id not in self.failed])
+
+    def _reached(self, peerid):
+        # starting peers are the first hop
+        depth = self.depths.get(peerid, 1)
+        if depth > self.hops:
+            self.hops = depth
+        return depth
+
+    def _slotAnswered(self, response, peerid):
+        self.inflight.pop(peerid).cancel()
+        self.stalled.discard(peerid)
+        if self.result.called:
+            return
+
+        foundValues = self._handleResponse(peerid, response)
+        if foundValues:
+            self.result.callback(self._lookupResult(foundValues))
+        else:
+            self._fillSlots()
+
+    def _slotFailed(self, failure, peerid):
+        """
+        Fail the lookup on an error querying peerid or handling its answer,
+        rather than leave it waiting on a slot that never frees.
+        """
+        timer = self.inflight.pop(peerid, None)
+        if timer is not None:
+            timer.cancel()
+        self.stalled.discard(peerid)
+        if not self.result.called:
+            self.result.errback(failure)
+
+    def _stall(self, peerid):
+        if peerid in self.inflight:
+            self.stalled.add(peerid)
+            self._fillSlots()
+
 
 class ValueSpiderCrawl(SpiderCrawl):
-    def __init__(self, protocol, node, peers, ksize, alpha):
-        SpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha)
+    kind = "get_peers"
+
+    def __init__(self, protocol, node, peers, ksize, alpha, mode=ROUNDS, stallTimeout=1.0, priority=LOOKUP,
+                 callGetPeers=None):
+        """
+        Like :class:`SpiderCrawl`, plus callGetPeers: a replacement for
+        C{protocol.callGetPeers} with the same signature, used to send every
+        get_peers query of this crawl.
+        """
+        SpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha, mode, stallTimeout, priority)
+        self.callGetPeers = callGetPeers or protocol.callGetPeers
         # keep track of the single nearest node without value - per
         # section 2.3 so we can set the key there if found
         self.nearestWithoutValue = NodeHeap(self.node, 1)
@@ -72,59 +223,76 @@ class ValueSpiderCrawl(SpiderCrawl):
         """
         Find either the closest nodes or the value requested.
         """
-        return self._find(self.protocol.callGetPeers)
+        return self._find(self.callGetPeers)
+
+    def _handleResponse(self, peerid, response):
+        """
+        Handle a single get_peers answer, returning the peers it holds.
+        """
+        response = RPCFindResponse(response)
+
+        if not response.happened():
+            self._peerFailed(peerid)
+        elif response.hasValues():
+            self._reached(peerid)
+            return response.getValues()
+        else:
+            peer = self.nearest.getNodeById(peerid)
+            self.nearestWithoutValue.push(peer)
+            self._pushNodes(response.getNodeList(), peerid)
+        return []
+
+    def _lookupResult(self, foundValues):
+        if foundValues:
+            return list(set(foundValues))  # return unique list of values
+        return None  # not found!
 
     def _nodesFound(self, responses):
         """
         Handle the result of an iteration in _find.
         """
-        toremove = []
         foundValues = []
-
         for peerid, response in responses.items():
-            response = RPCFindResponse(response)
+            foundValues.extend(self._handleResponse(peerid, response))
 
-            if not response.happened():
-                toremove.append(peerid)
-            elif response.hasValues():
-                foundValues.extend(response.getValues())
-            else:
-                peer = self.nearest.getNodeById(peerid)
-                self.nearestWithoutValue.push(peer)
-                self.nearest.push(response.getNodeList())
-
-        self.nearest.remove(toremove)
-
-        if len(foundValues) > 0:
-            return list(set(foundValues))  # return unique list of values
-        elif self.nearest.allBeenContacted():
-            return None  # not found!
+        if len(foundValues) > 0 or self.nearest.allBeenContacted():
+            return self._lookupResult(foundValues)
         else:
             return self.find()
 
 
 class NodeSpiderCrawl(SpiderCrawl):
+    kind = "find_node"
+
     def find(self):
         """
         Find the closest nodes.
         """
         return self._find(self.protocol.callFindNode)
 
+    def _handleResponse(self, peerid, response):
+        """
+        Handle a single find_node answer.  Never finds values.
+        """
+        response = RPCFindResponse(response)
+        if not response.happened():
+            self._peerFailed(peerid)
+        else:
+            self._pushNodes(response.getNodeList(), peerid)
+        return []
+
+    def _lookupResult(self, foundValues):
+        return list(self.nearest)
+
     def _nodesFound(self, responses):
         """
         Handle the result of an iteration in _find.
         """
-        toremove = []
         for peerid, response in responses.items():
-            response = RPCFindResponse(response)
-            if not response.happened():
-                toremove.append(peerid)
-            else:
-                self.nearest.push(response.getNodeList())
-        self.nearest.remove(toremove)
+            self._handleResponse(peerid, response)
 
         if self.nearest.allBeenContacted():
-            return list(self.nearest)
+            return self._lookupResult(None)
         return self.find()
 
 
@@ -142,16 +310,17 @@ class RPCFindResponse(object):
 
     def happened(self):
         """
-        Did the other host actually respond?
+        Did the other host actually respond, with a dictionary?  Anything
+        else is as good as no answer.
         """
-        return self.response[0]
+        return self.response[0] and isinstance(self.response[1], dict)
 
     def hasValues(self):
-        return isinstance(self.response[1], dict) and "values" in self.response[1] and len(
-            self.response[1]["values"]) > 0
+        values = self.response[1].get("values")
+        return isinstance(values, list) and len(values) > 0
 
     def getValues(self):
-        return decode_values(self.response[1]["values"])
+        return decode_values([value for value in self.response[1]["values"] if isinstance(value, str)])
 
     def getToken(self):
         return self.response[1]["token"]
@@ -159,7 +328,9 @@ class RPCFindResponse(object):
     def getNodeList(self):
         """
         Get the node list in the response.  If there's no value, this should
-        be set.
+        be set, but a node that only speaks IPv6 answers with "nodes6"
+        alone, so a missing or malformed list counts as empty.
         """
-        nodelist = decode_nodes(self.response[1]["nodes"]) or []
-        return [Node(*nodeple) for nodeple in nodelist]
+        nodes = self.response[1].get("nodes")
+        nodelist = decode_nodes(nodes) if isinstance(nodes, str) else []
+        return [Node.intern(*nodeple) for nodeple in nodelist]
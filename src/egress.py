@@ -0,0 +1,171 @@
+"""
+Outbound scheduling and bandwidth capping.
+"""
+import socket
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.error import MessageLengthError
+from twisted.python import log
+
+# traffic classes, highest priority first
+RESPONSE = 0
+LOOKUP = 1
+MAINTENANCE = 2
+
+CLASS_NAMES = ("response", "lookup", "maintenance")
+
+
+class EgressQueue(object):
+    """
+    Sends a protocol's datagrams in priority order under a global cap.
+
+    Every datagram belongs to one of three classes: answers to other
+    nodes' queries, queries of lookups someone is waiting on, and
+    background maintenance such as bootstrap, bucket refresh, eviction
+    pings and republishing.  Queued datagrams of a higher class always go
+    out before those of a lower one.
+
+    The cap is a token bucket of byteRate bytes and/or packetRate
+    datagrams per second, holding up to burst seconds' worth.  While
+    there are tokens and nothing is queued, datagrams are written right
+    away; otherwise they wait in their class's queue of at most maxQueued
+    entries, and beyond that are dropped.  Without a cap nothing is ever
+    queued.
+
+    depth() gives the queued datagrams per class; sent, dropped, failed
+    (the port refused them), waited (total seconds spent queued) and
+    maxWait are kept per class too.
+    """
+
+    def __init__(self, protocol, byteRate=None, packetRate=None, burst=1.0, maxQueued=4096, clock=reactor):
+        self.protocol = protocol
+        self.byteRate = byteRate
+        self.packetRate = packetRate
+        self.burst = burst
+        self.maxQueued = maxQueued
+        self.clock = clock
+        self.capped = byteRate is not None or packetRate is not None
+        self.byteTokens = byteRate * burst if byteRate is not None else 0.0
+        self.packetTokens = packetRate * burst if packetRate is not None else 0.0
+        self.stamp = clock.seconds()
+        # per class: deque of (datagram, address, queued at, onSent, args)
+        self.queues = tuple(deque() for _ in CLASS_NAMES)
+        self.queued = 0
+        self.drainCall = None
+
+        self.sent = [0] * len(CLASS_NAMES)
+        self.dropped = [0] * len(CLASS_NAMES)
+        self.failed = [0] * len(CLASS_NAMES)
+        self.waited = [0.0] * len(CLASS_NAMES)
+        self.maxWait = [0.0] * len(CLASS_NAMES)
+
+    def write(self, datagram, address, priority=RESPONSE, onSent=None, *args):
+        """
+        Send datagram to address, now or once the cap and higher classes
+        allow.  onSent, if given, is called with whether the datagram went
+        out followed by args, once it is written, or fails to be, or is
+        dropped.  Returns False if it was dropped or failed right away.
+        """
+        if not self.capped:
+            return self._send(datagram, address, priority, onSent, args)
+
+        if not self.queued:
+            self._refill()
+            if self._hasTokens(len(datagram)):
+                return self._send(datagram, address, priority, onSent, args)
+
+        queue = self.queues[priority]
+        if len(queue) >= self.maxQueued:
+            self.dropped[priority] += 1
+            if onSent is not None:
+                onSent(False, *args)
+            return False
+        queue.append((datagram, address, self.clock.seconds(), onSent, args))
+        self.queued += 1
+        self._scheduleDrain(len(datagram))
+        return True
+
+    def depth(self):
+        """
+        The number of datagrams queued, by class name.
+        """
+        return dict(zip(CLASS_NAMES, map(len, self.queues)))
+
+    def stats(self):
+        """
+        Queue depth, datagrams sent, dropped and failed, and mean and worst
+        wait in seconds, by class name.
+        """
+        stats = {}
+        for i, name in enumerate(CLASS_NAMES):
+            stats[name] = {"queued": len(self.queues[i]),
+                           "sent": self.sent[i],
+                           "dropped": self.dropped[i],
+                           "failed": self.failed[i],
+                           "meanWait": self.waited[i] / self.sent[i] if self.sent[i] else 0.0,
+                           "maxWait": self.maxWait[i]}
+        return stats
+
+    def _send(self, datagram, address, priority, onSent, args):
+        if self.capped:
+            self.byteTokens -= len(datagram)
+            self.packetTokens -= 1
+        sent = True
+        # the port may have gone away while this was queued
+        if self.protocol.transport is not None:
+            try:
+                self.protocol.transport.write(datagram, address)
+            except (socket.error, MessageLengthError):
+                log.err(None, "sending a datagram to %r failed" % (address,))
+                sent = False
+        if sent:
+            self.sent[priority] += 1
+        else:
+            self.failed[priority] += 1
+        if onSent is not None:
+            onSent(sent, *args)
+        return sent
+
+    def _refill(self):
+        now = self.clock.seconds()
+        elapsed = now - self.stamp
+        self.stamp = now
+        if self.byteRate is not None:
+            self.byteTokens = min(self.byteRate * self.burst, self.byteTokens + elapsed * self.byteRate)
+        if self.packetRate is not None:
+            self.packetTokens = min(self.packetRate * self.burst, self.packetTokens + elapsed * self.packetRate)
+
+    def _hasTokens(self, size):
+        # a datagram bigger than the whole bucket goes out once it is full
+        return ((self.byteRate is None or self.byteTokens >= min(size, self.byteRate * self.burst)) and
+                (self.packetRate is None or self.packetTokens >= 1))
+
+    def _scheduleDrain(self, size):
+        if self.drainCall is not None:
+            return
+        # time until the next datagram of the given size fits
+        delay = 0.0
+        if self.byteRate is not None:
+            delay = max(delay, (min(size, self.byteRate * self.burst) - self.byteTokens) / self.byteRate)
+        if self.packetRate is not None:
+            delay = max(delay, (1 - self.packetTokens) / self.packetRate)
+        self.drainCall = self.clock.callLater(max(delay, 0.001), self._drain)
+
+    def _drain(self):
+        self.drainCall = None
+        self._refill()
+        now = self.clock.seconds()
+        for priority, queue in enumerate(self.queues):
+            while queue:
+                datagram, address, queuedAt, onSent, args = queue[0]
+                if not self._hasTokens(len(datagram)):
+                    self._scheduleDrain(len(datagram))
+                    return
+                queue.popleft()
+                self.queued -= 1
+                wait = now - queuedAt
+                self.waited[priority] += wait
+                if wait > self.maxWait[priority]:
+                    self.maxWait[priority] = wait
+                self._send(datagram, address, priority, onSent, args)
@@ -0,0 +1,225 @@
+"""
+Info_hash harvesting.
+
+A L{Harvester} is a UDP protocol that poses as many nodes at once.  Its
+virtual node ids split the keyspace evenly and every query is answered
+from the id closest to its target, so the harvester sits in routing
+tables all over the keyspace and receives get_peers and announce_peer
+traffic for every part of it.  Queries are answered without a routing
+table or peer storage: find_node and get_peers get the most recently
+seen contacts, announce tokens are checked, nothing is stored.
+
+Every get_peers and announce_peer seen is turned into a record
+(info_hash, (ip, port), message type, timestamp) and handed to a sink.
+Repeats of the same info_hash, source ip and type are dropped while they
+are among the last maxSeen distinct ones.
+"""
+import os
+import random
+import time
+from binascii import hexlify
+from collections import OrderedDict, deque
+
+from twisted.internet import defer
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import LoopingCall
+from twisted.python.logfile import LogFile
+
+from bencode import BTFailure
+
+from krpc import KRPCCodec, decode, encodeError
+from log import Logger
+from utils import decode_nodes, encode_nodes, spread_node_ids, random_node_id, TokenManager
+from node import Node
+
+GET_PEERS = "get_peers"
+ANNOUNCE_PEER = "announce_peer"
+
+# contacts handed out in find_node and get_peers answers
+NODES_PER_ANSWER = 8
+
+
+class HarvestQueue(object):
+    """
+    A bounded queue of records.  Records put while it is full are
+    dropped and counted.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.queue = defer.DeferredQueue(size=maxsize)
+        self.dropped = 0
+
+    def put(self, record):
+        try:
+            self.queue.put(record)
+        except defer.QueueOverflow:
+            self.dropped += 1
+
+    def get(self):
+        """
+        A C{Deferred} for the next record.
+        """
+        return self.queue.get()
+
+    def __len__(self):
+        return len(self.queue.pending)
+
+
+class RollingFileSink(object):
+    """
+    Writes records as tab separated lines of timestamp, hex info_hash,
+    ip:port and message type, starting a new file every rotateLength
+    bytes and keeping at most maxRotatedFiles old ones.
+    """
+
+    def __init__(self, path, rotateLength=64 * 1024 * 1024, maxRotatedFiles=10):
+        directory, name = os.path.split(os.path.abspath(path))
+        self.file = LogFile(name, directory, rotateLength=rotateLength, maxRotatedFiles=maxRotatedFiles)
+
+    def put(self, record):
+        infoHash, (ip, port), kind, timestamp = record
+        self.file.write("%.3f\t%s\t%s:%d\t%s\n" % (timestamp, hexlify(infoHash), ip, port, kind))
+
+    def close(self):
+        self.file.close()
+
+
+class Harvester(DatagramProtocol):
+    """
+    Poses as count nodes spread over the keyspace and records the
+    info_hashes other nodes look up and announce.
+
+    To get known, it asks contacts it has learned of for nodes close to
+    one of its ids, queryRate times a second, which puts that id into
+    their routing tables and brings in more contacts.
+    """
+
+    def __init__(self, count=64, sink=None, queryRate=50, poolSize=10000, maxSeen=1000000):
+        self.ids = spread_node_ids(count)
+        self.codecs = dict((nodeId, KRPCCodec(nodeId)) for nodeId in self.ids)
+        self.sink = sink if sink is not None else HarvestQueue()
+        self.tokens = TokenManager()
+        self.queryRate = queryRate
+        # (id, ip, port) of contacts to query, most recently learned last
+        self.pool = deque(maxlen=poolSize)
+        # compact nodes of the latest contacts, rebuilt every query tick
+        self.nodes = ""
+        # (info_hash, ip, type) of recent records, oldest first
+        self.seen = OrderedDict()
+        # recently recorded info_hashes, oldest first, to count unique ones
+        self.hashes = OrderedDict()
+        self.maxSeen = maxSeen
+        self.harvested = 0
+        self.unique = 0
+        self.transactionSeq = 0
+        self.queryLoop = None
+        self.log = Logger(system=self)
+
+    def startProtocol(self):
+        self.tokens.start()
+        self.queryLoop = LoopingCall(self.query)
+        self.queryLoop.start(0.1, now=False)
+
+    def stopProtocol(self):
+        self.tokens.stop()
+        if self.queryLoop is not None and self.queryLoop.running:
+            self.queryLoop.stop()
+        self.queryLoop = None
+
+    def idFor(self, key):
+        """
+        The virtual id closest to the given 20 byte key.
+        """
+        if not isinstance(key, str) or len(key) != 20:
+            raise KeyError(key)
+        return self.ids[(long(hexlify(key), 16) * len(self.ids)) >> 160]
+
+    def bootstrap(self, addrs):
+        """
+        Introduce every virtual id to the given (ip, port) addresses.
+        """
+        for address in addrs:
+            for nodeId in self.ids:
+                self.sendFindNode(address, nodeId, nodeId)
+
+    def sendFindNode(self, address, nodeId, target):
+        self.transactionSeq = (self.transactionSeq + 1) & 0xffff
+        message = {"y": "q", "q": "find_node", "a": {"id": nodeId, "target": target}}
+        self.transport.write(self.codecs[nodeId].encodeQuery("%c%c" % divmod(self.transactionSeq, 256), message),
+                             address)
+
+    def query(self):
+        """
+        Send this tick's share of find_node queries, each from a random
+        virtual id for a target next to it, to the freshest contacts.
+        """
+        latest = [Node(nodeId, ip, port) for nodeId, ip, port in list(self.pool)[-NODES_PER_ANSWER:]]
+        self.nodes = encode_nodes(latest)
+
+        for _ in xrange(max(1, int(self.queryRate * 0.1))):
+            if not self.pool:
+                break
+            nodeId, ip, port = self.pool.pop()
+            vid = random.choice(self.ids)
+            self.sendFindNode((ip, port), vid, vid[:-2] + random_node_id()[:2])
+
+    def datagramReceived(self, datagram, address):
+        try:
+            msg = decode(datagram)
+            msgType = msg["y"]
+            if msgType == "q":
+                self._answer(msg["t"], msg["q"], msg["a"], address)
+            elif msgType == "r" and isinstance(msg["r"], dict):
+                nodes = msg["r"].get("nodes")
+                if isinstance(nodes, str):
+                    self.pool.extend((nodeId, ip, port) for nodeId, ip, port in decode_nodes(nodes))
+        except (KeyError, TypeError, BTFailure):
+            pass
+
+    def _answer(self, msgID, method, args, address):
+        ip, port = address
+        sender = args["id"]
+        if isinstance(sender, str) and len(sender) == 20:
+            self.pool.append((sender, ip, port))
+
+        if method == GET_PEERS:
+            infoHash = args["info_hash"]
+            nodeId = self.idFor(infoHash)
+            self.record(infoHash, address, GET_PEERS)
+            response = {"y": "r", "r": {"id": nodeId, "token": self.tokens.generate(ip, port), "nodes": self.nodes}}
+        elif method == ANNOUNCE_PEER:
+            infoHash = args["info_hash"]
+            if not self.tokens.verify(ip, port, args["token"]):
+                self.transport.write(encodeError(msgID, 203, "Protocol Error, bad token"), address)
+                return
+            nodeId = self.idFor(infoHash)
+            self.record(infoHash, address, ANNOUNCE_PEER)
+            response = {"y": "r", "r": {"id": nodeId}}
+        elif method == "find_node":
+            nodeId = self.idFor(args["target"])
+            response = {"y": "r", "r": {"id": nodeId, "nodes": self.nodes}}
+        elif method == "ping":
+            nodeId = self.idFor(sender)
+            response = {"y": "r", "r": {"id": nodeId}}
+        else:
+            self.transport.write(encodeError(msgID, 204, "Method Unknown"), address)
+            return
+
+        self.transport.write(self.codecs[nodeId].encodeResponse(msgID, response), address)
+
+    def record(self, infoHash, address, kind):
+        key = (infoHash, address[0], kind)
+        if key in self.seen:
+            return
+        self.seen[key] = True
+        if len(self.seen) > self.maxSeen:
+            self.seen.popitem(last=False)
+
+        if infoHash not in self.hashes:
+            self.unique += 1
+            self.hashes[infoHash] = True
+            if len(self.hashes) > self.maxSeen:
+                self.hashes.popitem(last=False)
+
+        self.harvested += 1
+        self.sink.put((infoHash, address, kind, time.time()))
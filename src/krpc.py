@@ -0,0 +1,284 @@
+"""
+Bencode codec specialised for KRPC messages.
+
+Decoding walks the datagram by offset and only builds objects for the keys
+KRPC actually uses; everything else is skipped in place.  Encoding splices
+the transaction id and variable fields into byte templates prepared once
+per node id.
+"""
+from bencode import BTFailure
+
+MAX_DATAGRAM_SIZE = 4096
+MAX_DEPTH = 4
+
+# top level keys of a KRPC message, including BEP 42 "ip" and BEP 43 "ro"
+MESSAGE_KEYS = frozenset(["t", "y", "q", "a", "r", "e", "v", "ip", "ro"])
+
+# keys of the "a" and "r" dictionaries used by BEP 5 (plus "nodes6" and
+# "want" from BEP 32)
+ARGUMENT_KEYS = frozenset(["id", "target", "info_hash", "port", "implied_port", "token",
+                           "nodes", "nodes6", "values", "want", "name"])
+
+
+class DecodeError(BTFailure):
+    """
+    The datagram is not a well formed KRPC message.
+    """
+
+
+_DIGITS = dict((str(i), i) for i in range(10))
+
+
+def _stringBounds(x, f):
+    """
+    Get the (start, end) offsets of the string whose length prefix starts at
+    offset f.  One and two digit lengths, which cover nearly every KRPC
+    string, are read without searching for the colon.
+    """
+    if x[f + 1] == ':':
+        return f + 2, f + 2 + _DIGITS[x[f]]
+    if x[f + 2] == ':':
+        return f + 3, f + 3 + _DIGITS[x[f]] * 10 + _DIGITS[x[f + 1]]
+    colon = x.index(':', f)
+    length = int(x[f:colon])
+    if length < 0:
+        raise DecodeError("negative string length")
+    return colon + 1, colon + 1 + length
+
+
+def _decode(x, f, depth):
+    c = x[f]
+    if c == 'i':
+        end = x.index('e', f + 1)
+        return int(x[f + 1:end]), end + 1
+    if c in _DIGITS:
+        start, end = _stringBounds(x, f)
+        return x[start:end], end
+    if depth >= MAX_DEPTH:
+        raise DecodeError("nested too deeply")
+    if c == 'l':
+        r, f = [], f + 1
+        while x[f] != 'e':
+            v, f = _decode(x, f, depth + 1)
+            r.append(v)
+        return r, f + 1
+    if c == 'd':
+        r, f = {}, f + 1
+        while x[f] != 'e':
+            start, f = _stringBounds(x, f)
+            r[x[start:f]], f = _decode(x, f, depth + 1)
+        return r, f + 1
+    raise DecodeError("unexpected %r at offset %d" % (c, f))
+
+
+def _skip(x, f, depth):
+    c = x[f]
+    if c == 'i':
+        return x.index('e', f + 1) + 1
+    if c in _DIGITS:
+        return _stringBounds(x, f)[1]
+    if depth >= MAX_DEPTH:
+        raise DecodeError("nested too deeply")
+    if c == 'l':
+        f += 1
+        while x[f] != 'e':
+            f = _skip(x, f, depth + 1)
+        return f + 1
+    if c == 'd':
+        f += 1
+        while x[f] != 'e':
+            f = _skip(x, _stringBounds(x, f)[1], depth + 1)
+        return f + 1
+    raise DecodeError("unexpected %r at offset %d" % (c, f))
+
+
+def _decodeMessage(x, f, keys, depth):
+    """
+    Decode the dictionary starting at offset f, keeping only the given keys.
+    Strings, integers and lists of strings are parsed inline, the "a" and
+    "r" dictionaries recurse with L{ARGUMENT_KEYS}, and anything else falls
+    back to the generic decoder.
+    """
+    r, f = {}, f + 1
+    while x[f] != 'e':
+        if x[f + 1] == ':':
+            start = f + 2
+            f = start + _DIGITS[x[f]]
+        else:
+            start, f = _stringBounds(x, f)
+        k = x[start:f]
+        c = x[f]
+
+        if k not in keys:
+            f = _skip(x, f, depth + 1)
+        elif c in _DIGITS:
+            if x[f + 1] == ':':
+                start = f + 2
+                f = start + _DIGITS[c]
+            else:
+                start, f = _stringBounds(x, f)
+            r[k] = x[start:f]
+        elif c == 'i':
+            end = x.index('e', f + 1)
+            r[k] = int(x[f + 1:end])
+            f = end + 1
+        elif c == 'd' and depth == 0 and (k == "a" or k == "r"):
+            r[k], f = _decodeMessage(x, f, ARGUMENT_KEYS, 1)
+        elif c == 'l':
+            listStart = f
+            values, f = [], f + 1
+            while x[f] in _DIGITS:
+                start, f = _stringBounds(x, f)
+                values.append(x[start:f])
+            if x[f] == 'e':
+                r[k] = values
+                f += 1
+            else:
+                # not a plain list of strings, decode it from the start again
+                r[k], f = _decode(x, listStart, depth + 1)
+        else:
+            r[k], f = _decode(x, f, depth + 1)
+    return r, f + 1
+
+
+def decode(datagram):
+    """
+    Decode a KRPC datagram into a C{dict}.
+
+    Only the keys listed in L{MESSAGE_KEYS} are kept, and within the "a" and
+    "r" dictionaries only those in L{ARGUMENT_KEYS}.  Raises L{DecodeError}
+    for oversized, truncated or otherwise malformed datagrams.
+
+    The datagram is walked by offset; the only substrings built are the
+    keys and values that end up in the result.
+    """
+    if len(datagram) > MAX_DATAGRAM_SIZE:
+        raise DecodeError("datagram of %d bytes is too large" % len(datagram))
+    if datagram[:1] != 'd':
+        raise DecodeError("datagram is not a dictionary")
+
+    try:
+        msg, f = _decodeMessage(datagram, 0, MESSAGE_KEYS, 0)
+    except (IndexError, KeyError, ValueError):
+        raise DecodeError("truncated or malformed datagram")
+
+    if f != len(datagram):
+        raise DecodeError("trailing data after message")
+    return msg
+
+
+def _encodeString(s, r):
+    r.append(str(len(s)))
+    r.append(':')
+    r.append(s)
+
+
+def _encode(x, r):
+    if isinstance(x, str):
+        _encodeString(x, r)
+    elif isinstance(x, (int, long)):
+        r.extend(('i', str(x), 'e'))
+    elif isinstance(x, (list, tuple)):
+        r.append('l')
+        for v in x:
+            _encode(v, r)
+        r.append('e')
+    elif isinstance(x, dict):
+        r.append('d')
+        for k in sorted(x):
+            _encodeString(k, r)
+            _encode(x[k], r)
+        r.append('e')
+    else:
+        raise TypeError("cannot bencode %r" % type(x))
+
+
+def encode(x):
+    """
+    Bencode a KRPC message.
+    """
+    r = []
+    _encode(x, r)
+    return ''.join(r)
+
+
+class KRPCCodec(object):
+    """
+    Encoder for messages sent on behalf of a single node id.
+
+    Queries and responses from this node always carry its id as the first
+    key of the "a" or "r" dictionary, so that part is encoded once and the
+    remaining arguments and the transaction id are spliced in around it.
+    """
+
+    def __init__(self, nodeId):
+        self.nodeId = nodeId
+        idField = "2:id" + encode(nodeId)
+        self.queryPrefix = "d1:ad" + idField
+        self.responsePrefix = "d1:rd" + idField
+        # {"y": "r", "r": {"id": nodeId}} minus the transaction id, which
+        # sits between the two halves
+        self.ackPrefix = self.responsePrefix + "e1:t"
+        self.responseSuffix = "1:y1:re"
+        self.querySuffix = "1:y1:qe"
+
+    def _encodeArguments(self, args, r):
+        for k in sorted(args):
+            if k != "id":
+                _encodeString(k, r)
+                _encode(args[k], r)
+
+    def encodeAck(self, msgID):
+        """
+        Encode the bare {"id": nodeId} response used by ping and
+        announce_peer.
+        """
+        return "%s%d:%s%s" % (self.ackPrefix, len(msgID), msgID, self.responseSuffix)
+
+    def encodeQuery(self, msgID, message):
+        """
+        Encode a {"y": "q", "q": ..., "a": {...}} message.
+        """
+        args = message["a"]
+        if message.get("y") != "q" or args.get("id") != self.nodeId or len(message) != 3:
+            message["t"] = msgID
+            return encode(message)
+
+        r = [self.queryPrefix]
+        self._encodeArguments(args, r)
+        r.append("e1:q")
+        _encodeString(message["q"], r)
+        r.append("1:t")
+        _encodeString(msgID, r)
+        r.append(self.querySuffix)
+        return ''.join(r)
+
+    def encodeResponse(self, msgID, message):
+        """
+        Encode a response or error message returned by an rpc_* method.
+        """
+        args = message.get("r")
+        if message.get("y") != "r" or args is None or args.get("id") != self.nodeId or len(message) != 2:
+            message["t"] = msgID
+            return encode(message)
+
+        if len(args) == 1:
+            return self.encodeAck(msgID)
+
+        r = [self.responsePrefix]
+        self._encodeArguments(args, r)
+        r.append("e1:t")
+        _encodeString(msgID, r)
+        r.append(self.responseSuffix)
+        return ''.join(r)
+
+
+def encodeError(msgID, code, message):
+    """
+    Encode a KRPC error.  msgID may be None when the transaction id of the
+    offending datagram couldn't be read.
+    """
+    error = "d1:eli%de%d:%se" % (code, len(message), message)
+    if msgID is None:
+        return error + "1:y1:ee"
+    return "%s1:t%d:%s1:y1:ee" % (error, len(msgID), msgID)
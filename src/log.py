@@ -6,6 +6,55 @@ DEBUG = 4
 WARNING = 3
 ERROR = 2
 CRITICAL = 1
+OFF = 0
+
+# the most verbose level anything is emitted at, and a counter bumped on
+# every change so Loggers know to refresh their cached copy
+_level = INFO
+_generation = 0
+
+
+def set_level(level):
+    """
+    Emit messages up to level (e.g. WARNING drops info and debug, OFF drops
+    everything) from every L{Logger}.  Messages above it are discarded
+    before they are formatted.
+    """
+    global _level, _generation
+    _level = level
+    _generation += 1
+
+
+def get_level():
+    return _level
+
+
+def start_logging(f=None, level=WARNING, setStdout=False):
+    """
+    Log to f (stdout by default) with a L{FileLogObserver}, keeping only
+    messages up to level.
+    """
+    set_level(level)
+    log.startLoggingWithObserver(FileLogObserver(f, level).emit, setStdout=setStdout)
+
+
+class lazy(object):
+    """
+    A log argument computed only if the message is actually formatted::
+
+        self.log.info("crawling with nearest: %s", lazy(tuple, self.nearest))
+    """
+    __slots__ = ('f', 'args')
+
+    def __init__(self, f, *args):
+        self.f = f
+        self.args = args
+
+    def __str__(self):
+        return str(self.f(*self.args))
+
+    def __repr__(self):
+        return repr(self.f(*self.args))
 
 
 class FileLogObserver(log.FileLogObserver):
@@ -14,7 +63,6 @@ class FileLogObserver(log.FileLogObserver):
         self.level = level
         self.default = default
 
-
     def emit(self, eventDict):
         ll = eventDict.get('loglevel', self.default)
         if eventDict['isError'] or 'failure' in eventDict or self.level >= ll:
@@ -22,34 +70,64 @@ class FileLogObserver(log.FileLogObserver):
 
 
 class Logger:
+    """
+    Logs with a fixed set of keyword arguments, e.g. system.
+
+    info(), debug() and the others take a message and optional arguments
+    to format it with, as in C{message % args}.  They check the level
+    first, against a cached copy of the one set with L{set_level}, so
+    below it a call costs an attribute lookup and two comparisons; use
+    L{lazy} for arguments that are expensive to compute.
+    """
+
     def __init__(self, **kwargs):
+        if 'system' in kwargs and not isinstance(kwargs['system'], str):
+            kwargs['system'] = kwargs['system'].__class__.__name__
         self.kwargs = kwargs
+        self.level = _level
+        self.generation = _generation
+
+    def enabled(self, level):
+        """
+        Whether messages at level are emitted.
+        """
+        if self.generation != _generation:
+            self.level = _level
+            self.generation = _generation
+        return level <= self.level
 
     def msg(self, message, **kw):
-        kw.update(self.kwargs)
-        if 'system' in kw and not isinstance(kw['system'], str):
-            kw['system'] = kw['system'].__class__.__name__
-        log.msg(message, **kw)
-
-    def info(self, message, **kw):
-        kw['loglevel'] = INFO
-        self.msg("[INFO] %s" % message, **kw)
-
-    def debug(self, message, **kw):
-        kw['loglevel'] = DEBUG
-        self.msg("[DEBUG] %s" % message, **kw)
-
-    def warning(self, message, **kw):
-        kw['loglevel'] = WARNING
-        self.msg("[WARNING] %s" % message, **kw)
-
-    def error(self, message, **kw):
-        kw['loglevel'] = ERROR
-        self.msg("[ERROR] %s" % message, **kw)
-
-    def critical(self, message, **kw):
-        kw['loglevel'] = CRITICAL
-        self.msg("[CRITICAL] %s" % message, **kw)
+        if kw:
+            kw.update(self.kwargs)
+            log.msg(message, **kw)
+        else:
+            log.msg(message, **self.kwargs)
+
+    def _emit(self, level, prefix, message, args, kw):
+        if args:
+            message = message % args
+        kw['loglevel'] = level
+        self.msg(prefix + message, **kw)
+
+    def info(self, message, *args, **kw):
+        if self.enabled(INFO):
+            self._emit(INFO, "[INFO] ", message, args, kw)
+
+    def debug(self, message, *args, **kw):
+        if self.enabled(DEBUG):
+            self._emit(DEBUG, "[DEBUG] ", message, args, kw)
+
+    def warning(self, message, *args, **kw):
+        if self.enabled(WARNING):
+            self._emit(WARNING, "[WARNING] ", message, args, kw)
+
+    def error(self, message, *args, **kw):
+        if self.enabled(ERROR):
+            self._emit(ERROR, "[ERROR] ", message, args, kw)
+
+    def critical(self, message, *args, **kw):
+        if self.enabled(CRITICAL):
+            self._emit(CRITICAL, "[CRITICAL] ", message, args, kw)
 
 try:
     theLogger
@@ -0,0 +1,266 @@
+"""
+Counters, histograms and gauges for a running node.
+
+A L{MetricsRegistry} holds metric families by name, each with one child
+per combination of label values.  Children are created up front for the
+label values known in advance, so updating one on the hot path is a dict
+lookup and an integer add.  Gauges are functions read at export time.
+
+L{DHTMetrics} is the registry every L{KademliaProtocol} keeps: RPCs in
+and out by method and outcome, round-trip times, and lookups.  Read it
+with snapshot() or prometheus(), or over HTTP with L{MetricsResource}.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import product
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# the queries we send and answer; anything else is counted as OTHER
+METHODS = ("ping", "find_node", "get_peers", "announce_peer")
+OTHER = "other"
+
+# what became of a query we received
+ANSWERED = "answered"
+ERROR = "error"
+THROTTLED = "throttled"
+INBOUND_OUTCOMES = (ANSWERED, ERROR, THROTTLED)
+
+# what became of a query we sent
+OK = "ok"
+TIMEOUT = "timeout"
+DROPPED = "dropped"
+OUTBOUND_OUTCOMES = (OK, TIMEOUT, DROPPED)
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LOOKUP_MESSAGE_BUCKETS = (4, 8, 16, 32, 64, 128, 256, 512)
+LOOKUP_DURATION_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LOOKUP_HOP_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10)
+LOOKUP_KINDS = ("find_node", "get_peers")
+
+
+class Counter(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram(object):
+    """
+    Counts observations into buckets with the given upper bounds, plus
+    one for everything above the last bound.
+    """
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @property
+    def value(self):
+        buckets = OrderedDict()
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            buckets[bound] = total
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class Gauge(object):
+    __slots__ = ("f",)
+
+    def __init__(self, f):
+        self.f = f
+
+    @property
+    def value(self):
+        return self.f()
+
+
+class Family(object):
+    """
+    All the metrics of one name, by tuple of label values.
+    """
+
+    def __init__(self, name, kind, help, labelNames, factory):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.factory = factory
+        self.children = OrderedDict()
+
+    def labels(self, *values):
+        """
+        The child for the given label values, created if needed.
+        """
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.families = OrderedDict()
+
+    def _family(self, name, kind, help, labelNames, factory, labelValues):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(name, kind, help, labelNames, factory)
+        if labelValues is not None:
+            for values in product(*labelValues):
+                family.labels(*values)
+        return family
+
+    def counter(self, name, help, labelNames=(), labelValues=()):
+        """
+        A counter family, with a child for every combination of the given
+        label values.
+        """
+        return self._family(name, COUNTER, help, labelNames, Counter, labelValues)
+
+    def histogram(self, name, help, bounds, labelNames=(), labelValues=()):
+        return self._family(name, HISTOGRAM, help, labelNames, lambda: Histogram(bounds), labelValues)
+
+    def gauge(self, name, help, f, labelNames=(), labels=()):
+        """
+        Report f() as the value of name with the given label values.
+        """
+        family = self._family(name, GAUGE, help, labelNames, None, None)
+        family.children[tuple(labels)] = Gauge(f)
+        return family
+
+    def snapshot(self):
+        """
+        A dict of metric name to value, or for labelled metrics to a dict
+        of label values to value.  Histogram values are dicts of
+        cumulative buckets, sum and count.
+        """
+        snapshot = {}
+        for name, family in self.families.iteritems():
+            if not family.labelNames:
+                snapshot[name] = family.labels().value
+            else:
+                snapshot[name] = dict((values, child.value) for values, child in family.children.iteritems())
+        return snapshot
+
+    def prometheus(self):
+        """
+        Every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, family in self.families.iteritems():
+            lines.append("# HELP %s %s" % (name, family.help))
+            lines.append("# TYPE %s %s" % (name, family.kind))
+            for values, child in family.children.iteritems():
+                labels = zip(family.labelNames, values)
+                if family.kind != HISTOGRAM:
+                    lines.append("%s%s %s" % (name, _formatLabels(labels), _formatValue(child.value)))
+                    continue
+                value = child.value
+                for bound, count in value["buckets"].iteritems():
+                    lines.append("%s_bucket%s %d" % (name, _formatLabels(labels + [("le", bound)]), count))
+                lines.append("%s_sum%s %s" % (name, _formatLabels(labels), _formatValue(value["sum"])))
+                lines.append("%s_count%s %d" % (name, _formatLabels(labels), value["count"]))
+        return "\n".join(lines) + "\n"
+
+
+def _formatValue(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ""
+    pairs = ['%s="%s"' % (name, _formatValue(value).replace("\\", "\\\\").replace('"', '\\"'))
+             for name, value in labels]
+    return "{%s}" % ",".join(pairs)
+
+
+class DHTMetrics(MetricsRegistry):
+    """
+    The metrics of one node.  RPCs and lookups are reported through the
+    methods below; the protocol adds gauges for its queues, routing table
+    and storage.
+    """
+
+    def __init__(self):
+        MetricsRegistry.__init__(self)
+        methods = METHODS + (OTHER,)
+        inbound = self.counter("dht_rpc_received_total", "Queries received, by method and outcome",
+                               ("method", "outcome"), (methods, INBOUND_OUTCOMES))
+        outbound = self.counter("dht_rpc_sent_total", "Queries sent, by method and outcome",
+                                ("method", "outcome"), (methods, OUTBOUND_OUTCOMES))
+        latency = self.histogram("dht_rpc_latency_seconds", "Round-trip time of answered queries",
+                                 LATENCY_BUCKETS, ("method",), (methods,))
+        messages = self.histogram("dht_lookup_messages", "Queries sent per lookup",
+                                  LOOKUP_MESSAGE_BUCKETS, ("kind",), (LOOKUP_KINDS,))
+        hops = self.histogram("dht_lookup_hops", "Longest chain of referrals that was answered, per lookup",
+                              LOOKUP_HOP_BUCKETS, ("kind",), (LOOKUP_KINDS,))
+        durations = self.histogram("dht_lookup_duration_seconds", "Time from start to result of a lookup",
+                                   LOOKUP_DURATION_BUCKETS, ("kind",), (LOOKUP_KINDS,))
+
+        # method -> outcome -> child, so updates don't build label tuples
+        self.inbound = dict((m, dict((o, inbound.labels(m, o)) for o in INBOUND_OUTCOMES)) for m in methods)
+        self.outbound = dict((m, dict((o, outbound.labels(m, o)) for o in OUTBOUND_OUTCOMES)) for m in methods)
+        self.latency = dict((m, latency.labels(m)) for m in methods)
+        self.lookupMessages = dict((kind, messages.labels(kind)) for kind in LOOKUP_KINDS)
+        self.lookupDurations = dict((kind, durations.labels(kind)) for kind in LOOKUP_KINDS)
+        self.lookupHops = dict((kind, hops.labels(kind)) for kind in LOOKUP_KINDS)
+
+    def queryReceived(self, method, outcome):
+        self.inbound.get(method, self.inbound[OTHER])[outcome].value += 1
+
+    def queryFinished(self, method, outcome, rtt=None):
+        """
+        Count a query we sent, and record its round-trip time if it was
+        answered.
+        """
+        self.outbound.get(method, self.outbound[OTHER])[outcome].value += 1
+        if rtt is not None:
+            self.latency.get(method, self.latency[OTHER]).observe(rtt)
+
+    def lookupFinished(self, kind, messages, duration, hops):
+        self.lookupMessages[kind].observe(messages)
+        self.lookupDurations[kind].observe(duration)
+        self.lookupHops[kind].observe(hops)
+
+
+try:
+    from twisted.web.resource import Resource
+except ImportError:
+    # twisted.web is optional; without it there's just no HTTP endpoint
+    Resource = object
+
+
+class MetricsResource(Resource):
+    """
+    Serves a registry in Prometheus text format.
+    """
+    isLeaf = True
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        return self.registry.prometheus()
@@ -3,17 +3,204 @@ Package for interacting on the network at a high level.
 """
 import binascii
 import pickle
+import time
+from collections import OrderedDict, deque
 
 from twisted.internet.task import LoopingCall
 from twisted.internet import defer, reactor, task
+from twisted.python import failure, log
 
-from log import Logger
+import mmsg
+from log import Logger, lazy
 from protocol import KademliaProtocol
-from utils import deferred_dict, generate_node_id
-from storage import ForgetfulStorage
+from utils import deferred_dict, generate_node_id, is_node_id
+from storage import PeerStorage
 from node import Node
 from crawling import ValueSpiderCrawl
 from crawling import NodeSpiderCrawl
+from crawling import ROUNDS
+from egress import LOOKUP, MAINTENANCE
+from refresh import RefreshScheduler
+from snapshot import ContactVerifier, read_snapshot, write_snapshot
+
+
+class LookupCache(object):
+    """
+    Coalesces concurrent lookups of the same key and remembers their results.
+
+    While a lookup for a key is running, every other request for that key
+    waits on it instead of starting its own.  Found results are kept for
+    ttl seconds in an LRU of at most maxKeys entries; lookups that found
+    nothing or failed are not cached.
+    """
+
+    def __init__(self, ttl=60, maxKeys=1024, clock=reactor):
+        self.ttl = ttl
+        self.clock = clock
+        self.maxKeys = maxKeys
+        # key -> (expires, result), least recently used first
+        self.results = OrderedDict()
+        # key -> [Deferred] of callers waiting on the running lookup
+        self.waiting = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key):
+        """
+        The cached result for key, or C{None} if there is none or it expired.
+        """
+        entry = self.results.pop(key, None)
+        if entry is None:
+            return None
+        if entry[0] <= self.clock.seconds():
+            return None
+        self.results[key] = entry
+        return entry[1]
+
+    def put(self, key, result):
+        self.results.pop(key, None)
+        self.results[key] = (self.clock.seconds() + self.ttl, result)
+        while len(self.results) > self.maxKeys:
+            self.results.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        Forget the cached result for key, or every cached result if key is
+        C{None}.  Lookups already running are not affected.
+        """
+        if key is None:
+            self.results.clear()
+        else:
+            self.results.pop(key, None)
+
+    def lookup(self, key, f, *args, **kwargs):
+        """
+        Get the result for key, calling f(*args, **kwargs) for a Deferred of
+        it only if it is neither cached nor already being looked up.
+
+        Every caller gets its own Deferred and its own copy of the result.
+        """
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return defer.succeed(list(result))
+
+        d = defer.Deferred()
+        if key in self.waiting:
+            self.coalesced += 1
+            self.waiting[key].append(d)
+            return d
+
+        self.misses += 1
+        self.waiting[key] = [d]
+        defer.maybeDeferred(f, *args, **kwargs).addCallbacks(self._finished, self._failed,
+                                                             callbackArgs=(key,), errbackArgs=(key,))
+        return d
+
+    def _finished(self, result, key):
+        if result is not None:
+            self.put(key, result)
+        for d in self.waiting.pop(key):
+            d.callback(list(result) if result is not None else None)
+
+    def _failed(self, failure, key):
+        for d in self.waiting.pop(key):
+            d.errback(failure)
+
+
+class BulkPeerLookup(object):
+    """
+    Looks up peers for many info_hashes under one budget of in-flight RPCs.
+
+    At most maxInflight get_peers queries are outstanding at any time, shared
+    by all crawls, and about maxInflight / alpha crawls run at once so that
+    queries rarely wait for the budget.  A node is asked about a key at most
+    once.  Lookups go through the server's :class:`LookupCache`, so cached
+    and concurrently running lookups are reused too.
+    """
+
+    def __init__(self, server, infoHashes, maxInflight=64, onResult=None):
+        """
+        Args:
+            server: The :class:`Server` to look up from
+            infoHashes: An iterable of 20 byte keys; duplicates are looked up once
+            maxInflight (int): The most get_peers queries outstanding at once
+            onResult: Called with (info_hash, peers) as each lookup finishes,
+                      peers being :class:`None` if nothing was found
+        """
+        self.server = server
+        self.onResult = onResult
+        self.queue = deque(OrderedDict.fromkeys(infoHashes))
+        self.total = len(self.queue)
+        self.maxLookups = max(1, maxInflight // server.alpha)
+        self.rpcs = defer.DeferredSemaphore(maxInflight)
+        self.results = {}
+        self.running = 0
+        self.scheduling = False
+        self.messages = 0
+        self.found = 0
+        self.started = None
+        self.elapsed = None
+        self.deferred = defer.Deferred()
+        self.log = Logger(system=self)
+
+    def start(self):
+        """
+        Start looking up.  Returns a C{Deferred} that fires with this
+        lookup once every key is done.
+        """
+        self.started = time.time()
+        self._next()
+        return self.deferred
+
+    def lookupsPerSecond(self):
+        return self.total / self.elapsed if self.elapsed else 0.0
+
+    def messagesPerLookup(self):
+        return self.messages / float(self.total) if self.total else 0.0
+
+    def _next(self):
+        # cached lookups finish synchronously; loop instead of recursing
+        if self.scheduling:
+            return
+        self.scheduling = True
+        while self.queue and self.running < self.maxLookups:
+            key = self.queue.popleft()
+            self.running += 1
+            self._lookup(key).addBoth(self._done, key)
+        self.scheduling = False
+
+        if not self.running and not self.queue and not self.deferred.called:
+            self.elapsed = time.time() - self.started
+            self.log.info("looked up %d keys in %.1fs: %.1f lookups/s, %.1f messages/lookup, %d found",
+                          self.total, self.elapsed, self.lookupsPerSecond(), self.messagesPerLookup(), self.found)
+            self.deferred.callback(self)
+
+    def _lookup(self, key):
+        peers = self.server.storage.get(key)
+        if peers is not None:
+            return defer.succeed(peers)
+        return self.server.lookups.lookup(key, self.server._lookup_peers, key, callGetPeers=self._callGetPeers)
+
+    def _callGetPeers(self, nodeToAsk, key, priority=LOOKUP):
+        self.messages += 1
+        return self.rpcs.run(self.server.protocol.callGetPeers, nodeToAsk, key, priority)
+
+    def _done(self, peers, key):
+        self.running -= 1
+        if isinstance(peers, failure.Failure):
+            self.log.error("lookup of %s failed: %s", lazy(binascii.hexlify, key), peers.getErrorMessage())
+            peers = None
+        self.results[key] = peers
+        if peers:
+            self.found += 1
+        if self.onResult is not None:
+            try:
+                self.onResult(key, peers)
+            except:
+                log.err(None, "onResult for %s failed" % binascii.hexlify(key))
+        self._next()
 
 
 class Server(object):
@@ -22,7 +209,9 @@ class Server(object):
     to start listening as an active node on the network.
     """
 
-    def __init__(self, ksize=20, alpha=3, id=None, storage=None):
+    def __init__(self, ksize=20, alpha=3, id=None, storage=None, throttle=None, lookupMode=ROUNDS,
+                 lookupCacheTTL=60, lookupCacheSize=1024, refreshInterval=3600, maxRefreshing=2,
+                 republishInterval=15 * 60, sendRate=None, sendPacketRate=None):
         """
         Create a server instance.  This will start listening on the given port.
 
@@ -31,16 +220,37 @@ class Server(object):
             alpha (int): The alpha parameter from the paper
             id: The id for this node on the network.
             storage: An instance that implements :interface:`~kademlia.storage.IStorage`
+            throttle: An :class:`~throttle.InboundThrottle` limiting inbound traffic
+            lookupMode: The :mod:`~crawling` lookup engine, ``ROUNDS`` or ``SLOTS``
+            lookupCacheTTL (int): Seconds to remember peers found by :meth:`get_peers`
+            lookupCacheSize (int): The most info_hashes to remember peers for
+            refreshInterval (int): Seconds without a lookup or contact after which a
+                                   bucket is refreshed (see :class:`~refresh.RefreshScheduler`)
+            maxRefreshing (int): The most bucket refreshes running at once
+            republishInterval (int): Seconds between re-announces of our own torrents
+            sendRate (int): The most bytes per second to send, or :class:`None` for no cap
+            sendPacketRate (int): The most datagrams per second to send, or :class:`None`
+                                  for no cap.  Beyond either cap, answers to other nodes go
+                                  out first, then lookups, then background maintenance
+                                  (see :class:`~egress.EgressQueue`)
         """
         self.ksize = ksize
         self.alpha = alpha
+        self.lookupMode = lookupMode
         self.log = Logger(system=self)
-        self.storage = storage or ForgetfulStorage(ttl=30 * 60)
+        self.storage = storage or PeerStorage(ttl=30 * 60)
         self.node = Node(id or generate_node_id())
-        self.protocol = KademliaProtocol(self.node, self.storage, ksize)
-        self.refreshLoop = LoopingCall(self.refresh_table).start(3600)
-
-    def listen(self, port, interface=""):
+        self.protocol = KademliaProtocol(self.node, self.storage, ksize, throttle,
+                                         sendRate=sendRate, sendPacketRate=sendPacketRate)
+        self.lookups = LookupCache(lookupCacheTTL, lookupCacheSize)
+        # info_hash -> port of every torrent we announced
+        self.announced = {}
+        self.refresher = RefreshScheduler(self, refreshInterval, maxRunning=maxRefreshing)
+        self.refresher.start()
+        self.republishLoop = LoopingCall(self.republish)
+        self.republishLoop.start(republishInterval, now=False)
+
+    def listen(self, port, interface="", batched=False):
         """
         Start listening on the given port.
 
@@ -48,30 +258,45 @@ class Server(object):
 
             reactor.listenUDP(port, server.protocol)
 
-        Provide interface="::" to accept ipv6 address
+        Provide interface="::" to accept ipv6 address.  With batched=True
+        datagrams are read and written with recvmmsg/sendmmsg, see
+        L{mmsg.MMsgPort}; where those aren't available this makes no
+        difference.
         """
+        if batched:
+            return mmsg.listen(port, self.protocol, interface)
         return reactor.listenUDP(port, self.protocol, interface)
 
+    def serve_metrics(self, port, interface="127.0.0.1"):
+        """
+        Serve this node's metrics in Prometheus text format over HTTP on
+        the given TCP port.  Needs twisted.web.  The same numbers are in
+        ``server.protocol.metrics.snapshot()``.
+        """
+        from twisted.web.server import Site
+        from metrics import MetricsResource
+        return reactor.listenTCP(port, Site(MetricsResource(self.protocol.metrics)), interface=interface)
+
     def refresh_table(self):
         """
         Refresh buckets that haven't had any lookups in the last hour
-        (per section 2.3 of the paper).
-        """
-        ds = []
-        for id in self.protocol.getRefreshIDs():
-            node = Node(id)
-            nearest = self.protocol.router.findNeighbors(node, self.alpha)
-            spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
-            ds.append(spider.find())
+        (per section 2.3 of the paper), then re-announce our torrents.
 
-        def republishKeys(_):
-            ds = []
-            # Republish keys older than one hour
-            for dkey, value in self.storage.iteritemsOlderThan(3600):
-                ds.append(self.digest_set(dkey, value))
-            return defer.gatherResults(ds)
+        Buckets are normally refreshed one by one as they come due; this
+        queues every lonely bucket at once, still running at most
+        maxRefreshing crawls at a time.
+        """
+        return self.refresher.refreshNow().addCallback(lambda _: self.republish())
 
-        return defer.gatherResults(ds).addCallback(republishKeys)
+    def republish(self):
+        """
+        Announce every torrent we announced before again, so the peers
+        stored for us don't expire.
+        """
+        ds = []
+        for info_hash, port in self.announced.items():
+            ds.append(self._announce(info_hash, port, MAINTENANCE))
+        return defer.gatherResults(ds)
 
     def bootstrappable_neighbors(self):
         """
@@ -101,14 +326,15 @@ class Server(object):
         def init_table(results):
             nodes = []
             for addr, result in results.items():
-                if result[0]:
-                    nodes.append(Node(result[1]["id"], addr[0], addr[1]))
-            spider = NodeSpiderCrawl(self.protocol, self.node, nodes, self.ksize, self.alpha)
+                if result[0] and isinstance(result[1], dict) and is_node_id(result[1].get("id")):
+                    nodes.append(Node.intern(result[1]["id"], addr[0], addr[1]))
+            spider = NodeSpiderCrawl(self.protocol, self.node, nodes, self.ksize, self.alpha, self.lookupMode,
+                                     priority=MAINTENANCE)
             return spider.find()
 
         ds = {}
         for addr in addrs:
-            ds[addr] = self.protocol.ping(addr, self.node.id)
+            ds[addr] = self.protocol.ping(addr, self.node.id, priority=MAINTENANCE)
         return deferred_dict(ds).addCallback(init_table)
 
     def inet_visible_ip(self):
@@ -121,7 +347,7 @@ class Server(object):
 
         def handle(results):
             ips = [result[1][0] for result in results if result[0]]
-            self.log.debug("other nodes think our ip is %s" % str(ips))
+            self.log.debug("other nodes think our ip is %s", ips)
             return ips
 
         ds = []
@@ -129,33 +355,79 @@ class Server(object):
             ds.append(self.protocol.stun(neighbor))
         return defer.gatherResults(ds).addCallback(handle)
 
-    def get_peers(self, info_hash):
+    def get_peers(self, info_hash, cached=True):
         """
         Get a key if the network has it.
 
+        Concurrent calls for the same info_hash share one lookup, and found
+        peers are remembered for a while (see :class:`LookupCache`).
+
+        Args:
+            info_hash: The 20 byte key to look up
+            cached (bool): If False, skip the cache and always run a fresh
+                           lookup.  Its result still replaces the cached one.
+
         Returns:
             :class:`None` if not found, the value otherwise.
         """
         # if this node has it, return it
         if self.storage.get(info_hash) is not None:
             return defer.succeed(self.storage.get(info_hash))
+        if not cached:
+            return self._lookup_peers(info_hash).addCallback(self._cache_peers, info_hash)
+        return self.lookups.lookup(info_hash, self._lookup_peers, info_hash)
+
+    def _lookup_peers(self, info_hash, callGetPeers=None):
         node = Node(info_hash)
         nearest = self.protocol.router.findNeighbors(node)
         if len(nearest) == 0:
-            self.log.warning("There are no known neighbors to get key %s" % info_hash)
+            self.log.warning("There are no known neighbors to get key %s", info_hash)
             return defer.succeed(None)
-        spider = ValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
+        spider = ValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha, self.lookupMode,
+                                  callGetPeers=callGetPeers)
         return spider.find()
 
+    def _cache_peers(self, peers, info_hash):
+        if peers is not None:
+            self.lookups.put(info_hash, list(peers))
+        return peers
+
+    def invalidate_peers(self, info_hash=None):
+        """
+        Forget the cached peers for info_hash, or for every info_hash if
+        it is :class:`None`.
+        """
+        self.lookups.invalidate(info_hash)
+
+    def get_peers_many(self, info_hashes, max_inflight=64, onResult=None):
+        """
+        Get peers for many keys, sharing one budget of in-flight RPCs.
+
+        Args:
+            info_hashes: An iterable of 20 byte keys
+            max_inflight (int): The most get_peers queries outstanding at once
+            onResult: Called with (info_hash, peers) as each lookup finishes
+
+        Returns:
+            A `Deferred` firing with the finished :class:`BulkPeerLookup`,
+            whose ``results`` map every key to its peers or :class:`None`
+            and which reports lookupsPerSecond and messagesPerLookup.
+        """
+        return BulkPeerLookup(self, info_hashes, max_inflight, onResult).start()
+
     def announce_peer(self, info_hash, port):
         """
         Set the given key to the given value in the network.
         """
-        self.log.debug("setting '%s' = '%s' on network" % (info_hash, port))
+        self.announced[info_hash] = port
+        return self._announce(info_hash, port, LOOKUP)
+
+    def _announce(self, info_hash, port, priority):
+        self.log.debug("setting '%s' = '%s' on network", info_hash, port)
 
         key = Node(info_hash)
         # this is useful for debugging messages
-        hkey = binascii.hexlify(info_hash)
+        hkey = lazy(binascii.hexlify, info_hash)
 
         def _any_announce_respond_success(responses):
             for defer_success, result in responses:
@@ -171,7 +443,7 @@ class Server(object):
             for defer_success, result in responses:
                 peer_reached, peer_response, node = result
                 if defer_success and peer_reached and "token" in peer_response:
-                    ds.append(self.protocol.callAnnouncePeer(node, key, port, peer_response["token"]))
+                    ds.append(self.protocol.callAnnouncePeer(node, key, port, peer_response["token"], priority))
 
             if ds:
                 return defer.DeferredList(ds).addCallback(_any_announce_respond_success)
@@ -179,21 +451,18 @@ class Server(object):
                 return False
 
         def _store(nodes):
-            self.log.info("setting '%s' on %s" % (hkey, map(str, nodes)))
-            # if this node is close too, then store here as well
-            if self.node.distanceTo(key) < max([n.distanceTo(key) for n in nodes]):
-                self.storage[info_hash] = port
-
-            ds = [self.protocol.callGetPeers(n, key) for n in nodes]
+            self.log.info("setting '%s' on %s", hkey, lazy(map, str, nodes))
+            ds = [self.protocol.callGetPeers(n, key, priority) for n in nodes]
             return defer.DeferredList(ds).addCallback(_any_get_peers_respond_success)
 
         nearest = self.protocol.router.findNeighbors(key)
 
         if len(nearest) == 0:
-            self.log.warning("There are no known neighbors to set key %s" % hkey)
+            self.log.warning("There are no known neighbors to set key %s", hkey)
             return defer.succeed(False)
 
-        spider = NodeSpiderCrawl(self.protocol, key, nearest, self.ksize, self.alpha)
+        spider = NodeSpiderCrawl(self.protocol, key, nearest, self.ksize, self.alpha, self.lookupMode,
+                                 priority=priority)
         return spider.find().addCallback(_store)
 
     def save_state(self, fname):
@@ -224,6 +493,46 @@ class Server(object):
             s.bootstrap(data['neighbors'])
         return s
 
+    def save_snapshot(self, fname):
+        """
+        Save the whole routing table, with the alpha/ksize/id of this node,
+        to a binary snapshot file (see :mod:`~snapshot`).  The file is
+        replaced atomically.
+        """
+        write_snapshot(fname, self.protocol.router, self.alpha)
+
+    @staticmethod
+    def load_snapshot(fname, **kwargs):
+        """
+        Create a server from a snapshot written by :meth:`save_snapshot`.
+
+        The routing table is filled straight from the file, so the server
+        answers find_node well as soon as it listens, and its contacts are
+        pinged in the background to weed out the ones that are gone.
+        Extra keyword arguments go to the :class:`Server` constructor.
+        """
+        data = read_snapshot(fname)
+        s = Server(data['ksize'], data['alpha'], data['id'], **kwargs)
+        s.protocol.router.restore(data['buckets'])
+        s.verify_table()
+        return s
+
+    def verify_table(self, batchSize=20, interval=0.5):
+        """
+        Ping every contact in the routing table, batchSize of them every
+        interval seconds.
+
+        Returns:
+            A `Deferred` firing with the :class:`~snapshot.ContactVerifier`
+            once all of them answered or timed out.
+        """
+        # if the transport hasn't been initialized yet, wait a second
+        if self.protocol.transport is None:
+            return task.deferLater(reactor, 1, self.verify_table, batchSize, interval)
+
+        nodes = [node for bucket in self.protocol.router.buckets for node in bucket.getNodes()]
+        return ContactVerifier(self.protocol, nodes, batchSize, interval).start()
+
     def save_state_regularly(self, fname, frequency=600):
         """
         Save the state of node with a given regularity to the given
@@ -1,13 +1,37 @@
+from binascii import hexlify
+from bisect import bisect_left
 from operator import itemgetter
+from weakref import WeakValueDictionary
 import heapq
 
 
-class Node:
+class Node(object):
+    __slots__ = ('id', 'ip', 'port', 'long_id', '__weakref__')
+
+    # id -> Node for every contact that is still referenced somewhere
+    # (routing table, lookup heaps, pending RPCs)
+    _interned = WeakValueDictionary()
+
     def __init__(self, id, ip=None, port=None):
         self.id = id
         self.ip = ip
         self.port = port
-        self.long_id = long(id.encode('hex'), 16)
+        self.long_id = long(hexlify(id), 16)
+
+    @classmethod
+    def intern(cls, id, ip, port):
+        """
+        Get the shared C{Node} for the given contact, creating it only if
+        no live instance with the same id, ip and port exists yet.  Use
+        this for nodes learned from the network so the same peer is a
+        single object everywhere.  A node id seen at a new address
+        replaces the previous entry.
+        """
+        node = cls._interned.get(id)
+        if node is None or node.ip != ip or node.port != port:
+            node = cls(id, ip, port)
+            cls._interned[id] = node
+        return node
 
     def sameHomeAs(self, node):
         return self.ip == node.ip and self.port == node.port
@@ -34,6 +58,11 @@ class Node:
 class NodeHeap(object):
     """
     A heap of nodes ordered by distance to a given node.
+
+    Only the closest C{maxsize} nodes are visible.  They are kept in a
+    sorted window; farther nodes wait in an overflow heap and move into
+    the window as closer ones are removed.  Every known node is indexed
+    by id, and a cursor marks the first window entry not yet contacted.
     """
     def __init__(self, node, maxsize):
         """
@@ -43,10 +72,48 @@ class NodeHeap(object):
         @param maxsize: The maximum size that this heap can grow to.
         """
         self.node = node
-        self.heap = []
+        self.entries = {}
+        self.window = []
+        self.overflow = []
+        self.cursor = 0
         self.contacted = set()
         self.maxsize = maxsize
 
+    def _windowIndex(self, entry):
+        index = bisect_left(self.window, entry)
+        if index < len(self.window) and self.window[index] is entry:
+            return index
+        return None
+
+    def _advanceCursor(self):
+        while self.cursor < len(self.window) and self.window[self.cursor][1] in self.contacted:
+            self.cursor += 1
+
+    def _insertWindow(self, entry):
+        index = bisect_left(self.window, entry)
+        self.window.insert(index, entry)
+        if index < self.cursor:
+            self.cursor = index
+        self._advanceCursor()
+
+        if len(self.window) > self.maxsize:
+            heapq.heappush(self.overflow, self.window.pop())
+            self.cursor = min(self.cursor, len(self.window))
+
+    def _removeWindow(self, index):
+        del self.window[index]
+        if index < self.cursor:
+            self.cursor -= 1
+        self._advanceCursor()
+
+    def _refill(self):
+        while len(self.window) < self.maxsize and self.overflow:
+            entry = heapq.heappop(self.overflow)
+            # entries removed while in the overflow heap are dropped lazily
+            if self.entries.get(entry[1]) is entry:
+                self.window.append(entry)
+        self._advanceCursor()
+
     def remove(self, peerIDs):
         """
         Remove a list of peer ids from this heap.  Note that while this
@@ -55,33 +122,36 @@ class NodeHeap(object):
         removal of nodes may not change the visible size as previously added
         nodes suddenly become visible.
         """
-        peerIDs = set(peerIDs)
-        if len(peerIDs) == 0:
-            return
-        nheap = []
-        for distance, node in self.heap:
-            if node.id not in peerIDs:
-                heapq.heappush(nheap, (distance, node))
-        self.heap = nheap
+        for peerID in peerIDs:
+            entry = self.entries.pop(peerID, None)
+            if entry is None:
+                continue
+            index = self._windowIndex(entry)
+            if index is not None:
+                self._removeWindow(index)
+        self._refill()
 
     def getNodeById(self, id):
-        for _, node in self.heap:
-            if node.id == id:
-                return node
-        return None
+        entry = self.entries.get(id)
+        return entry[2] if entry is not None else None
 
     def allBeenContacted(self):
-        return len(self.getUncontacted()) == 0
+        return self.cursor >= len(self.window)
 
     def getIDs(self):
-        return [n.id for n in self]
+        return [entry[1] for entry in self.window]
 
     def markContacted(self, node):
         self.contacted.add(node.id)
+        self._advanceCursor()
 
     def popleft(self):
         if len(self) > 0:
-            return heapq.heappop(self.heap)[1]
+            entry = self.window[0]
+            del self.entries[entry[1]]
+            self._removeWindow(0)
+            self._refill()
+            return entry[2]
         return None
 
     def push(self, nodes):
@@ -94,22 +164,23 @@ class NodeHeap(object):
             nodes = [nodes]
 
         for node in nodes:
-            if node not in self:
-                distance = self.node.distanceTo(node)
-                heapq.heappush(self.heap, (distance, node))
+            if node.id in self.entries:
+                continue
+            entry = (self.node.distanceTo(node), node.id, node)
+            self.entries[node.id] = entry
+            if len(self.window) < self.maxsize or entry < self.window[-1]:
+                self._insertWindow(entry)
+            else:
+                heapq.heappush(self.overflow, entry)
 
     def __len__(self):
-        return min(len(self.heap), self.maxsize)
+        return len(self.window)
 
     def __iter__(self):
-        nodes = heapq.nsmallest(self.maxsize, self.heap)
-        return iter(map(itemgetter(1), nodes))
+        return iter(map(itemgetter(2), self.window))
 
     def __contains__(self, node):
-        for distance, n in self.heap:
-            if node.id == n.id:
-                return True
-        return False
+        return node.id in self.entries
 
     def getUncontacted(self):
-        return [n for n in self if n.id not in self.contacted]
+        return [entry[2] for entry in self.window[self.cursor:] if entry[1] not in self.contacted]
@@ -1,54 +1,117 @@
-import random
+import time
+from collections import deque
 
 from base64 import b64encode
 
 from twisted.internet import defer
-from twisted.internet import reactor
 from twisted.python import log
 
 from rpcudp.protocol import RPCProtocol
 
+from egress import EgressQueue, CLASS_NAMES, RESPONSE, LOOKUP
 from node import Node
 from routing import RoutingTable
-from log import Logger
+from log import Logger, lazy
+from metrics import DHTMetrics, ANSWERED, ERROR, THROTTLED, OK, TIMEOUT, DROPPED
+from rtt import RTTEstimator, PeerRTTs
+from storage import IPeerStorage
+from timers import TimerWheel
+from throttle import InboundThrottle, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 
 from struct import pack
 
-from bencode import bencode, bdecode, BTFailure
+from bencode import BTFailure
 
-from utils import encode_nodes, generate_token, verify_token, encode_values
+from krpc import KRPCCodec, decode, encodeError
+
+from utils import encode_nodes, encode_values, is_node_id, random_node_id, TokenManager
 
 
 class KademliaProtocol(RPCProtocol):
-    def __init__(self, sourceNode, storage, ksize):
+    def __init__(self, sourceNode, storage, ksize, throttle=None, maxOutstanding=1024, maxPending=8192,
+                 minTimeout=0.5, sendRate=None, sendPacketRate=None):
         RPCProtocol.__init__(self)
         self.router = RoutingTable(self, ksize, sourceNode)
         self.storage = storage
+        self.throttle = throttle or InboundThrottle()
         self.sourceNode = sourceNode
         self.log = Logger(system=self)
         self.transactionSeq = 0
+        self.maxOutstanding = maxOutstanding
+        self.maxPending = maxPending
+        self._pending = deque()
+        # per-node timeouts go well below _waitTimeout, so use a finer wheel
+        self.timeouts = TimerWheel(0.1)
+        # round-trip times of every answered query, for nodes we haven't timed yet
+        self.rtt = RTTEstimator()
+        # and of each node we have timed; kept here rather than on the
+        # interned Node, which every protocol in the process shares
+        self.peerRTTs = PeerRTTs()
+        self.minTimeout = minTimeout
+        self.codec = KRPCCodec(sourceNode.id)
+        # everything we send goes through here, answers first
+        self.egress = EgressQueue(self, sendRate, sendPacketRate)
+        self.tokens = TokenManager()
+        self.metrics = DHTMetrics()
+        self._addGauges()
+        # query name -> bound rpc_* method, so dispatch is a single dict hit
+        self._handlers = dict((name[4:], getattr(self, name)) for name in dir(self)
+                              if name.startswith("rpc_") and callable(getattr(self, name)))
+
+    def _addGauges(self):
+        metrics = self.metrics
+        metrics.gauge("dht_outstanding_queries", "Queries waiting for an answer", lambda: len(self._outstanding))
+        metrics.gauge("dht_pending_queries", "Queries waiting for a free slot", lambda: len(self._pending))
+        for i, name in enumerate(CLASS_NAMES):
+            metrics.gauge("dht_egress_queued", "Datagrams waiting in the egress queue",
+                          lambda i=i: len(self.egress.queues[i]), ("class",), (name,))
+        for reason in sorted(self.throttle.dropped):
+            metrics.gauge("dht_throttle_dropped", "Inbound datagrams dropped by the throttle",
+                          lambda reason=reason: self.throttle.dropped[reason], ("reason",), (reason,))
+        router = self.router
+        metrics.gauge("dht_routing_buckets", "Buckets in the routing table", lambda: len(router.buckets))
+        metrics.gauge("dht_routing_nodes", "Nodes in the routing table",
+                      lambda: sum(len(bucket) for bucket in router.buckets))
+        metrics.gauge("dht_storage_keys", "Info_hashes with stored peers", lambda: self._storageCounts()[0])
+        metrics.gauge("dht_storage_peers", "Stored peers over all info_hashes", lambda: self._storageCounts()[1])
+
+    def _storageCounts(self):
+        keys = peers = 0
+        for _, values in self.storage.iteritems():
+            keys += 1
+            peers += len(values)
+        return keys, peers
+
+    def startProtocol(self):
+        self.tokens.start()
+
+    def stopProtocol(self):
+        self.tokens.stop()
 
     def datagramReceived(self, datagram, address):
         if self.noisy:
             log.msg("received datagram from %s" % repr(address))
 
+        if not self.throttle.allowSource(address[0]):
+            return
+
         try:
-            msg = bdecode(datagram)
+            msg = decode(datagram)
             msgID = msg["t"]
             msgType = msg["y"]
 
             if msgType == "q":
-                f = getattr(self, "rpc_%s" % msg["q"], None)
-
-                if f is None or not callable(f):
-                    self.transport.write(bencode({
-                        "t": msgID,
-                        "y": "e",
-                        "e": [204, "Method Unknown"]}),
-                        address
-                    )
+                method = msg["q"]
+                f = self._handlers.get(method)
+
+                if f is None:
+                    self.metrics.queryReceived(method, ERROR)
+                    self.egress.write(encodeError(msgID, 204, "Method Unknown"), address)
+                elif (self.throttle.maxQueryRate is None or
+                      self.throttle.allowQuery(self._queryPriority(method, msg["a"]))):
+                    self._acceptQuery(f, method, msgID, msg["a"], address)
                 else:
-                    self._acceptRequest(msgID, [msg["q"], [msg["a"]]], address)
+                    self.metrics.queryReceived(method, THROTTLED)
 
             elif msgType == "r":
                 self._acceptResponse(msgID, msg["r"], address)
@@ -60,61 +123,154 @@ class KademliaProtocol(RPCProtocol):
                 # otherwise, don't know the format, don't do anything
                 log.msg("Received unknown message from %s, ignoring" % repr(address))
 
-                self.transport.write(bencode({
-                    "t": msgID,
-                    "y": "e",
-                    "e": [203, "Protocol Error, invalid arguments"]}),
-                    address
-                )
+                self.egress.write(encodeError(msgID, 203, "Protocol Error, invalid arguments"), address)
 
-        except KeyError:
+        except (KeyError, TypeError):
             log.msg("Invalid message data from %s, ignoring" % repr(address))
 
-            self.transport.write(bencode({
-                "y": "e",
-                "e": [201, "Generic Error"]}),
-                address
-            )
+            self.egress.write(encodeError(None, 201, "Generic Error"), address)
 
         except BTFailure:
             log.msg("Not a valid bencoded string from %s, ignoring" % repr(address))
 
-            self.transport.write(bencode({
-                "y": "e",
-                "e": [203, "Protocol Error, malformed packet"]}),
-                address
-            )
+            self.egress.write(encodeError(None, 203, "Protocol Error, malformed packet"), address)
+
+    def _queryPriority(self, method, args):
+        """
+        Pings are cheap and keep us in other nodes' tables, so they are never
+        shed; find_node from nodes we don't know goes first.
+        """
+        if method == "ping":
+            return PRIORITY_HIGH
+        if method == "find_node" and not (isinstance(args, dict) and self.router.isKnownId(args.get("id"))):
+            return PRIORITY_LOW
+        return PRIORITY_NORMAL
+
+    def _acceptQuery(self, f, method, msgID, args, address):
+        response = f(address, args)
+        if isinstance(response, defer.Deferred):
+            response.addCallback(self._sendResponse, method, msgID, address)
+        else:
+            self._sendResponse(response, method, msgID, address)
 
-    def _sendResponse(self, response, msgID, address):
+    def _sendResponse(self, response, method, msgID, address):
+        self.metrics.queryReceived(method, ANSWERED if response.get("y") == "r" else ERROR)
         if self.noisy:
             log.msg("sending response for msg id %s to %s" % (b64encode(msgID), repr(address)))
 
-        response["t"] = msgID
-
-        self.transport.write(bencode(response), address)
-
-    def sendMessage(self, address, message):
-        msgID = pack(">I", self.transactionSeq)
-        self.transactionSeq += 1
-
-        message["t"] = msgID
-
-        self.transport.write(bencode(message), address)
+        self.egress.write(self.codec.encodeResponse(msgID, response), address, RESPONSE)
 
+    def sendMessage(self, address, message, node=None, priority=LOOKUP):
+        """
+        Send a query.  At most maxOutstanding queries are in flight at once;
+        further ones wait in a queue of up to maxPending entries, and beyond
+        that fail right away as if the node hadn't answered.
+
+        If the L{Node} being queried is given, its round-trip time is
+        recorded and sets the timeout (see L{queryTimeout}).  priority is
+        the L{egress} class the query is sent with; the timeout only starts
+        once it has actually gone out.
+        """
         d = defer.Deferred()
-        timeout = reactor.callLater(self._waitTimeout, self._timeout, msgID)
-
-        self._outstanding[msgID] = (d, timeout)
+        if len(self._outstanding) < self.maxOutstanding:
+            self._sendQuery(address, message, d, node, priority)
+        elif len(self._pending) < self.maxPending:
+            self._pending.append((address, message, d, node, priority))
+        else:
+            self.log.debug("too many queries in flight, not sending %s to %s", message["q"], address)
+            self.metrics.queryFinished(message["q"], DROPPED)
+            d.callback((False, None))
         return d
 
+    def queryTimeout(self, node=None):
+        """
+        Seconds to wait for an answer from node: its smoothed RTT plus four
+        deviations, or the same over every node we have timed if it hasn't
+        answered before.  Never below minTimeout or above _waitTimeout.
+        """
+        estimator = self.peerRTTs.get(node) if node is not None else None
+        if estimator is None:
+            estimator = self.rtt
+        return estimator.timeout(self.minTimeout, self._waitTimeout)
+
+    def _nextTransactionID(self):
+        # two byte ids, skipping any still waiting for an answer
+        seq = self.transactionSeq
+        while True:
+            seq = (seq + 1) & 0xffff
+            msgID = pack(">H", seq)
+            if msgID not in self._outstanding:
+                self.transactionSeq = seq
+                return msgID
+
+    def _sendQuery(self, address, message, d, node, priority):
+        msgID = self._nextTransactionID()
+        # the timeout and send time are filled in by _querySent
+        self._outstanding[msgID] = [d, None, None, node, message["q"]]
+        self.egress.write(self.codec.encodeQuery(msgID, message), address, priority, self._querySent, msgID)
+
+    def _querySent(self, sent, msgID):
+        entry = self._outstanding.get(msgID)
+        if entry is None:
+            return
+        if not sent:
+            # dropped by the egress queue or refused by the port
+            del self._outstanding[msgID]
+            self.metrics.queryFinished(entry[4], DROPPED)
+            entry[0].callback((False, None))
+            return
+        entry[1] = self.timeouts.callLater(self.queryTimeout(entry[3]), self._timeout, msgID)
+        entry[2] = time.time()
+
+    def _sendPending(self):
+        while self._pending and len(self._outstanding) < self.maxOutstanding:
+            self._sendQuery(*self._pending.popleft())
+
+    def _acceptResponse(self, msgID, data, address):
+        entry = self._outstanding.get(msgID)
+        # an answer to a query still waiting in the egress queue can't be genuine
+        if entry is None or entry[1] is None:
+            self.log.debug("received unknown message %s from %s; ignoring", lazy(b64encode, msgID), address)
+            return
+        del self._outstanding[msgID]
+        if self.noisy:
+            log.msg("received response for message id %s from %s" % (b64encode(msgID), repr(address)))
+
+        d, timeout, sentAt, node, method = entry
+        timeout.cancel()
+        rtt = time.time() - sentAt
+        self.metrics.queryFinished(method, OK, rtt)
+        self.rtt.update(rtt)
+        if node is not None:
+            self.peerRTTs.update(node, rtt)
+        d.callback((True, data))
+        self._sendPending()
+
+    def _timeout(self, msgID):
+        entry = self._outstanding.pop(msgID, None)
+        if entry is None:
+            return
+        self.log.debug("did not receive reply for msg id %s in time", lazy(b64encode, msgID))
+
+        self.metrics.queryFinished(entry[4], TIMEOUT)
+        entry[0].callback((False, None))
+        self._sendPending()
+
     def getRefreshIDs(self):
         """
         Get ids to search for to keep old buckets up to date.
         """
-        ids = []
-        for bucket in self.router.getLonelyBuckets():
-            ids.append(random.randint(*bucket.range))
-        return ids
+        return [random_node_id(*bucket.range) for bucket in self.router.getLonelyBuckets()]
+
+    @staticmethod
+    def _contact(node_id, sender):
+        """
+        The node that sent a query.  Raises KeyError, which the rpc_*
+        methods answer as invalid arguments, if its id isn't 20 bytes.
+        """
+        if not is_node_id(node_id):
+            raise KeyError("id")
+        return Node.intern(node_id, sender[0], sender[1])
 
     @staticmethod
     def _response_error(error_code, error_message):
@@ -124,7 +280,7 @@ class KademliaProtocol(RPCProtocol):
     def rpc_ping(self, sender, args):
         try:
             node_id = args["id"]
-            source = Node(node_id, sender[0], sender[1])
+            source = self._contact(node_id, sender)
 
             self.welcomeIfNewNode(source)
 
@@ -140,18 +296,21 @@ class KademliaProtocol(RPCProtocol):
             port = args["port"]
             token = args["token"]
 
-            source = Node(node_id, sender[0], sender[1])
+            source = self._contact(node_id, sender)
 
             self.welcomeIfNewNode(source)
 
-            self.log.debug("got a store request from %s, storing value" % str(sender))
+            self.log.debug("got a store request from %s, storing value", sender)
 
-            if verify_token(sender[0], sender[1], token):
-                values = self.storage.get(info_hash, [])
-                values.append((sender[0], port))
+            if self.tokens.verify(sender[0], sender[1], token):
+                if IPeerStorage.providedBy(self.storage):
+                    self.storage.addPeer(info_hash, (sender[0], port))
+                else:
+                    values = self.storage.get(info_hash, [])
+                    values.append((sender[0], port))
 
-                # Redeclare value by info_hash
-                self.storage[info_hash] = values
+                    # Redeclare value by info_hash
+                    self.storage[info_hash] = values
 
                 return {"y": "r",
                         "r": {"id": self.sourceNode.id}}
@@ -165,9 +324,8 @@ class KademliaProtocol(RPCProtocol):
             node_id = args["id"]
             target = args["target"]
 
-            self.log.info("finding neighbors of %i in local table" % long(node_id.encode('hex'), 16))
-
-            source = Node(node_id, sender[0], sender[1])
+            source = self._contact(node_id, sender)
+            self.log.info("finding neighbors of %d in local table", source.long_id)
             self.welcomeIfNewNode(source)
 
             node = Node(target)
@@ -183,7 +341,7 @@ class KademliaProtocol(RPCProtocol):
             node_id = args["id"]
             info_hash = args["info_hash"]
 
-            source = Node(node_id, sender[0], sender[1])
+            source = self._contact(node_id, sender)
 
             self.welcomeIfNewNode(source)
 
@@ -192,76 +350,86 @@ class KademliaProtocol(RPCProtocol):
                 # We must calculate unique token for sender
                 return {"y": "r",
                         "r": {"id": self.sourceNode.id,
-                              "token": generate_token(sender[0], sender[1]),
+                              "token": self.tokens.generate(sender[0], sender[1]),
                               "values": encode_values(values)}}
             else:
-                return self.rpc_find_node(sender, {"id": node_id,
-                                                   "target": info_hash})
+                response = self.rpc_find_node(sender, {"id": node_id,
+                                                       "target": info_hash})
+                # Per BEP 5 the token is handed out with the closest nodes too,
+                # otherwise nobody could ever announce a new info_hash to us
+                if response["y"] == "r":
+                    response["r"]["token"] = self.tokens.generate(sender[0], sender[1])
+                return response
         except KeyError:
             return self._response_error(203, "Protocol Error, invalid arguments")
 
-    def callFindNode(self, nodeToAsk, nodeToFind):
+    def callFindNode(self, nodeToAsk, nodeToFind, priority=LOOKUP):
         address = (nodeToAsk.ip, nodeToAsk.port)
-        d = self.find_node(address, self.sourceNode.id, nodeToFind.id)
+        d = self.find_node(address, self.sourceNode.id, nodeToFind.id, node=nodeToAsk, priority=priority)
         return d.addCallback(self.handleCallResponse, nodeToAsk, responseMessage="find_node")
 
-    def callGetPeers(self, nodeToAsk, key):
+    def callGetPeers(self, nodeToAsk, key, priority=LOOKUP):
         address = (nodeToAsk.ip, nodeToAsk.port)
-        d = self.get_peers(address, self.sourceNode.id, key.id)
+        d = self.get_peers(address, self.sourceNode.id, key.id, node=nodeToAsk, priority=priority)
         return d.addCallback(self.handleCallResponse, nodeToAsk, responseMessage="get_peers")
 
-    def callPing(self, nodeToAsk):
+    def callPing(self, nodeToAsk, priority=LOOKUP):
         address = (nodeToAsk.ip, nodeToAsk.port)
-        d = self.ping(address, self.sourceNode.id)
+        d = self.ping(address, self.sourceNode.id, node=nodeToAsk, priority=priority)
         return d.addCallback(self.handleCallResponse, nodeToAsk, responseMessage="ping")
 
-    def callAnnouncePeer(self, nodeToAsk, key, value, token):
+    def callAnnouncePeer(self, nodeToAsk, key, value, token, priority=LOOKUP):
         address = (nodeToAsk.ip, nodeToAsk.port)
-        d = self.announce_peer(address, self.sourceNode.id, key.id, value, token)
+        d = self.announce_peer(address, self.sourceNode.id, key.id, value, token, node=nodeToAsk,
+                               priority=priority)
         return d.addCallback(self.handleCallResponse, nodeToAsk, responseMessage="announce_peer")
 
     # BitTorrent protocol messages implementation
-    def ping(self, address, nodeId):
+    def ping(self, address, nodeId, node=None, priority=LOOKUP):
         return self.sendMessage(address, {"y": "q",
                                           "q": "ping",
-                                          "a": {"id": nodeId}})
+                                          "a": {"id": nodeId}}, node, priority)
 
-    def find_node(self, address, nodeId, targetId):
+    def find_node(self, address, nodeId, targetId, node=None, priority=LOOKUP):
         return self.sendMessage(address, {"y": "q",
                                           "q": "find_node",
                                           "a": {"id": nodeId,
-                                                "target": targetId}})
+                                                "target": targetId}}, node, priority)
 
-    def get_peers(self, address, nodeId, info_hash):
+    def get_peers(self, address, nodeId, info_hash, node=None, priority=LOOKUP):
         return self.sendMessage(address, {"y": "q",
                                           "q": "get_peers",
                                           "a": {"id": nodeId,
-                                                "info_hash": info_hash}})
+                                                "info_hash": info_hash}}, node, priority)
 
-    def announce_peer(self, address, nodeId, info_hash, port, token):
+    def announce_peer(self, address, nodeId, info_hash, port, token, node=None, priority=LOOKUP):
         return self.sendMessage(address, {"y": "q",
                                           "q": "announce_peer",
                                           "a": {"id": nodeId,
                                                 "implied_port": 0,
                                                 "info_hash": info_hash,
                                                 "port": port,
-                                                "token": token}})
+                                                "token": token}}, node, priority)
 
     def welcomeIfNewNode(self, node):
-        if self.router.isNewNode(node):
-            self.router.addContact(node)
+        """
+        Add a node that queried us to the routing table, or note that it
+        is still around if it is already there.
+        """
+        self.router.addContact(node)
 
     def handleCallResponse(self, result, node, responseMessage):
         """
         If we get a response, add the node to the routing table.  If
-        we get no response, make sure it's removed from the routing table.
+        we get no response, count it against the node, which eventually
+        gets it replaced.
         """
         if result[0]:
-            self.log.info("got response from %s, adding to router" % node)
-            self.welcomeIfNewNode(node)
+            self.log.info("got response from %s, adding to router", node)
+            self.router.addContact(node, replied=True)
         else:
-            self.log.debug("no response from %s, removing from router" % node)
-            self.router.removeContact(node)
+            self.log.debug("no response from %s, marking it failed", node)
+            self.router.contactFailed(node)
 
         # TODO: Its looks like a software crutch, need some solution to avoid it.
         return result + (node,)
@@ -0,0 +1,118 @@
+"""
+Bucket refresh scheduling.
+"""
+import random
+import time
+from collections import deque
+
+from twisted.internet import defer
+from twisted.internet.task import LoopingCall
+from twisted.python import failure
+
+from crawling import NodeSpiderCrawl
+from egress import MAINTENANCE
+from log import Logger
+from node import Node
+from utils import random_node_id
+
+
+class RefreshScheduler(object):
+    """
+    Refreshes buckets that haven't seen a lookup or a contact for a while,
+    a few at a time.
+
+    A bucket comes due interval seconds after it was last touched, plus a
+    random delay of up to jitter * interval so that buckets touched
+    together don't come due together.  Every tick seconds the due buckets
+    are queued, and at most maxRunning refresh crawls run at once.
+    """
+
+    def __init__(self, server, interval=3600, jitter=0.1, maxRunning=2, tick=10):
+        self.server = server
+        self.interval = interval
+        self.jitter = jitter
+        self.maxRunning = maxRunning
+        self.tick = tick
+        # (target id, lower bound of the bucket it refreshes)
+        self.queue = deque()
+        # lower bounds of the buckets queued or being refreshed
+        self.queued = set()
+        self.running = 0
+        # Deferreds from refreshNow, fired once the queue is drained
+        self.waiting = []
+        # bucket lower bound -> (lastUpdated, jitter delay drawn for it)
+        self.delays = {}
+        self.loop = None
+        self.log = Logger(system=self)
+
+    def start(self):
+        self.loop = LoopingCall(self.check)
+        self.loop.start(self.tick, now=False)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.loop = None
+
+    def dueAt(self, bucket):
+        """
+        When bucket comes due, with a fresh random delay each time it has
+        been touched since the last check.
+        """
+        lastUpdated, delay = self.delays.get(bucket.range[0], (None, None))
+        if lastUpdated != bucket.lastUpdated:
+            delay = random.random() * self.jitter * self.interval
+            self.delays[bucket.range[0]] = (bucket.lastUpdated, delay)
+        return bucket.lastUpdated + self.interval + delay
+
+    def check(self):
+        """
+        Queue every bucket that is due and start refreshing.
+        """
+        now = time.time()
+        for bucket in self.server.protocol.router.buckets:
+            if self.dueAt(bucket) <= now:
+                self._enqueue(bucket)
+        self._startNext()
+
+    def refreshNow(self, age=None):
+        """
+        Queue every bucket not touched for age seconds, by default
+        interval, without waiting for its jitter.
+
+        Returns a C{Deferred} that fires once nothing is queued or running.
+        """
+        for bucket in self.server.protocol.router.getLonelyBuckets(age or self.interval):
+            self._enqueue(bucket)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        self._startNext()
+        return d
+
+    def _enqueue(self, bucket):
+        if bucket.range[0] not in self.queued:
+            self.queued.add(bucket.range[0])
+            self.queue.append((random_node_id(*bucket.range), bucket.range[0]))
+
+    def _startNext(self):
+        server = self.server
+        while self.queue and self.running < self.maxRunning:
+            target, lower = self.queue.popleft()
+            self.running += 1
+            node = Node(target)
+            nearest = server.protocol.router.findNeighbors(node, server.alpha)
+            spider = NodeSpiderCrawl(server.protocol, node, nearest, server.ksize, server.alpha, server.lookupMode,
+                                     priority=MAINTENANCE)
+            spider.find().addBoth(self._finished, lower)
+
+        if not self.queue and not self.running:
+            waiting, self.waiting = self.waiting, []
+            for d in waiting:
+                d.callback(None)
+
+    def _finished(self, result, lower):
+        self.running -= 1
+        self.queued.discard(lower)
+        if isinstance(result, failure.Failure):
+            self.log.error("refresh failed: %s", result.getErrorMessage())
+        self._startNext()
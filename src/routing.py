@@ -1,16 +1,60 @@
-import heapq
 import time
 import operator
-from collections import OrderedDict
+from binascii import hexlify
+from bisect import bisect_right
+from collections import OrderedDict, deque
 
-from utils import OrderedSet, shared_prefix
+from twisted.internet import reactor
+
+from egress import MAINTENANCE
+from utils import is_node_id, shared_prefix
+
+# node health, per BEP 5
+GOOD = "good"
+QUESTIONABLE = "questionable"
+BAD = "bad"
+
+# a node that has answered us at least once stays good while we hear from
+# it (answers or queries) at least this often
+GOOD_INTERVAL = 15 * 60
+# consecutive unanswered queries after which a node is bad
+MAX_FAILURES = 2
+
+
+class NodeHealth(object):
+    """
+    What we know about a contact's liveness.
+    """
+    __slots__ = ('lastSeen', 'lastReplied', 'failures')
+
+    def __init__(self, now):
+        self.lastSeen = now
+        self.lastReplied = None
+        self.failures = 0
+
+    def seen(self, now, replied):
+        self.lastSeen = now
+        if replied:
+            self.lastReplied = now
+            self.failures = 0
+
+    def state(self, now):
+        if self.failures >= MAX_FAILURES:
+            return BAD
+        if self.lastReplied is not None and now - self.lastSeen < GOOD_INTERVAL:
+            return GOOD
+        return QUESTIONABLE
 
 
 class KBucket(object):
     def __init__(self, rangeLower, rangeUpper, ksize):
         self.range = (rangeLower, rangeUpper)
+        # least recently seen first
         self.nodes = OrderedDict()
-        self.replacementNodes = OrderedSet()
+        # contacts that didn't fit, least recently seen first, at most ksize
+        self.replacementNodes = OrderedDict()
+        # node id -> NodeHealth, for nodes and replacements
+        self.health = {}
         self.touchLastUpdated()
         self.ksize = ksize
 
@@ -27,41 +71,120 @@ class KBucket(object):
         for node in self.nodes.values():
             bucket = one if node.long_id <= midpoint else two
             bucket.nodes[node.id] = node
+            bucket.health[node.id] = self.health[node.id]
+        for node in self.replacementNodes.values():
+            bucket = one if node.long_id <= midpoint else two
+            bucket.replacementNodes[node.id] = node
+            bucket.health[node.id] = self.health[node.id]
         return (one, two)
 
     def removeNode(self, node):
         if node.id not in self.nodes:
             return
 
-        # delete node, and see if we can add a replacement
+        # delete node, and promote the most recently seen replacement
         del self.nodes[node.id]
+        del self.health[node.id]
         if len(self.replacementNodes) > 0:
-            newnode = self.replacementNodes.pop()
+            newnode = self.replacementNodes.popitem()[1]
             self.nodes[newnode.id] = newnode
 
+    def nodeFailed(self, node):
+        """
+        Count a query the node didn't answer.  A bad node stays until a
+        replacement is available for it; a failed replacement is dropped.
+        """
+        health = self.health.get(node.id)
+        if health is None:
+            return
+        health.failures += 1
+
+        if node.id in self.replacementNodes:
+            del self.replacementNodes[node.id]
+            del self.health[node.id]
+        elif health.failures >= MAX_FAILURES and len(self.replacementNodes) > 0:
+            self.removeNode(node)
+
+    def state(self, node, now=None):
+        """
+        The L{GOOD}, L{QUESTIONABLE} or L{BAD} state of a node in this
+        bucket, or None if it isn't in it.
+        """
+        health = self.health.get(node.id)
+        if health is None or node.id not in self.nodes:
+            return None
+        return health.state(now or time.time())
+
+    def staleNode(self, now=None):
+        """
+        The least recently seen questionable node, which is the one worth
+        pinging to find out whether it can be replaced, or None.
+        """
+        now = now or time.time()
+        for nodeId, node in self.nodes.iteritems():
+            if self.health[nodeId].state(now) == QUESTIONABLE:
+                return node
+        return None
+
+    def span(self):
+        """
+        Number of low-order bits that vary inside this bucket's range.
+        Bucket ranges are aligned binary prefixes, so every id in the
+        bucket shares all bits above this one.
+        """
+        return (self.range[0] ^ self.range[1]).bit_length()
+
     def hasInRange(self, node):
         return self.range[0] <= node.long_id <= self.range[1]
 
     def isNewNode(self, node):
         return node.id not in self.nodes
 
-    def addNode(self, node):
+    def addNode(self, node, replied=False):
         """
-        Add a C{Node} to the C{KBucket}.  Return True if successful,
-        False if the bucket is full.
+        Add a C{Node} to the C{KBucket}, or note that it is alive if it is
+        already there.  Return True if successful, False if the bucket is
+        full.
+
+        A full bucket makes room by evicting a bad node.  Otherwise the node
+        is kept in a replacement list, per section 4.1 of the paper, ordered
+        by how recently it was seen.
 
-        If the bucket is full, keep track of node in a replacement list,
-        per section 4.1 of the paper.
+        @param replied: Whether the node answered a query of ours, rather
+        than just sending us one.
         """
+        now = time.time()
+        health = self.health.get(node.id)
+
         if node.id in self.nodes:
             del self.nodes[node.id]
             self.nodes[node.id] = node
-        elif len(self) < self.ksize:
+            health.seen(now, replied)
+            return True
+
+        if health is None:
+            health = NodeHealth(now)
+            self.health[node.id] = health
+        health.seen(now, replied)
+
+        if len(self) >= self.ksize:
+            for nodeId in self.nodes:
+                if self.health[nodeId].state(now) == BAD:
+                    del self.nodes[nodeId]
+                    del self.health[nodeId]
+                    break
+
+        if len(self) < self.ksize:
+            self.replacementNodes.pop(node.id, None)
             self.nodes[node.id] = node
-        else:
-            self.replacementNodes.push(node)
-            return False
-        return True
+            return True
+
+        self.replacementNodes.pop(node.id, None)
+        self.replacementNodes[node.id] = node
+        if len(self.replacementNodes) > self.ksize:
+            staleId = self.replacementNodes.popitem(last=False)[0]
+            del self.health[staleId]
+        return False
 
     def depth(self):
         sp = shared_prefix([n.id for n in self.nodes.values()])
@@ -77,71 +200,242 @@ class KBucket(object):
         return len(self.nodes)
 
 
+class PingQueue(object):
+    """
+    Pings the questionable nodes of full buckets for the routing table.
+
+    A node is pinged at most once at a time, however many new contacts
+    arrive for its bucket.  Pings go out at no more than rate per second
+    and the rest wait in a queue of at most maxQueued nodes; beyond that
+    they are dropped, as the next new contact will ask again.  A node that
+    doesn't answer is swapped for the freshest replacement right away.
+    """
+
+    def __init__(self, router, rate=20, maxQueued=256, clock=reactor):
+        self.router = router
+        self.rate = rate
+        self.maxQueued = maxQueued
+        self.clock = clock
+        self.queue = deque()
+        # ids of the nodes queued or waiting for an answer
+        self.pending = set()
+        self.tokens = float(rate)
+        self.stamp = clock.seconds()
+        self.drainCall = None
+        self.sent = 0
+        self.dropped = 0
+
+    def ping(self, node):
+        if node.id in self.pending:
+            return
+        if len(self.queue) >= self.maxQueued:
+            self.dropped += 1
+            return
+        self.pending.add(node.id)
+        self.queue.append(node)
+        if self.drainCall is None:
+            self._drain()
+
+    def _drain(self):
+        self.drainCall = None
+        now = self.clock.seconds()
+        self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+        while self.queue and self.tokens >= 1:
+            self.tokens -= 1
+            node = self.queue.popleft()
+            self.sent += 1
+            self.router.protocol.callPing(node, MAINTENANCE).addCallback(self._answered, node)
+
+        if self.queue:
+            self.drainCall = self.clock.callLater((1 - self.tokens) / self.rate, self._drain)
+
+    def _answered(self, result, node):
+        self.pending.discard(node.id)
+        if not result[0]:
+            self.router.evictContact(node)
+        return result
+
+
 class RoutingTable(object):
-    def __init__(self, protocol, ksize, node):
+    def __init__(self, protocol, ksize, node, maxPingRate=20):
         """
         @param node: The node that represents this server.  It won't
         be added to the routing table, but will be needed later to
         determine which buckets to split or not.
+        @param maxPingRate: The most pings per second sent to check
+        whether questionable nodes can be replaced.
         """
         self.node = node
         self.protocol = protocol
         self.ksize = ksize
+        self.pings = PingQueue(self, maxPingRate)
         self.flush()
 
     def flush(self):
-        self.buckets = [KBucket(0, 2 ** 160, self.ksize)]
+        self.buckets = [KBucket(0, 2 ** 160 - 1, self.ksize)]
+        # lower bound of every bucket's range, kept in step with self.buckets
+        # so that getBucketFor can bisect instead of scanning
+        self.rangeLowers = [0]
+
+    def restore(self, buckets):
+        """
+        Replace the table's contents with buckets read from a snapshot: a
+        list of (lower, upper, lastUpdated, [(node, lastSeen)]) tuples that
+        must cover the id space in order.  Restored contacts are
+        questionable until they answer again.
+        """
+        expected = 0
+        for lower, upper, lastUpdated, nodes in buckets:
+            if lower != expected or upper < lower:
+                raise ValueError("buckets don't cover the id space in order")
+            expected = upper + 1
+        if expected != 2 ** 160:
+            raise ValueError("buckets don't cover the id space in order")
+
+        self.buckets = []
+        self.rangeLowers = []
+        for lower, upper, lastUpdated, nodes in buckets:
+            bucket = KBucket(lower, upper, self.ksize)
+            bucket.lastUpdated = lastUpdated
+            for node, lastSeen in sorted(nodes, key=operator.itemgetter(1)):
+                if bucket.hasInRange(node) and node.id != self.node.id and len(bucket) < self.ksize:
+                    bucket.nodes[node.id] = node
+                    bucket.health[node.id] = NodeHealth(lastSeen)
+            self.buckets.append(bucket)
+            self.rangeLowers.append(lower)
 
     def splitBucket(self, index):
         one, two = self.buckets[index].split()
         self.buckets[index] = one
         self.buckets.insert(index + 1, two)
+        self.rangeLowers.insert(index + 1, two.range[0])
 
-    def getLonelyBuckets(self):
+    def getLonelyBuckets(self, age=3600):
         """
         Get all of the buckets that haven't been updated in over
-        an hour.
+        age seconds, an hour by default.
+        """
+        return [b for b in self.buckets if b.lastUpdated < (time.time() - age)]
+
+    def touchBucketFor(self, node):
+        """
+        Note a lookup of, or contact with, an id in node's bucket, which
+        puts off the bucket's next refresh.
         """
-        return [b for b in self.buckets if b.lastUpdated < (time.time() - 3600)]
+        self.buckets[self.getBucketFor(node)].touchLastUpdated()
 
     def removeContact(self, node):
         index = self.getBucketFor(node)
         self.buckets[index].removeNode(node)
 
+    def evictContact(self, node):
+        """
+        Replace the node with the freshest replacement of its bucket, if
+        there is one.
+        """
+        bucket = self.buckets[self.getBucketFor(node)]
+        if len(bucket.replacementNodes) > 0:
+            bucket.removeNode(node)
+
+    def contactFailed(self, node):
+        """
+        The node didn't answer a query; see L{KBucket.nodeFailed}.
+        """
+        index = self.getBucketFor(node)
+        self.buckets[index].nodeFailed(node)
+
     def isNewNode(self, node):
         index = self.getBucketFor(node)
         return self.buckets[index].isNewNode(node)
 
-    def addContact(self, node):
+    def isKnownId(self, nodeId):
+        """
+        Is there a contact with the given raw node id in the table?
+        """
+        if not is_node_id(nodeId):
+            return False
+        index = bisect_right(self.rangeLowers, long(hexlify(nodeId), 16)) - 1
+        return nodeId in self.buckets[index].nodes
+
+    def addContact(self, node, replied=False):
         index = self.getBucketFor(node)
         bucket = self.buckets[index]
+        bucket.touchLastUpdated()
 
-        # this will succeed unless the bucket is full
-        if bucket.addNode(node):
+        # this will succeed unless the bucket is full of nodes that aren't bad
+        if bucket.addNode(node, replied):
             return
 
         # Per section 4.2 of paper, split if the bucket has the node in its range
         # or if the depth is not congruent to 0 mod 5
         if bucket.hasInRange(self.node) or bucket.depth() % 5 != 0:
             self.splitBucket(index)
-            self.addContact(node)
+            self.addContact(node, replied)
         else:
-            self.protocol.callPing(bucket.head())
+            # per BEP 5 only questionable nodes are pinged; if they fail,
+            # the new node takes their place as a replacement
+            stale = bucket.staleNode()
+            if stale is not None:
+                self.pings.ping(stale)
 
     def getBucketFor(self, node):
         """
         Get the index of the bucket that the given node would fall into.
         """
-        for index, bucket in enumerate(self.buckets):
-            if node.long_id < bucket.range[1]:
-                return index
+        return bisect_right(self.rangeLowers, node.long_id) - 1
 
     def findNeighbors(self, node, k=None, exclude=None):
+        """
+        Get the k nodes closest to the given node.
+
+        Bad nodes are left out.  Nodes whose distance to the target has
+        the same bit length are about equally close, so among those good
+        nodes come before questionable ones.
+
+        Buckets cover aligned prefixes of the id space, so the buckets
+        within XOR distance 2^bits of the target always form a contiguous
+        run around the target's own bucket.  Start there and widen the
+        run one prefix bit at a time; once k candidates are closer than
+        2^bits, nothing outside the run can beat them.
+        """
+        k = k or self.ksize
+        target = node.long_id
+        now = time.time()
+        # (distance bit length, 0 if good else 1, distance, node)
         nodes = []
-        # Linear scan by buckets and nodes. Find any closest neighbor (including far nodes).
-        for bucket in self.buckets:
-            for neighbor in bucket.getNodes():
-                if neighbor.id != node.id and (exclude is None or not neighbor.sameHomeAs(exclude)):
-                    heapq.heappush(nodes, (node.distanceTo(neighbor), neighbor))
 
-        return map(operator.itemgetter(1), heapq.nsmallest(k or self.ksize, nodes))
+        def collect(first, last):
+            for bucket in self.buckets[first:last + 1]:
+                health = bucket.health
+                for neighbor in bucket.getNodes():
+                    if neighbor.id != node.id and (exclude is None or not neighbor.sameHomeAs(exclude)):
+                        state = health[neighbor.id].state(now)
+                        if state != BAD:
+                            distance = target ^ neighbor.long_id
+                            nodes.append((distance.bit_length(), state != GOOD, distance, neighbor))
+
+        sortKey = operator.itemgetter(0, 1, 2)
+        first = last = self.getBucketFor(node)
+        collect(first, last)
+        bits = self.buckets[first].span()
+
+        while last - first + 1 < len(self.buckets):
+            if len(nodes) >= k:
+                nodes.sort(key=sortKey)
+                if nodes[k - 1][0] <= bits:
+                    break
+
+            # pull in the sibling of the current prefix block
+            bits += 1
+            lower = (target >> bits) << bits
+            upper = lower + 2 ** bits - 1
+            newFirst = bisect_right(self.rangeLowers, lower) - 1
+            newLast = bisect_right(self.rangeLowers, upper) - 1
+            collect(newFirst, first - 1)
+            collect(last + 1, newLast)
+            first, last = newFirst, newLast
+
+        nodes.sort(key=sortKey)
+        return map(operator.itemgetter(3), nodes[:k])
@@ -0,0 +1,82 @@
+"""
+Round-trip time estimation for RPC timeouts.
+"""
+from collections import OrderedDict
+
+# smoothing gains and variance multiplier from RFC 6298
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+RTT_K = 4
+
+
+class RTTEstimator(object):
+    """
+    Smoothed round-trip time and its mean deviation, both EWMAs, computed
+    the way TCP derives its retransmission timeout (RFC 6298).
+    """
+    __slots__ = ('srtt', 'rttvar', 'samples')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def update(self, rtt):
+        """
+        Add the round-trip time, in seconds, of an answered query.
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar += RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_ALPHA * (rtt - self.srtt)
+        self.samples += 1
+
+    def timeout(self, minimum, maximum):
+        """
+        srtt + 4 * rttvar, clamped to [minimum, maximum]; maximum if there
+        are no samples yet.
+        """
+        if self.srtt is None:
+            return maximum
+        return min(maximum, max(minimum, self.srtt + RTT_K * self.rttvar))
+
+    def __repr__(self):
+        if self.srtt is None:
+            return "<RTTEstimator no samples>"
+        return "<RTTEstimator srtt=%.3f rttvar=%.3f samples=%d>" % (self.srtt, self.rttvar, self.samples)
+
+
+class PeerRTTs(object):
+    """
+    An L{RTTEstimator} per peer, keyed by id, ip and port, for up to
+    maxsize peers.  The peer updated least recently is forgotten to make
+    room for a new one.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.estimators = OrderedDict()
+
+    def get(self, node):
+        """
+        The estimator of the given L{Node}, or None if it never answered.
+        """
+        return self.estimators.get((node.id, node.ip, node.port))
+
+    def update(self, node, rtt):
+        """
+        Add the round-trip time, in seconds, of a query node answered.
+        """
+        key = (node.id, node.ip, node.port)
+        estimator = self.estimators.pop(key, None)
+        if estimator is None:
+            estimator = RTTEstimator()
+            if len(self.estimators) >= self.maxsize:
+                self.estimators.popitem(last=False)
+        self.estimators[key] = estimator
+        estimator.update(rtt)
+
+    def __len__(self):
+        return len(self.estimators)
@@ -0,0 +1,171 @@
+"""
+In-memory datagram network for running many nodes in one process.
+
+Datagrams are handed straight to the receiving protocol after a simulated
+one-way delay, with random loss and optional churn, so lookups can be
+measured without the live DHT.  Time is real reactor time; keep latencies
+and timeouts scaled down to get through many lookups quickly.
+"""
+import random
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from node import Node
+
+
+class SimulatedTransport(object):
+    """
+    Stands in for the UDP port a protocol would get from C{listenUDP}.
+    """
+
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+        self.sent = 0
+
+    def write(self, datagram, address):
+        self.sent += 1
+        self.network.send(datagram, self.address, address)
+
+    def getHost(self):
+        return self.address
+
+    def stopListening(self):
+        self.network.unlisten(self.address)
+
+
+class SimulatedNetwork(object):
+    """
+    Connects protocols by (ip, port) address.
+
+    Every host gets a one-way base latency drawn uniformly from latency;
+    a datagram takes the sum of both ends' base latencies plus up to jitter
+    seconds, and is dropped with probability loss.  Hosts can be taken
+    down, in which case datagrams to them vanish, by hand or by churn
+    (see L{startChurn}).
+    """
+
+    def __init__(self, latency=(0.005, 0.05), jitter=0.005, loss=0.02, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.hosts = {}
+        self.baseLatency = {}
+        self.down = set()
+        self.delivered = 0
+        self.dropped = 0
+        self.churnLoop = None
+        # hosts taken down by churn -> the call bringing them back up, and
+        # how many times that happened
+        self.churnedDown = {}
+        self.churned = 0
+        # hosts owed to churn, carried over between ticks
+        self.churnCredit = 0.0
+
+    def address(self, index):
+        """
+        A unique fake IPv4 address for the host with the given number.
+        """
+        return ("10.%d.%d.%d" % (index >> 16 & 255, index >> 8 & 255, index & 255), 6881)
+
+    def listen(self, protocol, address):
+        transport = SimulatedTransport(self, address)
+        self.hosts[address] = protocol
+        self.baseLatency[address] = self.random.uniform(*self.latency)
+        protocol.makeConnection(transport)
+        return transport
+
+    def unlisten(self, address):
+        protocol = self.hosts.pop(address, None)
+        if protocol is not None:
+            protocol.doStop()
+
+    def setDown(self, address, down=True):
+        if down:
+            self.down.add(address)
+        else:
+            self.down.discard(address)
+
+    def startChurn(self, rate, downtime=30.0, tick=1.0):
+        """
+        Every tick seconds, take a rate share per second of the hosts that
+        are up down for downtime seconds.  They come back with their state
+        intact, like a node restarting with a saved routing table.
+        """
+        self.stopChurn()
+        self.churnCredit = 0.0
+        self.churnLoop = LoopingCall(self._churn, rate * tick, downtime)
+        self.churnLoop.start(tick, now=False)
+
+    def stopChurn(self):
+        """
+        Stop churning and bring every host churn took down back up.
+        """
+        if self.churnLoop is not None and self.churnLoop.running:
+            self.churnLoop.stop()
+        self.churnLoop = None
+        for address, rejoin in self.churnedDown.iteritems():
+            if rejoin.active():
+                rejoin.cancel()
+            self.setDown(address, False)
+        self.churnedDown.clear()
+
+    def _churn(self, share, downtime):
+        up = [address for address in self.hosts if address not in self.down]
+        self.churnCredit += share * len(up)
+        count = min(int(self.churnCredit), len(up))
+        self.churnCredit -= count
+        for address in self.random.sample(up, count):
+            self.setDown(address)
+            self.churned += 1
+            self.churnedDown[address] = reactor.callLater(downtime, self._rejoin, address)
+
+    def _rejoin(self, address):
+        self.churnedDown.pop(address, None)
+        self.setDown(address, False)
+
+    def send(self, datagram, source, destination):
+        if destination not in self.hosts or destination in self.down or source in self.down \
+                or self.random.random() < self.loss:
+            self.dropped += 1
+            return
+
+        delay = self.baseLatency[source] + self.baseLatency[destination] + self.random.uniform(0, self.jitter)
+        reactor.callLater(delay, self._deliver, datagram, source, destination)
+
+    def _deliver(self, datagram, source, destination):
+        protocol = self.hosts.get(destination)
+        if protocol is None or destination in self.down:
+            self.dropped += 1
+            return
+        self.delivered += 1
+        protocol.datagramReceived(datagram, source)
+
+
+def seedRoutingTables(servers, network, rand=random):
+    """
+    Fill every server's routing table with all other servers, in random
+    order, without sending any pings for full buckets.
+    """
+    contacts = [Node.intern(server.node.id, *network.address(i)) for i, server in enumerate(servers)]
+    for server in servers:
+        order = list(contacts)
+        rand.shuffle(order)
+        for node in order:
+            if node.id != server.node.id:
+                _addContactQuietly(server.protocol.router, node)
+
+
+def _addContactQuietly(router, node):
+    """
+    RoutingTable.addContact, minus the ping of a full bucket's head.
+    """
+    index = router.getBucketFor(node)
+    bucket = router.buckets[index]
+    if bucket.addNode(node):
+        return
+    if bucket.hasInRange(router.node) or bucket.depth() % 5 != 0:
+        router.splitBucket(index)
+        _addContactQuietly(router, node)
@@ -0,0 +1,180 @@
+"""
+Binary snapshots of a whole routing table, for warm restarts.
+
+A snapshot is a header followed by one block per bucket::
+
+    header   magic "BTRT", version, ksize, alpha, bucket count,
+             our node id, time written                      (37 bytes)
+    bucket   range lower and upper bound as 20 byte ids, node count n,
+             time last updated                              (50 bytes)
+             n compact node records, 20 byte id + ip + port (26 bytes each)
+             n last seen times, whole seconds since the epoch (4 bytes each)
+
+All fields are in network order.  Files are written to a temporary name
+and renamed into place, and read through C{mmap}.  Only IPv4 contacts with
+20 byte ids are kept.
+"""
+import mmap
+import os
+import socket
+import struct
+import time
+
+from twisted.internet import defer
+from twisted.internet.task import LoopingCall
+
+from egress import MAINTENANCE
+from log import Logger
+from node import Node
+from utils import NODE_SIZE, is_node_id, peer_struct
+
+MAGIC = "BTRT"
+VERSION = 1
+
+header_struct = struct.Struct("!4sBBBH20sd")
+bucket_struct = struct.Struct("!20s20sHd")
+seen_struct = struct.Struct("!I")
+
+
+class SnapshotError(Exception):
+    """
+    The file isn't a routing table snapshot this version can read.
+    """
+
+
+def _long_to_id(value):
+    return ("%040x" % value).decode("hex")
+
+
+def _encode_bucket(bucket):
+    records = []
+    seen = []
+    for node in bucket.getNodes():
+        if not is_node_id(node.id):
+            continue  # would throw every later record off
+        try:
+            records.append(node.id + peer_struct.pack(socket.inet_aton(node.ip), node.port))
+        except (socket.error, struct.error, TypeError):
+            continue  # not an IPv4 address and port
+        seen.append(seen_struct.pack(int(bucket.health[node.id].lastSeen)))
+    header = bucket_struct.pack(_long_to_id(bucket.range[0]), _long_to_id(bucket.range[1]),
+                                len(records), bucket.lastUpdated)
+    return header + "".join(records) + "".join(seen)
+
+
+def write_snapshot(fname, router, alpha):
+    """
+    Write the routing table to fname, replacing any existing file only
+    once the new one is complete.
+    """
+    blocks = [header_struct.pack(MAGIC, VERSION, router.ksize, alpha, len(router.buckets),
+                                 router.node.id, time.time())]
+    blocks.extend(_encode_bucket(bucket) for bucket in router.buckets)
+
+    tmpname = "%s.%d.tmp" % (fname, os.getpid())
+    with open(tmpname, "wb") as f:
+        f.write("".join(blocks))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpname, fname)
+
+
+def read_snapshot(fname):
+    """
+    Read a snapshot written by L{write_snapshot}.
+
+    Returns:
+        A dict with the ksize, alpha and id of the node that wrote it, the
+        time it was written and its buckets: a list of (lower, upper,
+        lastUpdated, [(node, lastSeen)]) tuples.
+    """
+    with open(fname, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < header_struct.size:
+            raise SnapshotError("%s is too short for a snapshot" % fname)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        magic, version, ksize, alpha, count, nodeId, savedAt = header_struct.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError("%s is not a version %d snapshot" % (fname, VERSION))
+
+        inet_ntoa = socket.inet_ntoa
+        buckets = []
+        offset = header_struct.size
+        for _ in xrange(count):
+            if offset + bucket_struct.size > size:
+                raise SnapshotError("%s is truncated" % fname)
+            lower, upper, n, lastUpdated = bucket_struct.unpack_from(data, offset)
+            offset += bucket_struct.size
+            seenOffset = offset + n * NODE_SIZE
+            if seenOffset + n * seen_struct.size > size:
+                raise SnapshotError("%s is truncated" % fname)
+
+            nodes = []
+            for i in xrange(n):
+                record = offset + i * NODE_SIZE
+                ip, port = peer_struct.unpack_from(data, record + 20)
+                node = Node.intern(data[record:record + 20], inet_ntoa(ip), port)
+                nodes.append((node, seen_struct.unpack_from(data, seenOffset + i * seen_struct.size)[0]))
+            offset = seenOffset + n * seen_struct.size
+
+            buckets.append((long(lower.encode("hex"), 16), long(upper.encode("hex"), 16), lastUpdated, nodes))
+    finally:
+        data.close()
+
+    return {"ksize": ksize, "alpha": alpha, "id": nodeId, "saved": savedAt, "buckets": buckets}
+
+
+class ContactVerifier(object):
+    """
+    Pings restored contacts in the background, batchSize every interval
+    seconds.  Contacts that answer become good; ones that don't are
+    marked bad right away, so lookups skip them until replaced.
+    """
+
+    def __init__(self, protocol, nodes, batchSize=20, interval=0.5):
+        self.protocol = protocol
+        self.nodes = list(nodes)
+        self.batchSize = batchSize
+        self.interval = interval
+        self.answered = 0
+        self.failed = 0
+        self.outstanding = 0
+        self.loop = None
+        self.deferred = defer.Deferred()
+        self.log = Logger(system=self)
+
+    def start(self):
+        """
+        Returns a C{Deferred} that fires with this verifier once every
+        contact has answered or timed out.
+        """
+        self.loop = LoopingCall(self._sendBatch)
+        self.loop.start(self.interval)
+        return self.deferred
+
+    def _sendBatch(self):
+        batch, self.nodes = self.nodes[:self.batchSize], self.nodes[self.batchSize:]
+        if not self.nodes:
+            self.loop.stop()
+        for node in batch:
+            self.outstanding += 1
+            self.protocol.callPing(node, MAINTENANCE).addCallback(self._answered, node)
+        self._checkDone()
+
+    def _answered(self, result, node):
+        self.outstanding -= 1
+        if result[0]:
+            self.answered += 1
+        else:
+            self.failed += 1
+            # handleCallResponse counted one failure; one is enough here
+            self.protocol.router.contactFailed(node)
+        self._checkDone()
+        return result
+
+    def _checkDone(self):
+        if not self.nodes and not self.outstanding and not self.deferred.called:
+            self.log.info("verified restored contacts: %d answered, %d failed", self.answered, self.failed)
+            self.deferred.callback(self)
@@ -1,10 +1,12 @@
-import time
 from itertools import izip
 from itertools import imap
 from itertools import takewhile
+from itertools import dropwhile
 import operator
 from collections import OrderedDict
 
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from zope.interface import implements
 from zope.interface import Interface
 
@@ -40,48 +42,99 @@ class IStorage(Interface):
         """
 
 
+class IPeerStorage(IStorage):
+    """
+    Storage for announced peers, keyed by info_hash.  Values are lists of
+    (ip, port) tuples.
+    """
+
+    def addPeer(key, peer):
+        """
+        Record an announce of the (ip, port) peer for the given key.
+        """
+
+
 class ForgetfulStorage(object):
     implements(IStorage)
 
-    def __init__(self, ttl=604800):
+    def __init__(self, ttl=604800, sweepInterval=None, sweepBatch=1000, clock=reactor):
         """
         By default, max age is a week.
+
+        Without a sweepInterval every access culls expired items first.  With
+        one, accesses only check the age of the key they touch and a reactor
+        loop drops at most sweepBatch expired items every sweepInterval
+        seconds.  Items are kept in insertion order, so the expired ones are
+        always at the front.
         """
         self.data = OrderedDict()
         self.ttl = ttl
+        self.sweepBatch = sweepBatch
+        self.clock = clock
+        self.sweepLoop = None
+        if sweepInterval is not None:
+            self.sweepLoop = LoopingCall(self.sweep)
+            self.sweepLoop.clock = clock
+            self.sweepLoop.start(sweepInterval, now=False)
 
     def __setitem__(self, key, value):
         if key in self.data:
             del self.data[key]
-        self.data[key] = (time.time(), value)
-        self.cull()
+        self.data[key] = (self.clock.seconds(), value)
+        self._cullOnAccess()
 
     def cull(self):
-        for k, v in self.iteritemsOlderThan(self.ttl):
+        minBirthday = self.clock.seconds() - self.ttl
+        while self.data and minBirthday >= next(self.data.itervalues())[0]:
             self.data.popitem(last=False)
 
+    def sweep(self):
+        """
+        Drop up to sweepBatch expired items.
+        """
+        minBirthday = self.clock.seconds() - self.ttl
+        for _ in xrange(self.sweepBatch):
+            if not self.data or minBirthday < next(self.data.itervalues())[0]:
+                break
+            self.data.popitem(last=False)
+
+    def _cullOnAccess(self):
+        if self.sweepLoop is None:
+            self.cull()
+
     def get(self, key, default=None):
-        self.cull()
-        if key in self.data:
-            return self[key]
-        return default
+        self._cullOnAccess()
+        item = self.data.get(key)
+        if item is None or item[0] <= self.clock.seconds() - self.ttl:
+            return default
+        return item[1]
 
     def __getitem__(self, key):
-        self.cull()
-        return self.data[key][1]
+        self._cullOnAccess()
+        birthday, value = self.data[key]
+        if birthday <= self.clock.seconds() - self.ttl:
+            raise KeyError(key)
+        return value
 
     def __iter__(self):
-        self.cull()
-        return iter(self.data)
+        self._cullOnAccess()
+        return imap(operator.itemgetter(0), self._iterLive())
 
     def __repr__(self):
-        self.cull()
-        return repr(self.data)
+        self._cullOnAccess()
+        return repr(OrderedDict(self._iterLive()))
+
+    def _iterLive(self):
+        minBirthday = self.clock.seconds() - self.ttl
+        live = dropwhile(lambda r: minBirthday >= r[1], self._tripleIterable())
+        return imap(operator.itemgetter(0, 2), live)
 
     def iteritemsOlderThan(self, secondsOld):
-        minBirthday = time.time() - secondsOld
-        zipped = self._tripleIterable()
-        matches = takewhile(lambda r: minBirthday >= r[1], zipped)
+        now = self.clock.seconds()
+        minBirthday = now - secondsOld
+        expiredBirthday = now - self.ttl
+        live = dropwhile(lambda r: expiredBirthday >= r[1], self._tripleIterable())
+        matches = takewhile(lambda r: minBirthday >= r[1], live)
         return imap(operator.itemgetter(0, 2), matches)
 
     def _tripleIterable(self):
@@ -91,7 +144,110 @@ class ForgetfulStorage(object):
         return izip(ikeys, ibirthday, ivalues)
 
     def iteritems(self):
+        self._cullOnAccess()
+        return self._iterLive()
+
+
+class PeerStorage(object):
+    implements(IPeerStorage)
+
+    def __init__(self, ttl=1800, maxPeers=100, maxKeys=10000, clock=reactor):
+        """
+        Peers expire individually once they haven't re-announced for ttl
+        seconds (30 minutes by default).  At most maxPeers peers are kept per
+        key and at most maxKeys keys overall; the least recently announced
+        entry is dropped to make room.
+        """
+        # key -> OrderedDict((ip, port) -> announce time), both levels
+        # ordered from least to most recently announced
+        self.data = OrderedDict()
+        self.ttl = ttl
+        self.maxPeers = maxPeers
+        self.maxKeys = maxKeys
+        self.clock = clock
+
+    def addPeer(self, key, peer):
+        now = self.clock.seconds()
+        peers = self.data.pop(key, None)
+        if peers is None:
+            peers = OrderedDict()
+        elif peer in peers:
+            del peers[peer]
+        peers[peer] = now
+        while len(peers) > self.maxPeers:
+            peers.popitem(last=False)
+        self.data[key] = peers
         self.cull()
-        ikeys = self.data.iterkeys()
-        ivalues = imap(operator.itemgetter(1), self.data.itervalues())
-        return izip(ikeys, ivalues)
+
+    def __setitem__(self, key, value):
+        now = self.clock.seconds()
+        peers = OrderedDict((peer, now) for peer in value)
+        while len(peers) > self.maxPeers:
+            peers.popitem(last=False)
+        if key in self.data:
+            del self.data[key]
+        if peers:
+            self.data[key] = peers
+        self.cull()
+
+    def cull(self):
+        """
+        Drop keys that only hold expired peers, and the least recently
+        announced keys beyond maxKeys.
+        """
+        minBirthday = self.clock.seconds() - self.ttl
+        while self.data:
+            key, peers = next(self.data.iteritems())
+            if len(self.data) <= self.maxKeys and peers[next(reversed(peers))] > minBirthday:
+                break
+            del self.data[key]
+
+    def _livePeers(self, key):
+        peers = self.data.get(key)
+        if peers is None:
+            return None
+
+        minBirthday = self.clock.seconds() - self.ttl
+        while peers and next(peers.itervalues()) <= minBirthday:
+            peers.popitem(last=False)
+        if not peers:
+            del self.data[key]
+            return None
+        return peers.keys()
+
+    def get(self, key, default=None):
+        peers = self._livePeers(key)
+        return default if peers is None else peers
+
+    def __getitem__(self, key):
+        peers = self._livePeers(key)
+        if peers is None:
+            raise KeyError(key)
+        return peers
+
+    def __iter__(self):
+        self.cull()
+        return iter(self.data.keys())
+
+    def __repr__(self):
+        self.cull()
+        return repr(self.data)
+
+    def iteritemsOlderThan(self, secondsOld):
+        """
+        Yield (key, peers) for every key, listing only the live peers that
+        were last announced at least secondsOld seconds ago.
+        """
+        now = self.clock.seconds()
+        minBirthday = now - self.ttl
+        maxBirthday = now - secondsOld
+        for key, peers in self.data.items():
+            old = [peer for peer, birthday in peers.iteritems() if minBirthday < birthday <= maxBirthday]
+            if old:
+                yield key, old
+
+    def iteritems(self):
+        for key in list(self):
+            peers = self.get(key)
+            if peers is not None:
+                yield key, peers
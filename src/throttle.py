@@ -0,0 +1,86 @@
+"""
+Inbound rate limiting and load shedding.
+"""
+import time
+from collections import OrderedDict
+
+# query priorities, highest first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class InboundThrottle(object):
+    """
+    Decides which inbound datagrams get processed.
+
+    Every source ip gets a token bucket of sourceBurst datagrams refilled at
+    sourceRate per second; the buckets live in an LRU table of at most
+    maxSources entries, so a source that falls out of it simply starts
+    over with a full bucket.  This check runs before the datagram is
+    decoded.
+
+    When maxQueryRate is set, all queries also share a global bucket of one
+    second's worth of queries.  High priority queries are always answered,
+    normal ones need a token, and low priority ones are only answered while
+    the bucket is at least lowPriorityShare full, so they are shed first as
+    load rises.  Responses to our own queries never go through it.
+    """
+
+    def __init__(self, sourceRate=50, sourceBurst=100, maxSources=65536,
+                 maxQueryRate=None, lowPriorityShare=0.5):
+        self.sourceRate = sourceRate
+        self.sourceBurst = sourceBurst
+        self.maxSources = maxSources
+        # ip -> (tokens, last update), least recently seen first
+        self.sources = OrderedDict()
+
+        self.maxQueryRate = maxQueryRate
+        if maxQueryRate is not None:
+            self.lowPriorityFloor = maxQueryRate * lowPriorityShare
+            self.queryTokens = float(maxQueryRate)
+            self.queryStamp = time.time()
+
+        # dropped datagrams, by reason
+        self.dropped = {"source": 0, "normal": 0, "low": 0}
+
+    def allowSource(self, ip):
+        now = time.time()
+        entry = self.sources.pop(ip, None)
+        if entry is None:
+            tokens = self.sourceBurst
+        else:
+            tokens = min(self.sourceBurst, entry[0] + (now - entry[1]) * self.sourceRate)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        else:
+            self.dropped["source"] += 1
+
+        self.sources[ip] = (tokens, now)
+        if len(self.sources) > self.maxSources:
+            self.sources.popitem(last=False)
+        return allowed
+
+    def allowQuery(self, priority):
+        if self.maxQueryRate is None:
+            return True
+
+        now = time.time()
+        tokens = min(self.maxQueryRate, self.queryTokens + (now - self.queryStamp) * self.maxQueryRate)
+        self.queryStamp = now
+
+        if priority == PRIORITY_HIGH:
+            allowed = True
+        elif priority == PRIORITY_NORMAL:
+            allowed = tokens >= 1
+        else:
+            allowed = tokens >= self.lowPriorityFloor
+
+        if allowed:
+            self.queryTokens = max(0.0, tokens - 1)
+        else:
+            self.queryTokens = tokens
+            self.dropped["normal" if priority == PRIORITY_NORMAL else "low"] += 1
+        return allowed
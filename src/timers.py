@@ -0,0 +1,95 @@
+"""
+Coarse timers for large numbers of short-lived deadlines.
+"""
+import math
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+
+class WheelCall(object):
+    """
+    A call scheduled on a L{TimerWheel}.  Like a Twisted C{DelayedCall} it
+    can be cancelled until it fires.
+    """
+    __slots__ = ('f', 'args', 'cancelled', 'called')
+
+    def __init__(self, f, args):
+        self.f = f
+        self.args = args
+        self.cancelled = False
+        self.called = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+
+class TimerWheel(object):
+    """
+    Groups deadlines into slots of resolution seconds and fires each slot
+    from a single periodic sweep, instead of putting one C{DelayedCall}
+    per deadline on the reactor's timed-call heap.
+
+    Calls fire at most resolution seconds late and never early.  Cancelled
+    calls stay in their slot until it is swept.  The sweep only runs while
+    there are slots pending.
+    """
+
+    def __init__(self, resolution=0.5, clock=reactor):
+        self.resolution = resolution
+        self.clock = clock
+        # slot number -> [WheelCall]
+        self.slots = {}
+        self.lastSwept = int(clock.seconds() / resolution)
+        self.sweepLoop = None
+
+    def callLater(self, delay, f, *args):
+        call = WheelCall(f, args)
+        slot = int(math.ceil((self.clock.seconds() + delay) / self.resolution))
+        slot = max(slot, self.lastSwept + 1)
+        calls = self.slots.get(slot)
+        if calls is None:
+            self.slots[slot] = [call]
+        else:
+            calls.append(call)
+
+        if self.sweepLoop is None:
+            self.sweepLoop = LoopingCall(self.sweep)
+            self.sweepLoop.clock = self.clock
+            self.sweepLoop.start(self.resolution, now=False).addErrback(self._sweepFailed, self.sweepLoop)
+        return call
+
+    def sweep(self):
+        now = int(self.clock.seconds() / self.resolution)
+        if now - self.lastSwept > len(self.slots):
+            # after a long pause, visit the pending slots rather than every tick
+            due = sorted(slot for slot in self.slots if slot <= now)
+        else:
+            due = xrange(self.lastSwept + 1, now + 1)
+        self.lastSwept = max(now, self.lastSwept)
+
+        for slot in due:
+            for call in self.slots.pop(slot, ()):
+                if not call.cancelled:
+                    call.called = True
+                    try:
+                        call.f(*call.args)
+                    except:
+                        log.err(None, "timer callback failed")
+
+        if not self.slots and self.sweepLoop is not None:
+            self.sweepLoop.stop()
+            self.sweepLoop = None
+
+    def _sweepFailed(self, failure, loop):
+        # the loop has stopped; let the next callLater start a new one
+        if self.sweepLoop is loop:
+            self.sweepLoop = None
+        log.err(failure, "timer wheel sweep failed")
+
+    def __len__(self):
+        return sum(len(calls) for calls in self.slots.itervalues())
@@ -5,13 +5,18 @@ import hashlib
 import operator
 import socket
 import struct
-import math
-import datetime
+import os
+import random
+from hmac import compare_digest
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
 from uuid import uuid4
 
-token_salt = uuid4().bytes
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class OrderedSet(list):
@@ -35,64 +40,191 @@ def sha1(s):
     return hashlib.sha1(s).digest()
 
 
-def ceil_dt(dt):
-    nsecs = dt.minute * 60 + dt.second + dt.microsecond * 1e-6
-    delta = math.ceil(nsecs / 300) * 300 - nsecs
-    return dt + datetime.timedelta(seconds=delta)
-
-
 def generate_node_id():
     return sha1(uuid4().bytes)
 
 
-def generate_token(ip, port):
-    return sha1(token_salt + str(ceil_dt(datetime.datetime.now())) + ip + str(port))
+def is_node_id(value):
+    """
+    Is value a raw 20 byte node id?
+    """
+    return isinstance(value, str) and len(value) == 20
 
 
-def verify_token(ip, port, token):
-    return generate_token(ip, port) == token
+def random_node_id(lower=0, upper=2 ** 160 - 1):
+    """
+    A random 20 byte id whose numeric value is in [lower, upper].
+    """
+    return ("%040x" % random.randint(lower, upper)).decode("hex")
 
 
-def decode_nodes(message):
-    result = []
-    if len(message) % 26 != 0:
-        return result
+def spread_node_ids(count):
+    """
+    One random id in each of count equal slices of the keyspace, in order.
+    The id for any key is then spread_node_ids(count)[long_key * count >> 160].
+    """
+    space = 2 ** 160
+    return [random_node_id(i * space / count, (i + 1) * space / count - 1) for i in range(count)]
 
-    for i in range(0, len(message), 26):
-        node_id = message[i: i + 20]
 
-        try:
-            ip = socket.inet_ntoa(message[i + 20: i + 24])  # from network order to IP address
-            port = struct.unpack("!H", message[i + 24: i + 26])[0]  # "!" means to read by network order
-        except:
-            continue
+class TokenManager(object):
+    """
+    Hands out the tokens that get_peers answers carry and announce_peer
+    requests must echo back.
+
+    A token is a truncated SHA-1 of a random secret followed by the
+    requester's address.  The secret is rotated every interval seconds and
+    tokens made with the previous secret are still accepted, so a token is
+    valid for at least one full interval.  The secret is fed into a hash
+    object once per rotation and copied for every token.
+    """
 
-        result.append([node_id, ip, port])
+    def __init__(self, interval=300, size=8, clock=reactor):
+        self.interval = interval
+        self.size = size
+        self.clock = clock
+        self.current = self._keyedHash()
+        self.previous = self.current
+        self.rotateLoop = None
 
-    return result
+    @staticmethod
+    def _keyedHash():
+        return hashlib.sha1(os.urandom(20))
+
+    def rotate(self):
+        self.previous = self.current
+        self.current = self._keyedHash()
+
+    def start(self):
+        if self.rotateLoop is None:
+            self.rotateLoop = LoopingCall(self.rotate)
+            self.rotateLoop.clock = self.clock
+            self.rotateLoop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.rotateLoop is not None:
+            self.rotateLoop.stop()
+            self.rotateLoop = None
+
+    def _token(self, keyed, ip, port):
+        h = keyed.copy()
+        h.update("%s:%d" % (ip, port))
+        return h.digest()[:self.size]
+
+    def generate(self, ip, port):
+        return self._token(self.current, ip, port)
+
+    def verify(self, ip, port, token):
+        if not isinstance(token, str):
+            return False
+        return (compare_digest(self._token(self.current, ip, port), token) or
+                compare_digest(self._token(self.previous, ip, port), token))
+
+
+# compact node info: 20 byte id followed by the compact peer info below
+NODE_SIZE = 26
+
+# compact peer info: ip address and port in network order
+PEER_SIZE = 6
+peer_struct = struct.Struct("!4sH")
+
+# whole compact node strings of up to this many records are unpacked with a
+# single precompiled struct; longer ones fall back to unpack_from per record
+MAX_BATCH_STRUCT = 256
+_node_batch_structs = {}
+
+# numpy is only needed for the *_array codecs
+if numpy is not None:
+    NODE_DTYPE = numpy.dtype([("id", "V20"), ("ip", "u1", 4), ("port", ">u2")])
+    PEER_DTYPE = numpy.dtype([("ip", "u1", 4), ("port", ">u2")])
+
+
+def _node_batch_struct(count):
+    batch = _node_batch_structs.get(count)
+    if batch is None:
+        batch = _node_batch_structs[count] = struct.Struct("!" + "20s4sH" * count)
+    return batch
+
+
+def decode_nodes(message):
+    if len(message) % NODE_SIZE != 0:
+        return []
+
+    count = len(message) / NODE_SIZE
+    if count <= MAX_BATCH_STRUCT:
+        fields = _node_batch_struct(count).unpack(message)
+    else:
+        fields = []
+        unpack_from = _node_batch_struct(1).unpack_from
+        for offset in xrange(0, len(message), NODE_SIZE):
+            fields.extend(unpack_from(message, offset))
+
+    inet_ntoa = socket.inet_ntoa
+    # port 0 can't be sent to, so such contacts are useless
+    return [[fields[i], inet_ntoa(fields[i + 1]), fields[i + 2]] for i in xrange(0, len(fields), 3)
+            if fields[i + 2]]
 
 
 def decode_values(values):
-    return map(lambda value: (socket.inet_ntoa(value[:4]),
-                              struct.unpack("!H", value[4: 6])[0]), values)
+    unpack = peer_struct.unpack
+    inet_ntoa = socket.inet_ntoa
+    result = []
+    for value in values:
+        if len(value) == PEER_SIZE:
+            ip, port = unpack(value)
+            result.append((inet_ntoa(ip), port))
+    return result
 
 
 def encode_values(values):
-    return map(lambda value: socket.inet_aton(value[0] + struct.pack("!H", value[1])), values)
+    pack = peer_struct.pack
+    inet_aton = socket.inet_aton
+    result = []
+    for ip, port in values:
+        try:
+            result.append(pack(inet_aton(ip), port))
+        except (socket.error, struct.error, TypeError):
+            continue  # not an IPv4 address and port
+    return result
 
 
 def encode_nodes(nodes):
-    result = ""
+    pack = peer_struct.pack
+    inet_aton = socket.inet_aton
+    result = []
     for node in nodes:
         try:
-            ip_message = socket.inet_aton(node.ip)
-            port_message = struct.pack("!H", node.port)
-        except:
-            continue  # from IP address to network order
+            packed = pack(inet_aton(node.ip), node.port)
+        except (socket.error, struct.error, TypeError):
+            continue  # not an IPv4 address and port
+        result.append(node.id)
+        result.append(packed)
 
-        result = result + node.id + ip_message + port_message
+    return "".join(result)
 
-    return result
+
+def decode_nodes_array(message):
+    """
+    Decode a compact node string into a numpy array of L{NODE_DTYPE}
+    records without creating a Python object per node.  The array is a
+    read-only view over the message.
+    """
+    if numpy is None:
+        raise ImportError("numpy is required for array decoding")
+    if len(message) % NODE_SIZE != 0:
+        return numpy.empty(0, NODE_DTYPE)
+    return numpy.frombuffer(message, NODE_DTYPE)
+
+
+def decode_values_array(values):
+    """
+    Decode a list of compact peer strings into a numpy array of
+    L{PEER_DTYPE} records, skipping malformed entries.
+    """
+    if numpy is None:
+        raise ImportError("numpy is required for array decoding")
+    packed = "".join(value for value in values if len(value) == PEER_SIZE)
+    return numpy.frombuffer(packed, PEER_DTYPE)
 
 
 def deferred_dict(d):
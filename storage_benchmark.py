@@ -0,0 +1,100 @@
+"""
+Throughput of ForgetfulStorage with a large number of stored keys.
+
+Fills each storage with 1M keys and then runs a get_peers/announce_peer
+style mix of reads, misses and writes against it, comparing the legacy
+cull-on-every-access storage, the current cull mode and the swept mode.
+
+    python storage_benchmark.py [keys] [ops]
+"""
+import operator
+import os
+import random
+import sys
+import time
+from collections import OrderedDict
+from itertools import imap, izip, takewhile
+
+from src.storage import ForgetfulStorage
+
+
+class LegacyForgetfulStorage(object):
+    def __init__(self, ttl=604800):
+        self.data = OrderedDict()
+        self.ttl = ttl
+
+    def __setitem__(self, key, value):
+        if key in self.data:
+            del self.data[key]
+        self.data[key] = (time.time(), value)
+        self.cull()
+
+    def cull(self):
+        for k, v in self.iteritemsOlderThan(self.ttl):
+            self.data.popitem(last=False)
+
+    def get(self, key, default=None):
+        self.cull()
+        if key in self.data:
+            return self[key]
+        return default
+
+    def __getitem__(self, key):
+        self.cull()
+        return self.data[key][1]
+
+    def iteritemsOlderThan(self, secondsOld):
+        minBirthday = time.time() - secondsOld
+        zipped = self._tripleIterable()
+        matches = takewhile(lambda r: minBirthday >= r[1], zipped)
+        return imap(operator.itemgetter(0, 2), matches)
+
+    def _tripleIterable(self):
+        ikeys = self.data.iterkeys()
+        ibirthday = imap(operator.itemgetter(0), self.data.itervalues())
+        ivalues = imap(operator.itemgetter(1), self.data.itervalues())
+        return izip(ikeys, ibirthday, ivalues)
+
+
+def run(storage, keys, ops):
+    for key in keys:
+        storage[key] = [("10.0.0.1", 6881)]
+
+    workload = []
+    for i in xrange(ops):
+        roll = random.random()
+        if roll < 0.6:
+            workload.append((0, random.choice(keys)))
+        elif roll < 0.8:
+            workload.append((0, os.urandom(20)))
+        else:
+            workload.append((1, random.choice(keys)))
+
+    started = time.time()
+    for write, key in workload:
+        if write:
+            storage[key] = [("10.0.0.2", 6881)]
+        else:
+            storage.get(key)
+    return ops / (time.time() - started)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    ops = int(sys.argv[2]) if len(sys.argv) > 2 else 500000
+    keys = [os.urandom(20) for _ in xrange(count)]
+
+    variants = [
+        ("legacy", lambda: LegacyForgetfulStorage(ttl=3600)),
+        ("cull", lambda: ForgetfulStorage(ttl=3600)),
+        ("swept", lambda: ForgetfulStorage(ttl=3600, sweepInterval=1)),
+    ]
+
+    print "%d keys, %d ops" % (count, ops)
+    print "%-8s %12s" % ("mode", "ops/sec")
+    for name, factory in variants:
+        print "%-8s %12.0f" % (name, run(factory(), keys, ops))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import os
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from src.crawling import NodeSpiderCrawl, RPCFindResponse, SLOTS, ROUNDS
+from src.node import Node
+from src.protocol import KademliaProtocol
+from src.storage import PeerStorage
+from src.timers import TimerWheel
+
+
+class SpiderCrawlTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = KademliaProtocol(Node(os.urandom(20)), PeerStorage(), 8)
+        self.protocol.timeouts = TimerWheel(0.1, Clock())
+        self.peers = [Node(os.urandom(20), "10.0.0.%d" % i, 6881) for i in range(1, 5)]
+        self.pending = []
+        self.protocol.callFindNode = self.callFindNode
+
+    def callFindNode(self, nodeToAsk, nodeToFind, priority):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    def crawl(self, mode):
+        spider = NodeSpiderCrawl(self.protocol, Node(os.urandom(20)), self.peers, 8, 3, mode)
+        return spider, spider.find()
+
+    def answerAll(self, response):
+        while self.pending:
+            self.pending.pop(0).callback(response)
+
+    def test_missingNodes(self):
+        """
+        An answer without "nodes", like a nodes6-only one, adds nothing but
+        doesn't stop the lookup.
+        """
+        for mode in (ROUNDS, SLOTS):
+            del self.pending[:]
+            _, d = self.crawl(mode)
+            self.answerAll((True, {"id": "x" * 20, "nodes6": ""}))
+            self.assertEqual(sorted(node.id for node in self.successResultOf(d)),
+                             sorted(peer.id for peer in self.peers))
+
+    def test_malformedAnswer(self):
+        """
+        A peer whose answer isn't a dictionary counts as failed.
+        """
+        for mode in (ROUNDS, SLOTS):
+            del self.pending[:]
+            _, d = self.crawl(mode)
+            self.pending.pop(0).callback((True, ["x"]))
+            self.answerAll((True, {"nodes": 5}))
+            self.assertEqual(len(self.successResultOf(d)), len(self.peers) - 1)
+
+    def test_ownErrorFailsSlots(self):
+        """
+        An error handling an answer fails a SLOTS lookup instead of leaving
+        it waiting forever, and later answers are dropped quietly.
+        """
+        spider, d = self.crawl(SLOTS)
+
+        def fail(peerid, response):
+            raise RuntimeError("boom")
+        spider._handleResponse = fail
+        self.pending[0].callback((True, {"nodes": ""}))
+        self.failureResultOf(d, RuntimeError)
+        # the other two queries are still out, and no new ones were sent
+        self.assertEqual(len(spider.inflight), 2)
+        self.assertEqual(len(self.pending), 3)
+
+        for pending in self.pending[1:]:
+            pending.callback((False, None))
+        self.assertEqual(spider.inflight, {})
+
+    def test_slotsFinish(self):
+        _, d = self.crawl(SLOTS)
+        self.answerAll((True, {"nodes": ""}))
+        self.assertEqual(sorted(node.id for node in self.successResultOf(d)),
+                         sorted(peer.id for peer in self.peers))
+
+
+class RPCFindResponseTest(unittest.TestCase):
+    def test_values(self):
+        response = RPCFindResponse((True, {"values": [5, "\x0a\x00\x00\x01\x1a\xe1", "short"]}))
+        self.assertTrue(response.hasValues())
+        self.assertEqual(response.getValues(), [("10.0.0.1", 6881)])
+
+    def test_malformed(self):
+        self.assertFalse(RPCFindResponse((True, "x")).happened())
+        self.assertFalse(RPCFindResponse((False, None)).happened())
+        response = RPCFindResponse((True, {"values": 5, "nodes": ["x"]}))
+        self.assertFalse(response.hasValues())
+        self.assertEqual(response.getNodeList(), [])
@@ -0,0 +1,145 @@
+import errno
+import socket
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from src.egress import EgressQueue, RESPONSE, LOOKUP, MAINTENANCE
+
+
+class RecordingTransport(object):
+    def __init__(self):
+        self.written = []
+        self.refuse = set()
+
+    def write(self, data, address):
+        if address in self.refuse:
+            raise socket.error(errno.EINVAL, "Invalid argument")
+        self.written.append((data, address))
+
+
+class FakeProtocol(object):
+    def __init__(self):
+        self.transport = RecordingTransport()
+
+
+class EgressQueueTest(unittest.TestCase):
+    address = ("10.0.0.1", 6881)
+
+    def setUp(self):
+        self.clock = Clock()
+        self.protocol = FakeProtocol()
+        self.sent = []
+
+    def queue(self, **kwargs):
+        return EgressQueue(self.protocol, clock=self.clock, **kwargs)
+
+    def onSent(self, sent, name):
+        self.sent.append((name, sent))
+
+    def written(self):
+        return [data for data, _ in self.protocol.transport.written]
+
+    def test_uncapped(self):
+        egress = self.queue()
+        self.assertTrue(egress.write("a", self.address, MAINTENANCE, self.onSent, "a"))
+        self.assertEqual(self.written(), ["a"])
+        self.assertEqual(self.sent, [("a", True)])
+        self.assertEqual(egress.depth(), {"response": 0, "lookup": 0, "maintenance": 0})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_writeFails(self):
+        """
+        A datagram the port refuses is counted as failed and reported to
+        onSent, and the queue carries on.
+        """
+        egress = self.queue()
+        self.protocol.transport.refuse.add(("10.0.0.2", 0))
+        self.assertFalse(egress.write("a", ("10.0.0.2", 0), LOOKUP, self.onSent, "a"))
+        self.assertTrue(egress.write("b", self.address, LOOKUP, self.onSent, "b"))
+        self.assertEqual(self.sent, [("a", False), ("b", True)])
+        self.assertEqual(egress.stats()["lookup"]["failed"], 1)
+        self.assertEqual(egress.stats()["lookup"]["sent"], 1)
+        self.assertEqual(len(self.flushLoggedErrors(socket.error)), 1)
+
+    def test_packetRate(self):
+        """
+        Past the burst, datagrams wait and go out at packetRate, higher
+        classes first.
+        """
+        egress = self.queue(packetRate=2, burst=1.0)
+        egress.write("r0", self.address, RESPONSE)
+        egress.write("r1", self.address, RESPONSE)
+        egress.write("m0", self.address, MAINTENANCE, self.onSent, "m0")
+        egress.write("l0", self.address, LOOKUP, self.onSent, "l0")
+        egress.write("r2", self.address, RESPONSE)
+        self.assertEqual(self.written(), ["r0", "r1"])
+        self.assertEqual(egress.depth(), {"response": 1, "lookup": 1, "maintenance": 1})
+
+        self.clock.advance(0.5)
+        self.assertEqual(self.written(), ["r0", "r1", "r2"])
+        self.clock.advance(0.5)
+        self.assertEqual(self.written()[3:], ["l0"])
+        self.assertEqual(self.sent, [("l0", True)])
+        self.clock.advance(0.5)
+        self.assertEqual(self.written()[4:], ["m0"])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        stats = egress.stats()
+        self.assertEqual(stats["maintenance"]["sent"], 1)
+        self.assertAlmostEqual(stats["maintenance"]["maxWait"], 1.5)
+        self.assertAlmostEqual(stats["lookup"]["meanWait"], 1.0)
+        self.assertAlmostEqual(stats["response"]["meanWait"], 0.5 / 3)
+
+    def test_byteRate(self):
+        egress = self.queue(byteRate=100, burst=1.0)
+        egress.write("x" * 60, self.address, LOOKUP)
+        egress.write("y" * 60, self.address, LOOKUP)
+        self.assertEqual(len(self.written()), 1)
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.written()), 1)
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.written()), 2)
+
+    def test_oversized(self):
+        """
+        A datagram bigger than the whole bucket goes out once it is full.
+        """
+        egress = self.queue(byteRate=100, burst=1.0)
+        egress.write("x" * 50, self.address, LOOKUP)
+        egress.write("y" * 500, self.address, LOOKUP)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.written()), 2)
+
+    def test_maxQueued(self):
+        egress = self.queue(packetRate=1, burst=1.0, maxQueued=2)
+        for name in ("a", "b", "c", "d"):
+            egress.write(name, self.address, LOOKUP, self.onSent, name)
+        self.assertEqual(self.sent, [("a", True), ("d", False)])
+        self.assertEqual(egress.stats()["lookup"]["dropped"], 1)
+        self.clock.pump([1, 1])
+        self.assertEqual(self.written(), ["a", "b", "c"])
+
+    def test_drainSurvivesFailure(self):
+        """
+        A queued datagram the port refuses doesn't hold up the rest.
+        """
+        egress = self.queue(packetRate=10, burst=0.1)
+        self.protocol.transport.refuse.add(("10.0.0.2", 0))
+        egress.write("a", self.address, LOOKUP)
+        egress.write("b", ("10.0.0.2", 0), LOOKUP, self.onSent, "b")
+        egress.write("c", self.address, LOOKUP, self.onSent, "c")
+        self.clock.advance(0.1)
+        self.clock.advance(0.1)
+        self.assertEqual(self.written(), ["a", "c"])
+        self.assertEqual(self.sent, [("b", False), ("c", True)])
+        self.assertEqual(egress.depth()["lookup"], 0)
+        self.flushLoggedErrors(socket.error)
+
+    def test_transportGone(self):
+        egress = self.queue(packetRate=1, burst=1.0)
+        egress.write("a", self.address, LOOKUP)
+        egress.write("b", self.address, LOOKUP, self.onSent, "b")
+        self.protocol.transport = None
+        self.clock.advance(1)
+        self.assertEqual(self.sent, [("b", True)])
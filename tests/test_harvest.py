@@ -0,0 +1,57 @@
+import os
+
+from bencode import bdecode, bencode
+from twisted.trial import unittest
+
+from src.harvest import Harvester, HarvestQueue, GET_PEERS
+from src.node import Node
+from src.utils import encode_nodes
+
+
+class RecordingTransport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data, address):
+        self.written.append((bdecode(data), address))
+
+
+class HarvesterTest(unittest.TestCase):
+    address = ("10.0.0.1", 6881)
+
+    def setUp(self):
+        self.sink = HarvestQueue()
+        self.harvester = Harvester(count=4, sink=self.sink)
+        self.harvester.transport = self.transport = RecordingTransport()
+
+    def receive(self, message):
+        self.harvester.datagramReceived(bencode(message), self.address)
+
+    def test_getPeersRecorded(self):
+        infoHash = os.urandom(20)
+        self.receive({"t": "aa", "y": "q", "q": GET_PEERS, "a": {"id": os.urandom(20), "info_hash": infoHash}})
+        self.assertEqual(len(self.transport.written), 1)
+        response = self.transport.written[0][0]
+        self.assertEqual(response["r"]["id"], self.harvester.idFor(infoHash))
+        self.assertEqual(self.harvester.harvested, 1)
+        self.assertEqual(len(self.sink), 1)
+
+    def test_responseNodesPooled(self):
+        nodes = [Node(os.urandom(20), "10.0.0.%d" % i, 6881) for i in range(1, 4)]
+        self.receive({"t": "aa", "y": "r", "r": {"id": os.urandom(20), "nodes": encode_nodes(nodes)}})
+        self.assertEqual([nodeId for nodeId, _, _ in self.harvester.pool], [node.id for node in nodes])
+
+    def test_malformedIgnored(self):
+        """
+        Datagrams of the wrong shape are dropped without an exception.
+        """
+        for message in ({"t": "aa", "y": "r", "r": ["x"]},
+                        {"t": "aa", "y": "r", "r": "x"},
+                        {"t": "aa", "y": "r", "r": {"nodes": 5}},
+                        {"t": "aa", "y": "q", "q": GET_PEERS, "a": ["x"]},
+                        {"t": "aa", "y": "q", "q": GET_PEERS, "a": "x"},
+                        {"t": "aa", "y": "q", "q": GET_PEERS, "a": {"id": "x", "info_hash": 5}}):
+            self.receive(message)
+        self.harvester.datagramReceived("d1:y", self.address)
+        self.assertEqual(list(self.harvester.pool), [])
+        self.assertEqual(self.harvester.harvested, 0)
@@ -0,0 +1,138 @@
+import os
+import random
+
+from bencode import bencode
+from twisted.trial import unittest
+
+from src.krpc import KRPCCodec, DecodeError, MAX_DATAGRAM_SIZE, decode, encode, encodeError
+
+
+class DecodeTest(unittest.TestCase):
+    def assertRoundTrips(self, message):
+        self.assertEqual(decode(bencode(message)), message)
+
+    def test_query(self):
+        self.assertRoundTrips({"t": "aa", "y": "q", "q": "get_peers",
+                               "a": {"id": os.urandom(20), "info_hash": os.urandom(20)}})
+
+    def test_announce(self):
+        self.assertRoundTrips({"t": "\x00\xff", "y": "q", "q": "announce_peer", "v": "LT\x01\x00",
+                               "a": {"id": os.urandom(20), "info_hash": os.urandom(20), "port": 6881,
+                                     "implied_port": 1, "token": os.urandom(8)}})
+
+    def test_response(self):
+        self.assertRoundTrips({"t": "aa", "y": "r", "ip": os.urandom(6),
+                               "r": {"id": os.urandom(20), "token": "x" * 8, "nodes": os.urandom(26 * 8),
+                                     "values": [os.urandom(6) for _ in range(30)]}})
+
+    def test_error(self):
+        self.assertRoundTrips({"t": "aa", "y": "e", "e": [201, "A Generic Error Ocurred"]})
+
+    def test_longStrings(self):
+        """
+        Strings with lengths of three or more digits, and of zero.
+        """
+        self.assertRoundTrips({"t": "", "y": "r", "r": {"id": "x" * 20, "nodes": "n" * 260, "token": ""}})
+
+    def test_integers(self):
+        self.assertEqual(decode("d1:ti-12e1:yi0ee"), {"t": -12, "y": 0})
+
+    def test_mixedList(self):
+        self.assertRoundTrips({"t": "aa", "y": "q", "a": {"want": ["n4", 6, ["x"]]}})
+
+    def test_unknownKeysDropped(self):
+        message = {"t": "aa", "y": "q", "q": "ping", "zz": {"deep": [1, {"x": "y"}]}, "b": 5,
+                   "a": {"id": "x" * 20, "extra": ["a", 1], "more": {"k": "v"}}}
+        self.assertEqual(decode(bencode(message)), {"t": "aa", "y": "q", "q": "ping", "a": {"id": "x" * 20}})
+
+    def test_nestedArgumentsKept(self):
+        """
+        Only the top level "a" and "r" dictionaries are filtered.
+        """
+        message = {"t": "aa", "y": "r", "r": {"id": "x" * 20, "values": [{"odd": "entry"}]}}
+        self.assertRoundTrips(message)
+
+    def test_truncated(self):
+        datagram = bencode({"t": "aa", "y": "r", "r": {"id": "x" * 20, "nodes": "n" * 208, "token": "abc"}})
+        for end in range(len(datagram)):
+            self.assertRaises(DecodeError, decode, datagram[:end])
+
+    def test_trailingData(self):
+        self.assertRaises(DecodeError, decode, bencode({"t": "aa", "y": "q"}) + "x")
+        self.assertRaises(DecodeError, decode, bencode({"t": "aa", "y": "q"}) + "de")
+
+    def test_negativeLength(self):
+        for datagram in ("d1:t-1:ae", "d1:t-12:ae", "d-1:t1:ae", "d1:ad2:id-20:xee", "d1:vl-1:aee",
+                         "d1:vd-123:xee"):
+            self.assertRaises(DecodeError, decode, datagram)
+
+    def test_malformed(self):
+        for datagram in ("", "x", "le", "i1e", "3:abc", "d1:t", "d1:ti1e", "d1:tie", "d1:tix1e",
+                         "d1:tx1:ae", "d1:ad1:xe", "d1:vd1:x:ee", "d12:ae", "d1:t1:a"):
+            self.assertRaises(DecodeError, decode, datagram)
+
+    def test_depth(self):
+        """
+        Values nest up to MAX_DEPTH levels, kept or skipped.
+        """
+        for key in ("v", "zz"):
+            self.assertEqual(len(decode("d%d:%sllleeee" % (len(key), key))), 1 if key == "v" else 0)
+            self.assertRaises(DecodeError, decode, "d%d:%sllllee" % (len(key), key) + "ee")
+        self.assertEqual(decode("d1:ad4:wantlleeee"), {"a": {"want": [[]]}})
+        self.assertRaises(DecodeError, decode, "d1:ad4:wantllleeeee")
+        self.assertRaises(DecodeError, decode, "d1:t" + "l" * 1000 + "e" * 1001)
+
+    def test_corrupted(self):
+        """
+        Corrupted datagrams either decode or raise L{DecodeError}.
+        """
+        rand = random.Random(0)
+        datagram = bencode({"t": "aa", "y": "r", "v": ["a", 1, ["b"]],
+                            "r": {"id": "x" * 20, "nodes": "n" * 26, "values": ["v" * 6] * 2, "token": "tok"}})
+        for _ in range(20000):
+            corrupted = bytearray(datagram)
+            for _ in range(rand.randint(1, 3)):
+                corrupted[rand.randrange(len(corrupted))] = rand.choice("deil:-0123456789x")
+            try:
+                decode(str(corrupted))
+            except DecodeError:
+                pass
+
+    def test_maxSize(self):
+        message = {"t": "aa", "y": "r", "r": {"id": "x" * 20, "nodes": ""}}
+        # "0:" becomes a four digit length and the string
+        message["r"]["nodes"] = "n" * (MAX_DATAGRAM_SIZE - len(bencode(message)) - 3)
+        datagram = bencode(message)
+        self.assertEqual(len(datagram), MAX_DATAGRAM_SIZE)
+        self.assertEqual(decode(datagram), message)
+
+        message["r"]["nodes"] += "n"
+        self.assertRaises(DecodeError, decode, bencode(message))
+
+
+class EncodeTest(unittest.TestCase):
+    def test_matchesBencode(self):
+        for value in ({"t": "aa", "y": "q", "a": {"id": "x" * 20, "port": 6881}},
+                      {"e": [201, "oops"], "nested": [[], {}, [1, "x"]], "big": 2 ** 70, "neg": -3},
+                      [], {}, "", 0):
+            self.assertEqual(encode(value), bencode(value))
+
+    def test_unsupported(self):
+        self.assertRaises(TypeError, encode, {"x": 1.5})
+
+    def test_codec(self):
+        nodeId = os.urandom(20)
+        codec = KRPCCodec(nodeId)
+        query = {"y": "q", "q": "get_peers", "a": {"id": nodeId, "info_hash": os.urandom(20)}}
+        self.assertEqual(codec.encodeQuery("aa", dict(query)), bencode(dict(query, t="aa")))
+
+        for response in ({"y": "r", "r": {"id": nodeId}},
+                         {"y": "r", "r": {"id": nodeId, "token": "abc", "values": ["x" * 6]}},
+                         {"y": "r", "r": {"id": "other" * 4, "nodes": ""}},
+                         {"y": "e", "e": [203, "bad token"]}):
+            self.assertEqual(codec.encodeResponse("\x00\x01", dict(response)), bencode(dict(response, t="\x00\x01")))
+
+    def test_encodeError(self):
+        self.assertEqual(encodeError("aa", 201, "Generic Error"),
+                         bencode({"t": "aa", "y": "e", "e": [201, "Generic Error"]}))
+        self.assertEqual(encodeError(None, 203, "malformed"), bencode({"y": "e", "e": [203, "malformed"]}))
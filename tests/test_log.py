@@ -0,0 +1,40 @@
+from twisted.python import log as twistedLog
+from twisted.trial import unittest
+
+from src import log
+
+
+class LoggerLevelTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(log.set_level, log.get_level())
+        log.set_level(log.INFO)
+        self.events = []
+        twistedLog.addObserver(self.events.append)
+        self.addCleanup(twistedLog.removeObserver, self.events.append)
+
+    def test_setLevelRefreshesCache(self):
+        """
+        Loggers that already cached the level pick up every later change.
+        """
+        logger = log.Logger(system="test")
+        self.assertTrue(logger.enabled(log.INFO))
+        log.set_level(log.WARNING)
+        self.assertFalse(logger.enabled(log.INFO))
+        self.assertTrue(logger.enabled(log.WARNING))
+        log.set_level(log.OFF)
+        self.assertFalse(logger.enabled(log.CRITICAL))
+        log.set_level(log.DEBUG)
+        self.assertTrue(logger.enabled(log.DEBUG))
+
+    def test_dropped(self):
+        """
+        Messages above the level are neither formatted nor emitted.
+        """
+        logger = log.Logger(system="test")
+        logger.info("kept %s", "info")
+        log.set_level(log.WARNING)
+        logger.info("dropped %s", log.lazy(self.fail, "formatted"))
+        logger.warning("kept %s", "warning")
+        self.assertEqual([event["message"] for event in self.events],
+                         [("[INFO] kept info",), ("[WARNING] kept warning",)])
+        self.assertEqual(self.events[0]["system"], "test")
@@ -0,0 +1,66 @@
+import socket
+
+from twisted.internet import protocol
+from twisted.trial import unittest
+
+from src import mmsg
+
+
+class Recorder(protocol.DatagramProtocol):
+    def __init__(self):
+        self.received = []
+        self.refused = 0
+
+    def datagramReceived(self, datagram, address):
+        self.received.append((datagram, address))
+
+    def connectionRefused(self):
+        self.refused += 1
+
+
+class MMsgPortTest(unittest.TestCase):
+    if not mmsg.HAVE_MMSG:
+        skip = "recvmmsg and sendmmsg aren't available"
+
+    def setUp(self):
+        self.protocol = Recorder()
+        self.port = mmsg.listen(0, self.protocol, "127.0.0.1", batchSize=4)
+        self.addCleanup(self.port.stopListening)
+        self.address = ("127.0.0.1", self.port.getHost().port)
+        self.peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.peer.bind(("127.0.0.1", 0))
+        self.peer.settimeout(1)
+        self.addCleanup(self.peer.close)
+
+    def test_read(self):
+        """
+        Every datagram is delivered whole, with its sender, across batches.
+        """
+        self.assertTrue(self.port.batched)
+        datagrams = ["x" * size for size in (1, 0, 100, 8192, 7, 3)]
+        for datagram in datagrams:
+            self.peer.sendto(datagram, self.address)
+        self.port.doRead()
+        self.assertEqual(self.protocol.received, [(datagram, self.peer.getsockname()) for datagram in datagrams])
+        self.assertEqual(self.port.recvCalls, 2)
+
+    def test_write(self):
+        for i in range(6):
+            self.port.write("datagram %d" % i, self.peer.getsockname())
+        self.port.flushCall.cancel()
+        self.port.flush()
+        self.assertEqual([self.peer.recvfrom(100) for _ in range(6)],
+                         [("datagram %d" % i, self.address) for i in range(6)])
+        self.assertEqual(self.port.sendCalls, 2)
+
+    def test_refused(self):
+        """
+        A connected port hears that its peer refused, as a regular one does.
+        """
+        closed = self.peer.getsockname()
+        self.peer.close()
+        self.port.connect(*closed)
+        self.port.write("ping")
+        self.port.doRead()
+        self.assertEqual(self.protocol.refused, 1)
+
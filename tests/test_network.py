@@ -0,0 +1,156 @@
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from src.network import BulkPeerLookup, LookupCache
+from src.node import Node
+from src.storage import PeerStorage
+
+
+class LookupCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = LookupCache(ttl=60, maxKeys=2, clock=self.clock)
+        self.running = []
+
+    def find(self, key):
+        d = defer.Deferred()
+        self.running.append(d)
+        return d
+
+    def test_coalesced(self):
+        """
+        Concurrent lookups of one key share a single run, and each caller
+        gets its own copy of the result.
+        """
+        first = self.cache.lookup("a", self.find, "a")
+        second = self.cache.lookup("a", self.find, "a")
+        self.assertEqual(len(self.running), 1)
+        self.running[0].callback([1])
+        first, second = self.successResultOf(first), self.successResultOf(second)
+        self.assertEqual(first, [1])
+        self.assertEqual(second, [1])
+        self.assertNotIdentical(first, second)
+        self.assertEqual((self.cache.misses, self.cache.coalesced), (1, 1))
+
+    def test_failureShared(self):
+        """
+        A failed lookup fails every caller waiting on it and isn't cached.
+        """
+        first = self.cache.lookup("a", self.find, "a")
+        second = self.cache.lookup("a", self.find, "a")
+        self.running[0].errback(RuntimeError("boom"))
+        self.failureResultOf(first, RuntimeError)
+        self.failureResultOf(second, RuntimeError)
+        self.cache.lookup("a", self.find, "a")
+        self.assertEqual(len(self.running), 2)
+
+    def test_expiry(self):
+        """
+        Found results are served from the cache for ttl seconds.
+        """
+        self.cache.lookup("a", self.find, "a")
+        self.running[0].callback([1])
+        self.clock.advance(59)
+        self.assertEqual(self.successResultOf(self.cache.lookup("a", self.find, "a")), [1])
+        self.assertEqual(self.cache.hits, 1)
+        self.clock.advance(1)
+        self.cache.lookup("a", self.find, "a")
+        self.assertEqual(len(self.running), 2)
+
+    def test_notFoundNotCached(self):
+        self.cache.lookup("a", self.find, "a")
+        self.running[0].callback(None)
+        self.cache.lookup("a", self.find, "a")
+        self.assertEqual(len(self.running), 2)
+
+    def test_bounded(self):
+        for key in "abc":
+            self.cache.put(key, [key])
+        self.assertEqual(list(self.cache.results), ["b", "c"])
+
+
+class FakeServer(object):
+    """
+    Just enough of a :class:`~network.Server` for :class:`BulkPeerLookup`:
+    every lookup asks four nodes and answers with the first reply.
+    """
+    alpha = 3
+
+    def __init__(self):
+        self.storage = PeerStorage()
+        self.lookups = LookupCache()
+        self.protocol = self
+        # [(key, Deferred)] of the get_peers queries not answered yet
+        self.queries = []
+
+    def callGetPeers(self, nodeToAsk, key, priority):
+        d = defer.Deferred()
+        self.queries.append((key.id, d))
+        return d
+
+    def _lookup_peers(self, key, callGetPeers=None):
+        ds = [callGetPeers(Node(chr(i) * 20), Node(key)) for i in range(4)]
+        return defer.gatherResults(ds).addCallback(lambda answers: answers[0])
+
+    def answer(self, count=None):
+        answering = self.queries[:count]
+        del self.queries[:count]
+        for key, d in answering:
+            d.callback([("10.0.0.1", ord(key[0]))])
+
+
+class BulkPeerLookupTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.keys = [chr(i) * 20 for i in range(1, 6)]
+        self.found = []
+
+    def test_budget(self):
+        """
+        No more than maxInflight queries are out at once, and each answer
+        lets one more go.
+        """
+        bulk = BulkPeerLookup(self.server, self.keys, maxInflight=6, onResult=self.onResult)
+        bulk.start()
+        # two lookups of four queries, six of them sent
+        self.assertEqual(bulk.running, 2)
+        self.assertEqual(bulk.messages, 8)
+        self.assertEqual(len(self.server.queries), 6)
+        self.server.answer(1)
+        self.assertEqual(len(self.server.queries), 6)
+        self.server.answer(2)
+        self.assertEqual(len(self.server.queries), 5)
+
+    def test_completes(self):
+        """
+        Every key is looked up once, stored keys without any query, and the
+        lookup fires once they are all done.
+        """
+        self.server.storage.addPeer(self.keys[0], ("10.0.0.2", 6881))
+        bulk = BulkPeerLookup(self.server, self.keys + self.keys[1:2], maxInflight=6, onResult=self.onResult)
+        d = bulk.start()
+        while self.server.queries:
+            self.assertNoResult(d)
+            self.server.answer()
+        self.assertIdentical(self.successResultOf(d), bulk)
+        self.assertEqual(bulk.total, 5)
+        self.assertEqual(bulk.found, 5)
+        self.assertEqual(bulk.messages, 16)
+        self.assertEqual(sorted(self.found), sorted(self.keys))
+        self.assertEqual(bulk.results[self.keys[0]], [("10.0.0.2", 6881)])
+
+    def test_onResultFails(self):
+        """
+        An onResult that raises is logged and doesn't stall the rest.
+        """
+        def onResult(key, peers):
+            raise RuntimeError("boom")
+        d = BulkPeerLookup(self.server, self.keys, maxInflight=6, onResult=onResult).start()
+        while self.server.queries:
+            self.server.answer()
+        self.successResultOf(d)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 5)
+
+    def onResult(self, key, peers):
+        self.found.append(key)
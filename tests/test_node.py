@@ -0,0 +1,137 @@
+import random
+
+from twisted.trial import unittest
+
+from src.node import Node, NodeHeap
+
+
+def randomNode(rand):
+    return Node("".join(chr(rand.getrandbits(8)) for _ in range(20)), "10.0.0.1", 6881)
+
+
+class NodeTest(unittest.TestCase):
+    def test_longId(self):
+        self.assertEqual(Node("\x00" * 19 + "\x05").long_id, 5)
+        self.assertEqual(Node("\xff" * 20).long_id, 2 ** 160 - 1)
+
+    def test_distance(self):
+        self.assertEqual(Node("\x00" * 19 + "\x05").distanceTo(Node("\x00" * 19 + "\x03")), 6)
+
+    def test_intern(self):
+        node = Node.intern("a" * 20, "10.0.0.1", 6881)
+        self.assertIdentical(Node.intern("a" * 20, "10.0.0.1", 6881), node)
+        moved = Node.intern("a" * 20, "10.0.0.2", 6881)
+        self.assertNotIdentical(moved, node)
+        self.assertIdentical(Node.intern("a" * 20, "10.0.0.2", 6881), moved)
+
+
+class NodeHeapTest(unittest.TestCase):
+    def setUp(self):
+        self.rand = random.Random(3)
+        self.target = randomNode(self.rand)
+
+    def closest(self, nodes, count):
+        return sorted(nodes, key=self.target.distanceTo)[:count]
+
+    def test_ordering(self):
+        """
+        Only the maxsize closest nodes are visible, closest first, however
+        they were pushed.
+        """
+        heap = NodeHeap(self.target, 8)
+        nodes = [randomNode(self.rand) for _ in range(100)]
+        for start in range(0, 100, 7):
+            heap.push(nodes[start:start + 7])
+        self.assertEqual(list(heap), self.closest(nodes, 8))
+        self.assertEqual(len(heap), 8)
+        self.assertEqual(heap.getIDs(), [node.id for node in self.closest(nodes, 8)])
+
+    def test_pushSingleAndDuplicates(self):
+        heap = NodeHeap(self.target, 8)
+        node = randomNode(self.rand)
+        heap.push(node)
+        heap.push([node, node])
+        self.assertEqual(list(heap), [node])
+        self.assertIn(node, heap)
+        self.assertIdentical(heap.getNodeById(node.id), node)
+        self.assertIdentical(heap.getNodeById("x" * 20), None)
+
+    def test_remove(self):
+        """
+        Removing visible nodes brings the next closest out of the overflow.
+        """
+        heap = NodeHeap(self.target, 8)
+        nodes = [randomNode(self.rand) for _ in range(50)]
+        heap.push(nodes)
+        removed = self.rand.sample(nodes, 30)
+        heap.remove([node.id for node in removed])
+        remaining = [node for node in nodes if node not in removed]
+        self.assertEqual(list(heap), self.closest(remaining, 8))
+        for node in removed:
+            self.assertNotIn(node, heap)
+
+    def test_removedNotResurrected(self):
+        heap = NodeHeap(self.target, 2)
+        nodes = self.closest([randomNode(self.rand) for _ in range(5)], 5)
+        heap.push(nodes)
+        heap.remove([nodes[3].id])
+        heap.remove([nodes[0].id, nodes[1].id, nodes[2].id])
+        self.assertEqual(list(heap), [nodes[4]])
+
+    def test_popleft(self):
+        heap = NodeHeap(self.target, 4)
+        nodes = [randomNode(self.rand) for _ in range(10)]
+        heap.push(nodes)
+        popped = [heap.popleft() for _ in range(10)]
+        self.assertEqual(popped, self.closest(nodes, 10))
+        self.assertIdentical(heap.popleft(), None)
+
+    def test_contacted(self):
+        heap = NodeHeap(self.target, 4)
+        nodes = self.closest([randomNode(self.rand) for _ in range(10)], 10)
+        heap.push(nodes[2:])
+        self.assertEqual(heap.getUncontacted(), nodes[2:6])
+        heap.markContacted(nodes[2])
+        heap.markContacted(nodes[4])
+        self.assertEqual(heap.getUncontacted(), [nodes[3], nodes[5]])
+        heap.markContacted(nodes[3])
+        heap.markContacted(nodes[5])
+        self.assertTrue(heap.allBeenContacted())
+
+        # closer nodes arriving, and contacted ones dropping out
+        heap.push(nodes[:2])
+        self.assertFalse(heap.allBeenContacted())
+        self.assertEqual(heap.getUncontacted(), nodes[:2])
+        heap.markContacted(nodes[0])
+        heap.remove([nodes[1].id, nodes[2].id])
+        self.assertEqual(list(heap), [nodes[0], nodes[3], nodes[4], nodes[5]])
+        self.assertTrue(heap.allBeenContacted())
+        heap.remove([nodes[0].id])
+        self.assertEqual(heap.getUncontacted(), [nodes[6]])
+
+    def test_randomOperations(self):
+        """
+        The visible window always matches a plain sort of what's left.
+        """
+        heap = NodeHeap(self.target, 8)
+        present = set()
+        contacted = set()
+        for _ in range(2000):
+            action = self.rand.random()
+            if action < 0.5:
+                nodes = [randomNode(self.rand) for _ in range(self.rand.randint(1, 8))]
+                heap.push(nodes)
+                present.update(nodes)
+            elif action < 0.8 and present:
+                node = self.rand.choice(list(heap) or list(present))
+                heap.remove([node.id])
+                present.discard(node)
+            elif len(heap):
+                node = self.rand.choice(list(heap))
+                heap.markContacted(node)
+                contacted.add(node)
+
+            window = self.closest(present, 8)
+            self.assertEqual(list(heap), window)
+            self.assertEqual(heap.getUncontacted(), [n for n in window if n not in contacted])
+            self.assertEqual(heap.allBeenContacted(), all(n in contacted for n in window))
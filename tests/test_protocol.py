@@ -0,0 +1,133 @@
+import errno
+import os
+import socket
+
+from bencode import bdecode, bencode
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from src.node import Node
+from src.protocol import KademliaProtocol
+from src.storage import PeerStorage
+from src.timers import TimerWheel
+
+
+class RecordingTransport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data, address):
+        self.written.append((bdecode(data), address))
+
+
+class DatagramReceivedTest(unittest.TestCase):
+    address = ("10.0.0.1", 6881)
+
+    def setUp(self):
+        self.protocol = KademliaProtocol(Node(os.urandom(20)), PeerStorage(), 8)
+        self.protocol.timeouts = TimerWheel(0.1, Clock())
+        self.protocol.transport = self.transport = RecordingTransport()
+
+    def query(self, method, args):
+        self.protocol.datagramReceived(bencode({"t": "aa", "y": "q", "q": method, "a": args}), self.address)
+        self.assertEqual(len(self.transport.written), 1)
+        return self.transport.written[0][0]
+
+    def test_findNode(self):
+        response = self.query("find_node", {"id": os.urandom(20), "target": os.urandom(20)})
+        self.assertEqual(response["y"], "r")
+        self.assertEqual(response["t"], "aa")
+
+    def test_argumentsNotADict(self):
+        """
+        Queries whose arguments aren't a dict get a generic error.
+        """
+        for method in ("find_node", "get_peers", "ping"):
+            for args in (["x"], "x"):
+                del self.transport.written[:]
+                response = self.query(method, args)
+                self.assertEqual(response["y"], "e")
+                self.assertEqual(response["e"][0], 201)
+
+    def test_badSenderId(self):
+        """
+        Queries from ids that aren't 20 bytes are refused, and the sender
+        doesn't reach the routing table.
+        """
+        for method, args in (("ping", {"id": "short"}), ("find_node", {"id": "x" * 21, "target": "t" * 20}),
+                             ("get_peers", {"id": "", "info_hash": "i" * 20})):
+            del self.transport.written[:]
+            response = self.query(method, args)
+            self.assertEqual(response["e"][0], 203)
+        self.assertEqual(sum(len(bucket) for bucket in self.protocol.router.buckets), 0)
+
+    def test_unknownMethod(self):
+        response = self.query("vote", {"id": os.urandom(20)})
+        self.assertEqual(response["e"][0], 204)
+
+
+class RefusingTransport(object):
+    def write(self, data, address):
+        raise socket.error(errno.EINVAL, "Invalid argument")
+
+
+class SendQueryTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = KademliaProtocol(Node(os.urandom(20)), PeerStorage(), 8)
+        self.protocol.timeouts = TimerWheel(0.1, Clock())
+        self.protocol.transport = RefusingTransport()
+
+    def test_writeFails(self):
+        """
+        A query the port refuses fails right away instead of holding an
+        in-flight slot with no timeout.
+        """
+        d = self.protocol.callPing(Node(os.urandom(20), "10.0.0.1", 0))
+        self.assertFalse(self.successResultOf(d)[0])
+        self.assertEqual(self.protocol._outstanding, {})
+        self.assertEqual(self.protocol.metrics.snapshot()["dht_rpc_sent_total"][("ping", "dropped")], 1)
+        self.flushLoggedErrors(socket.error)
+
+
+class InFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.protocol = KademliaProtocol(Node(os.urandom(20)), PeerStorage(), 8, maxOutstanding=2, maxPending=1)
+        self.protocol.timeouts = TimerWheel(0.1, self.clock)
+        self.protocol.transport = self.transport = RecordingTransport()
+        self.nodes = [Node(os.urandom(20), "10.0.0.%d" % i, 6881) for i in range(1, 5)]
+
+    def answer(self, index):
+        query, address = self.transport.written[index]
+        response = {"t": query["t"], "y": "r", "r": {"id": self.nodes[index].id}}
+        self.protocol.datagramReceived(bencode(response), address)
+
+    def test_caps(self):
+        """
+        Past maxOutstanding queries wait, and past maxPending they fail.
+        """
+        ds = [self.protocol.callPing(node) for node in self.nodes]
+        self.assertEqual(len(self.transport.written), 2)
+        self.assertEqual(len(self.protocol._pending), 1)
+        self.assertFalse(self.successResultOf(ds[3])[0])
+
+        # an answer frees a slot for the pending query
+        self.answer(0)
+        self.assertTrue(self.successResultOf(ds[0])[0])
+        self.assertEqual(len(self.transport.written), 3)
+        self.assertEqual(self.transport.written[2][1], ("10.0.0.3", 6881))
+        self.assertEqual(len(self.protocol._pending), 0)
+
+    def test_timeout(self):
+        self.protocol._waitTimeout = 1.0
+        ds = [self.protocol.callPing(node) for node in self.nodes[:3]]
+        self.clock.pump([0.1] * 11)
+        self.assertFalse(self.successResultOf(ds[0])[0])
+        self.assertFalse(self.successResultOf(ds[1])[0])
+        # sent once the first two timed out
+        self.assertEqual(len(self.transport.written), 3)
+        self.assertNoResult(ds[2])
+        self.clock.pump([0.1] * 11)
+        self.assertFalse(self.successResultOf(ds[2])[0])
+        self.assertEqual(self.protocol._outstanding, {})
+        self.assertIdentical(self.protocol.timeouts.sweepLoop, None)
@@ -0,0 +1,38 @@
+import time
+
+from twisted.trial import unittest
+
+from src.refresh import RefreshScheduler
+from src.routing import KBucket
+
+
+class DueAtTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = RefreshScheduler(None, interval=3600, jitter=0.1)
+
+    def test_jitter(self):
+        """
+        Buckets come due between interval and interval * (1 + jitter)
+        after they were touched, at different times.
+        """
+        buckets = [KBucket(i, 2 ** 160 - 1, 8) for i in range(100)]
+        delays = [self.scheduler.dueAt(bucket) - bucket.lastUpdated for bucket in buckets]
+        for delay in delays:
+            self.assertTrue(3600 <= delay <= 3960, delay)
+        self.assertTrue(len(set(delays)) > 90)
+
+    def test_stableUntilTouched(self):
+        """
+        The delay is drawn again only once the bucket has been touched.
+        """
+        bucket = KBucket(0, 2 ** 160 - 1, 8)
+        due = self.scheduler.dueAt(bucket)
+        self.assertEqual(self.scheduler.dueAt(bucket), due)
+
+        bucket.lastUpdated = time.time() - 7200
+        self.assertTrue(self.scheduler.dueAt(bucket) < due)
+        delays = set()
+        for i in range(10):
+            bucket.lastUpdated = 1000 + i
+            delays.add(self.scheduler.dueAt(bucket) - bucket.lastUpdated)
+        self.assertEqual(len(delays), 10)
@@ -0,0 +1,240 @@
+import random
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from src.node import Node
+from src.routing import KBucket, NodeHealth, RoutingTable, PingQueue, GOOD, QUESTIONABLE, BAD, GOOD_INTERVAL
+
+
+class FakeProtocol(object):
+    def __init__(self):
+        self.pinged = []
+        # the Deferred of each ping, in the order they were sent
+        self.pings = []
+
+    def callPing(self, node, priority):
+        self.pinged.append(node)
+        self.pings.append(defer.Deferred())
+        return self.pings[-1]
+
+
+def randomNode(rand, ip="10.0.0.1"):
+    return Node("".join(chr(rand.getrandbits(8)) for _ in range(20)), ip, rand.randint(1, 65535))
+
+
+class NodeHealthTest(unittest.TestCase):
+    def test_states(self):
+        health = NodeHealth(1000)
+        # only heard from, never answered
+        self.assertEqual(health.state(1000), QUESTIONABLE)
+        health.seen(1000, replied=True)
+        self.assertEqual(health.state(1000 + GOOD_INTERVAL - 1), GOOD)
+        self.assertEqual(health.state(1000 + GOOD_INTERVAL), QUESTIONABLE)
+        # a query from it keeps it good
+        health.seen(2000, replied=False)
+        self.assertEqual(health.state(2000 + GOOD_INTERVAL - 1), GOOD)
+
+    def test_bad(self):
+        health = NodeHealth(1000)
+        health.seen(1000, replied=True)
+        health.failures += 2
+        self.assertEqual(health.state(1000), BAD)
+        health.seen(1001, replied=True)
+        self.assertEqual(health.state(1001), GOOD)
+
+
+class KBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.rand = random.Random(1)
+        self.bucket = KBucket(0, 2 ** 160, 2)
+        self.nodes = [randomNode(self.rand) for _ in range(4)]
+
+    def test_replacements(self):
+        """
+        Contacts that don't fit in a full bucket wait as replacements.
+        """
+        for node in self.nodes:
+            self.assertEqual(self.bucket.addNode(node, replied=True), node in self.nodes[:2])
+        self.assertEqual(self.bucket.getNodes(), self.nodes[:2])
+        self.assertEqual(self.bucket.replacementNodes.values(), self.nodes[2:])
+        self.assertEqual(self.bucket.state(self.nodes[0]), GOOD)
+        self.assertIdentical(self.bucket.state(self.nodes[2]), None)
+
+    def test_promotion(self):
+        """
+        A node is replaced by the freshest replacement once it is bad.
+        """
+        for node in self.nodes:
+            self.bucket.addNode(node, replied=True)
+        self.bucket.nodeFailed(self.nodes[0])
+        self.assertIn(self.nodes[0], self.bucket.getNodes())
+        self.bucket.nodeFailed(self.nodes[0])
+        self.assertEqual(self.bucket.getNodes(), [self.nodes[1], self.nodes[3]])
+        self.assertEqual(self.bucket.replacementNodes.values(), [self.nodes[2]])
+
+    def test_badKeptWithoutReplacement(self):
+        """
+        Without a replacement a bad node stays until a new contact arrives
+        to take its place.
+        """
+        for node in self.nodes[:2]:
+            self.bucket.addNode(node, replied=True)
+        for _ in range(2):
+            self.bucket.nodeFailed(self.nodes[0])
+        self.assertEqual(self.bucket.state(self.nodes[0]), BAD)
+        self.assertTrue(self.bucket.addNode(self.nodes[2]))
+        self.assertEqual(self.bucket.getNodes(), [self.nodes[1], self.nodes[2]])
+
+    def test_failedReplacementDropped(self):
+        for node in self.nodes[:3]:
+            self.bucket.addNode(node, replied=True)
+        self.bucket.nodeFailed(self.nodes[2])
+        self.assertEqual(len(self.bucket.replacementNodes), 0)
+        self.assertNotIn(self.nodes[2].id, self.bucket.health)
+
+    def test_staleNode(self):
+        """
+        The least recently seen questionable node is the one to ping.
+        """
+        for node in self.nodes[:2]:
+            self.bucket.addNode(node, replied=True)
+        now = self.bucket.health[self.nodes[1].id].lastSeen
+        self.assertIdentical(self.bucket.staleNode(now), None)
+        self.assertIdentical(self.bucket.staleNode(now + GOOD_INTERVAL), self.nodes[0])
+
+
+class PingQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.rand = random.Random(1)
+        self.protocol = FakeProtocol()
+        self.router = RoutingTable(self.protocol, 2, randomNode(self.rand))
+        self.clock = Clock()
+        self.pings = PingQueue(self.router, rate=2, maxQueued=3, clock=self.clock)
+
+    def test_dedup(self):
+        """
+        A node is pinged once while a ping of it is queued or unanswered.
+        """
+        node = randomNode(self.rand)
+        self.pings.ping(node)
+        self.pings.ping(node)
+        self.assertEqual(self.protocol.pinged, [node])
+        self.protocol.pings[0].callback((True, {}, node))
+        self.pings.ping(node)
+        self.assertEqual(self.protocol.pinged, [node, node])
+
+    def test_rate(self):
+        """
+        Pings beyond the rate wait for tokens, and beyond maxQueued are
+        dropped.
+        """
+        nodes = [randomNode(self.rand) for _ in range(6)]
+        for node in nodes:
+            self.pings.ping(node)
+        self.assertEqual(self.protocol.pinged, nodes[:2])
+        self.assertEqual(len(self.pings.queue), 3)
+        self.assertEqual(self.pings.dropped, 1)
+        self.clock.advance(0.5)
+        self.assertEqual(self.protocol.pinged, nodes[:3])
+        self.clock.pump([0.5, 0.5])
+        self.assertEqual(self.protocol.pinged, nodes[:5])
+        self.assertIdentical(self.pings.drainCall, None)
+        self.assertEqual(self.pings.sent, 5)
+
+    def test_failedEvicted(self):
+        """
+        A node that doesn't answer makes way for the freshest replacement.
+        """
+        nodes = [randomNode(self.rand, "10.0.0.%d" % i) for i in range(1, 4)]
+        bucket = KBucket(0, 2 ** 160, 2)
+        for node in nodes:
+            bucket.addNode(node, replied=True)
+        self.router.buckets = [bucket]
+        self.pings.ping(nodes[0])
+        self.protocol.pings[0].callback((False, None))
+        self.assertEqual(bucket.getNodes(), nodes[1:])
+        self.assertNotIn(nodes[0].id, self.pings.pending)
+
+
+class RoutingTableTest(unittest.TestCase):
+    def setUp(self):
+        self.rand = random.Random(1)
+        self.protocol = FakeProtocol()
+        self.router = RoutingTable(self.protocol, 8, randomNode(self.rand))
+        self.router.pings = PingQueue(self.router, clock=Clock())
+
+    def fill(self, count):
+        """
+        Add count contacts, half of them spread over the buckets near our
+        own id so that the table splits deep.
+        """
+        for i in range(count):
+            node = self.nearNode() if i % 2 else randomNode(self.rand)
+            self.router.addContact(node, replied=i % 3 != 0)
+
+    def nearNode(self):
+        """
+        A node sharing a random prefix of up to 40 bits with our own id.
+        """
+        bits = self.rand.randint(1, 40)
+        distance = (1 << (160 - bits)) | self.rand.getrandbits(160 - bits)
+        return Node(("%040x" % (self.router.node.long_id ^ distance)).decode("hex"), "10.0.0.2",
+                    self.rand.randint(1, 65535))
+
+    def test_rangeLowers(self):
+        self.fill(2000)
+        self.assertTrue(len(self.router.buckets) > 10)
+        self.assertEqual(self.router.rangeLowers, [bucket.range[0] for bucket in self.router.buckets])
+        for previous, bucket in zip(self.router.buckets, self.router.buckets[1:]):
+            self.assertEqual(previous.range[1] + 1, bucket.range[0])
+
+    def test_getBucketFor(self):
+        self.fill(2000)
+        for _ in range(500):
+            node = randomNode(self.rand)
+            index = self.router.getBucketFor(node)
+            self.assertTrue(self.router.buckets[index].hasInRange(node))
+        for bucket in self.router.buckets:
+            for bound in bucket.range:
+                self.assertIdentical(self.router.buckets[self.router.getBucketFor(Node(("%040x" % bound).decode("hex")))],
+                                     bucket)
+
+    def test_isKnownId(self):
+        self.fill(200)
+        for node in self.router.buckets[-1].getNodes():
+            self.assertTrue(self.router.isKnownId(node.id))
+        self.assertFalse(self.router.isKnownId(randomNode(self.rand).id))
+        self.assertFalse(self.router.isKnownId(None))
+        self.assertFalse(self.router.isKnownId("short"))
+
+    def test_findNeighbors(self):
+        """
+        The outward walk finds the same nodes as sorting the whole table.
+        """
+        self.fill(2000)
+        contacts = [node for bucket in self.router.buckets for node in bucket.getNodes()]
+        health = dict((node.id, bucket.state(node)) for bucket in self.router.buckets for node in bucket.getNodes())
+        for k in (1, 8, 20, 100):
+            for i in range(100):
+                target = self.nearNode() if i % 2 else randomNode(self.rand)
+                expected = sorted(contacts, key=lambda node: ((target.long_id ^ node.long_id).bit_length(),
+                                                              health[node.id] != GOOD,
+                                                              target.long_id ^ node.long_id))[:k]
+                self.assertEqual(self.router.findNeighbors(target, k), expected)
+
+    def test_findNeighborsOwnBucket(self):
+        self.fill(2000)
+        node = self.router.buckets[0].getNodes()[0]
+        self.assertNotIn(node, self.router.findNeighbors(node, 50))
+        self.assertEqual(len(self.router.findNeighbors(node, 50)), 50)
+
+    def test_findNeighborsExclude(self):
+        self.fill(300)
+        excluded = self.router.buckets[-1].getNodes()[0]
+        neighbors = self.router.findNeighbors(excluded, 1000, exclude=excluded)
+        self.assertFalse([node for node in neighbors if node.sameHomeAs(excluded)])
+
+    def test_findNeighborsEmpty(self):
+        self.assertEqual(self.router.findNeighbors(randomNode(self.rand)), [])
@@ -0,0 +1,52 @@
+import os
+
+from twisted.trial import unittest
+
+from src.node import Node
+from src.protocol import KademliaProtocol
+from src.rtt import RTTEstimator, PeerRTTs
+from src.storage import PeerStorage
+
+
+class RTTEstimatorTest(unittest.TestCase):
+    def test_noSamples(self):
+        self.assertEqual(RTTEstimator().timeout(0.5, 15), 15)
+
+    def test_timeout(self):
+        estimator = RTTEstimator()
+        estimator.update(0.2)
+        # srtt 0.2, rttvar 0.1
+        self.assertAlmostEqual(estimator.timeout(0.05, 15), 0.6)
+        self.assertEqual(estimator.timeout(1.0, 15), 1.0)
+        self.assertEqual(estimator.timeout(0.05, 0.3), 0.3)
+
+
+class PeerRTTsTest(unittest.TestCase):
+    def test_byAddress(self):
+        rtts = PeerRTTs()
+        node = Node("a" * 20, "10.0.0.1", 6881)
+        rtts.update(node, 0.1)
+        self.assertEqual(rtts.get(Node("a" * 20, "10.0.0.1", 6881)).samples, 1)
+        self.assertIdentical(rtts.get(Node("a" * 20, "10.0.0.2", 6881)), None)
+
+    def test_bounded(self):
+        rtts = PeerRTTs(maxsize=2)
+        a, b, c = [Node(c * 20, "10.0.0.1", 6881) for c in "abc"]
+        rtts.update(a, 0.1)
+        rtts.update(b, 0.1)
+        rtts.update(a, 0.1)
+        rtts.update(c, 0.1)
+        self.assertEqual(len(rtts), 2)
+        self.assertIdentical(rtts.get(b), None)
+        self.assertEqual(rtts.get(a).samples, 2)
+
+    def test_perProtocol(self):
+        """
+        Protocols in one process time the same interned node separately.
+        """
+        node = Node.intern(os.urandom(20), "10.0.0.1", 6881)
+        fast, slow = [KademliaProtocol(Node(os.urandom(20)), PeerStorage(), 8) for _ in range(2)]
+        fast.peerRTTs.update(node, 0.01)
+        slow.peerRTTs.update(node, 2.0)
+        self.assertEqual(fast.queryTimeout(node), fast.minTimeout)
+        self.assertEqual(slow.queryTimeout(node), slow._waitTimeout)
@@ -0,0 +1,99 @@
+import random
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from src.node import Node
+from src.routing import RoutingTable, PingQueue, QUESTIONABLE
+from src.snapshot import SnapshotError, read_snapshot, write_snapshot
+from tests.test_routing import FakeProtocol, randomNode
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.rand = random.Random(7)
+        self.router = self.makeRouter(randomNode(self.rand))
+        for _ in range(500):
+            self.router.addContact(randomNode(self.rand), replied=True)
+        self.fname = self.mktemp()
+
+    def makeRouter(self, node):
+        router = RoutingTable(FakeProtocol(), 8, node)
+        router.pings = PingQueue(router, clock=Clock())
+        return router
+
+    def contents(self, router):
+        return [(bucket.range, bucket.getNodes()) for bucket in router.buckets]
+
+    def test_roundTrip(self):
+        write_snapshot(self.fname, self.router, 3)
+        data = read_snapshot(self.fname)
+        self.assertEqual((data["ksize"], data["alpha"], data["id"]), (8, 3, self.router.node.id))
+        self.assertEqual(len(data["buckets"]), len(self.router.buckets))
+
+        for (lower, upper, lastUpdated, nodes), bucket in zip(data["buckets"], self.router.buckets):
+            self.assertEqual((lower, upper), bucket.range)
+            self.assertAlmostEqual(lastUpdated, bucket.lastUpdated)
+            self.assertEqual([tuple(node) for node, _ in nodes], [tuple(node) for node in bucket.getNodes()])
+            self.assertEqual([seen for _, seen in nodes],
+                             [int(bucket.health[node.id].lastSeen) for node in bucket.getNodes()])
+
+    def test_restore(self):
+        """
+        A table restored from a snapshot holds the same contacts in the
+        same buckets, all of them questionable.
+        """
+        write_snapshot(self.fname, self.router, 3)
+        restored = self.makeRouter(Node(self.router.node.id))
+        restored.restore(read_snapshot(self.fname)["buckets"])
+
+        self.assertEqual([(r, map(tuple, nodes)) for r, nodes in self.contents(restored)],
+                         [(r, map(tuple, nodes)) for r, nodes in self.contents(self.router)])
+        self.assertEqual(restored.rangeLowers, self.router.rangeLowers)
+        for bucket in restored.buckets:
+            for node in bucket.getNodes():
+                self.assertEqual(bucket.state(node), QUESTIONABLE)
+        target = randomNode(self.rand)
+        self.assertEqual(map(tuple, restored.findNeighbors(target)), map(tuple, self.router.findNeighbors(target)))
+
+    def test_nonIPv4Skipped(self):
+        bucket = self.router.buckets[self.router.getBucketFor(self.router.node)]
+        ipv6 = Node(self.router.node.id[:-1] + chr(ord(self.router.node.id[-1]) ^ 1), "::1", 6881)
+        bucket.nodes.popitem()
+        bucket.addNode(ipv6)
+        write_snapshot(self.fname, self.router, 3)
+        ids = [node.id for _, _, _, nodes in read_snapshot(self.fname)["buckets"] for node, _ in nodes]
+        self.assertNotIn(ipv6.id, ids)
+        self.assertEqual(len(ids), sum(len(bucket) for bucket in self.router.buckets) - 1)
+
+    def test_badIdsSkipped(self):
+        """
+        A contact whose id isn't 20 bytes doesn't make the snapshot
+        unreadable.
+        """
+        bucket = self.router.buckets[0]
+        bucket.nodes.popitem()
+        short = Node("short", "10.0.0.9", 6881)
+        bucket.addNode(short)
+        write_snapshot(self.fname, self.router, 3)
+        ids = [node.id for _, _, _, nodes in read_snapshot(self.fname)["buckets"] for node, _ in nodes]
+        self.assertNotIn(short.id, ids)
+        self.assertEqual(len(ids), sum(len(bucket) for bucket in self.router.buckets) - 1)
+
+    def test_badFiles(self):
+        write_snapshot(self.fname, self.router, 3)
+        with open(self.fname, "rb") as f:
+            data = f.read()
+
+        for corrupted in ("", data[:20], data[:-1], data[:len(data) / 2], "XXXX" + data[4:],
+                          data[:4] + "\x09" + data[5:]):
+            with open(self.fname, "wb") as f:
+                f.write(corrupted)
+            self.assertRaises(SnapshotError, read_snapshot, self.fname)
+
+    def test_restoreChecksCoverage(self):
+        router = self.makeRouter(randomNode(self.rand))
+        for buckets in ([], [(0, 2 ** 159 - 1, 0, [])], [(0, 2 ** 159, 0, []), (2 ** 159, 2 ** 160 - 1, 0, [])],
+                        [(1, 2 ** 160 - 1, 0, [])]):
+            self.assertRaises(ValueError, router.restore, buckets)
+        self.assertEqual(len(router.buckets), 1)
@@ -0,0 +1,90 @@
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from src.storage import ForgetfulStorage, PeerStorage
+
+
+class ForgetfulStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_cullOnAccess(self):
+        storage = ForgetfulStorage(ttl=100, clock=self.clock)
+        storage["a"] = 1
+        self.clock.advance(50)
+        storage["b"] = 2
+        self.clock.advance(50)
+        self.assertIdentical(storage.get("a"), None)
+        self.assertEqual(list(storage.data), ["b"])
+        self.assertEqual(list(storage.iteritemsOlderThan(50)), [("b", 2)])
+
+    def test_swept(self):
+        """
+        In swept mode expired items read as missing at once, but only the
+        sweep loop drops them, sweepBatch at a time.
+        """
+        storage = ForgetfulStorage(ttl=100, sweepInterval=10, sweepBatch=2, clock=self.clock)
+        self.addCleanup(storage.sweepLoop.stop)
+        for key in "abc":
+            storage[key] = key
+        self.clock.advance(95)
+        storage["d"] = "d"
+        self.clock.advance(5)
+        self.assertIdentical(storage.get("a"), None)
+        self.assertRaises(KeyError, storage.__getitem__, "b")
+        self.assertEqual(list(storage), ["d"])
+        self.assertEqual(list(storage.data), ["c", "d"])
+        self.clock.advance(10)
+        self.assertEqual(list(storage.data), ["d"])
+        self.assertEqual(storage["d"], "d")
+
+
+class PeerStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.storage = PeerStorage(ttl=100, maxPeers=3, maxKeys=2, clock=self.clock)
+
+    def test_perPeerExpiry(self):
+        """
+        Each peer expires ttl seconds after its own last announce.
+        """
+        self.storage.addPeer("a", ("10.0.0.1", 1))
+        self.clock.advance(50)
+        self.storage.addPeer("a", ("10.0.0.2", 2))
+        self.assertEqual(self.storage.get("a"), [("10.0.0.1", 1), ("10.0.0.2", 2)])
+        self.clock.advance(50)
+        self.assertEqual(self.storage.get("a"), [("10.0.0.2", 2)])
+        self.assertEqual(list(self.storage.iteritemsOlderThan(50)), [("a", [("10.0.0.2", 2)])])
+        self.clock.advance(50)
+        self.assertIdentical(self.storage.get("a"), None)
+        self.assertRaises(KeyError, self.storage.__getitem__, "a")
+        self.assertEqual(list(self.storage), [])
+
+    def test_reannounce(self):
+        self.storage.addPeer("a", ("10.0.0.1", 1))
+        self.clock.advance(90)
+        self.storage.addPeer("a", ("10.0.0.1", 1))
+        self.clock.advance(90)
+        self.assertEqual(self.storage["a"], [("10.0.0.1", 1)])
+
+    def test_maxPeers(self):
+        """
+        The least recently announced peer makes room for a new one.
+        """
+        for port in range(1, 5):
+            self.storage.addPeer("a", ("10.0.0.1", port))
+        self.storage.addPeer("a", ("10.0.0.1", 2))
+        self.storage.addPeer("a", ("10.0.0.1", 5))
+        self.assertEqual(self.storage["a"], [("10.0.0.1", 4), ("10.0.0.1", 2), ("10.0.0.1", 5)])
+
+    def test_maxKeys(self):
+        """
+        The least recently announced key makes room for a new one.
+        """
+        for key in "abc":
+            self.storage.addPeer(key, ("10.0.0.1", 1))
+            self.clock.advance(1)
+        self.assertEqual(list(self.storage), ["b", "c"])
+        self.storage.addPeer("b", ("10.0.0.1", 2))
+        self.storage["d"] = [("10.0.0.1", 1)]
+        self.assertEqual(list(self.storage), ["b", "d"])
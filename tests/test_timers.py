@@ -0,0 +1,84 @@
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from src.timers import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimerWheel(0.5, self.clock)
+        self.fired = []
+
+    def test_firesWithinResolution(self):
+        """
+        Calls fire no earlier than asked and at most one resolution late.
+        """
+        for delay in (0.2, 0.5, 0.7, 3.0):
+            self.wheel.callLater(delay, self.fired.append, delay)
+        fired = {}
+        for step in range(10):
+            self.clock.advance(0.5)
+            for delay in self.fired:
+                fired.setdefault(delay, self.clock.seconds())
+        for delay, at in fired.items():
+            self.assertTrue(delay <= at <= delay + 0.5, (delay, at))
+        self.assertEqual(sorted(fired), [0.2, 0.5, 0.7, 3.0])
+
+    def test_cancel(self):
+        call = self.wheel.callLater(1, self.fired.append, "x")
+        self.assertTrue(call.active())
+        call.cancel()
+        self.assertFalse(call.active())
+        self.clock.advance(2)
+        self.assertEqual(self.fired, [])
+
+    def test_sweepStopsWhenEmpty(self):
+        call = self.wheel.callLater(1, self.fired.append, "x")
+        self.assertEqual(len(self.wheel), 1)
+        self.clock.pump([0.5] * 3)
+        self.assertEqual(self.fired, ["x"])
+        self.assertFalse(call.active())
+        self.assertIdentical(self.wheel.sweepLoop, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_longPause(self):
+        self.wheel.callLater(1, self.fired.append, 1)
+        self.wheel.callLater(1000, self.fired.append, 1000)
+        self.clock.advance(100)
+        self.assertEqual(self.fired, [1])
+        self.clock.advance(900)
+        self.assertEqual(self.fired, [1, 1000])
+
+    def test_failingCall(self):
+        """
+        A call that raises is logged, and neither the rest of its slot nor
+        later calls are lost.
+        """
+        def fail():
+            raise RuntimeError("boom")
+        self.wheel.callLater(1, fail)
+        self.wheel.callLater(1, self.fired.append, "same slot")
+        self.wheel.callLater(2, self.fired.append, "later")
+        self.clock.pump([0.5] * 4)
+        self.assertEqual(self.fired, ["same slot", "later"])
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+        self.wheel.callLater(1, self.fired.append, "after")
+        self.clock.pump([0.5] * 3)
+        self.assertEqual(self.fired[-1], "after")
+
+    def test_sweepFailure(self):
+        """
+        If the sweep itself fails, the next callLater starts a new one.
+        """
+        self.wheel.callLater(1, self.fired.append, "x")
+        self.wheel.slots = None
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.flushLoggedErrors(TypeError)), 1)
+        self.assertIdentical(self.wheel.sweepLoop, None)
+
+        self.wheel.slots = {}
+        self.wheel.callLater(1, self.fired.append, "y")
+        self.clock.pump([0.5] * 3)
+        self.assertEqual(self.fired, ["y"])
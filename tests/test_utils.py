@@ -0,0 +1,47 @@
+import os
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from src.node import Node
+from src.utils import TokenManager, decode_nodes, encode_nodes
+
+
+class CompactNodesTest(unittest.TestCase):
+    def test_roundTrip(self):
+        nodes = [Node(os.urandom(20), "10.0.%d.%d" % (i / 250, i % 250), 1000 + i) for i in range(300)]
+        self.assertEqual(decode_nodes(encode_nodes(nodes)), [list(node) for node in nodes])
+
+    def test_badLength(self):
+        self.assertEqual(decode_nodes("x" * 27), [])
+
+    def test_portZeroSkipped(self):
+        nodes = [Node("a" * 20, "10.0.0.1", 6881), Node("b" * 20, "10.0.0.2", 0), Node("c" * 20, "10.0.0.3", 1)]
+        self.assertEqual([nodeId for nodeId, _, _ in decode_nodes(encode_nodes(nodes))], ["a" * 20, "c" * 20])
+
+
+class TokenManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.tokens = TokenManager(interval=300, clock=self.clock)
+        self.tokens.start()
+        self.addCleanup(self.tokens.stop)
+
+    def test_perAddress(self):
+        token = self.tokens.generate("10.0.0.1", 6881)
+        self.assertEqual(len(token), 8)
+        self.assertTrue(self.tokens.verify("10.0.0.1", 6881, token))
+        self.assertFalse(self.tokens.verify("10.0.0.2", 6881, token))
+        self.assertFalse(self.tokens.verify("10.0.0.1", 6882, token))
+        self.assertFalse(self.tokens.verify("10.0.0.1", 6881, None))
+
+    def test_rotation(self):
+        """
+        A token stays valid through the next rotation and no further.
+        """
+        token = self.tokens.generate("10.0.0.1", 6881)
+        self.clock.advance(300)
+        self.assertNotEqual(self.tokens.generate("10.0.0.1", 6881), token)
+        self.assertTrue(self.tokens.verify("10.0.0.1", 6881, token))
+        self.clock.advance(300)
+        self.assertFalse(self.tokens.verify("10.0.0.1", 6881, token))
@@ -0,0 +1,60 @@
+"""
+Throughput of announce token generation and verification.
+
+Compares the legacy per-request datetime/SHA-1 tokens with TokenManager.
+
+    python token_benchmark.py [operations]
+"""
+import datetime
+import hashlib
+import math
+import sys
+import time
+from uuid import uuid4
+
+from src.utils import TokenManager
+
+token_salt = uuid4().bytes
+
+
+def ceil_dt(dt):
+    nsecs = dt.minute * 60 + dt.second + dt.microsecond * 1e-6
+    delta = math.ceil(nsecs / 300) * 300 - nsecs
+    return dt + datetime.timedelta(seconds=delta)
+
+
+def legacy_generate(ip, port):
+    return hashlib.sha1(token_salt + str(ceil_dt(datetime.datetime.now())) + ip + str(port)).digest()
+
+
+def legacy_verify(ip, port, token):
+    return legacy_generate(ip, port) == token
+
+
+def rate(f, count):
+    started = time.time()
+    for i in xrange(count):
+        f(i)
+    return count / (time.time() - started)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    manager = TokenManager()
+    ip = "10.1.2.3"
+    legacy_token = legacy_generate(ip, 6881)
+    token = manager.generate(ip, 6881)
+
+    print "%-10s %14s %14s" % ("operation", "legacy ops/s", "manager ops/s")
+    print "%-10s %14.0f %14.0f" % (
+        "generate",
+        rate(lambda i: legacy_generate(ip, i & 0xffff), count),
+        rate(lambda i: manager.generate(ip, i & 0xffff), count))
+    print "%-10s %14.0f %14.0f" % (
+        "verify",
+        rate(lambda i: legacy_verify(ip, 6881, legacy_token), count),
+        rate(lambda i: manager.verify(ip, 6881, token), count))
+
+
+if __name__ == "__main__":
+    main()